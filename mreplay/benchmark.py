@@ -0,0 +1,974 @@
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import mmap
+import tempfile
+import random
+import resource
+import itertools
+import collections
+from optparse import OptionParser
+import scribe
+from mreplay import unistd
+from mreplay.location import Location
+from mreplay import mutator
+from mreplay import log_index
+from mreplay.log_writer import LogWriter
+from mreplay.session import Session, LazySession, Event, events_from_buffer
+from mreplay.streaming import StreamingSession, peak_rss
+
+def synthetic_events(num_events, num_procs=8, syscall_mix=None,
+                     num_resources=1, data_size=5, seed=0):
+    """ Yields a scribe event stream of about num_events events, spread
+        over num_procs processes, each switching process after a few
+        syscalls. syscall_mix is a list of (nr, weight) the syscalls are
+        picked from, reads only by default. Each syscall locks one of
+        num_resources resources: the fewer, the more contention. Reads and
+        writes carry data_size bytes of data.
+    """
+    if syscall_mix is None:
+        syscall_mix = [(unistd.NR_read, 1)]
+    nrs = [nr for (nr, weight) in syscall_mix for i in xrange(weight)]
+    rand = random.Random(seed)
+    serials = [itertools.count() for i in xrange(num_resources)]
+    data = ('hello' * (data_size / 5 + 1))[:data_size]
+
+    def syscall():
+        nr = rand.choice(nrs)
+        io = nr in (unistd.NR_read, unistd.NR_write)
+        events = [scribe.EventSyscallExtra(nr=nr, ret=data_size if io else 0)]
+        if io:
+            events.append(scribe.EventData(data))
+        resource = rand.randrange(num_resources)
+        events.append(scribe.EventResourceLockExtra(id=3 + resource,
+                      serial=serials[resource].next()))
+        events.append(scribe.EventResourceUnlock())
+        events.append(scribe.EventSyscallEnd())
+        events.append(scribe.EventRdtsc())
+        return events
+
+    yield scribe.EventInit()
+    count = 1
+    for pid in itertools.cycle(xrange(1, num_procs + 1)):
+        if count >= num_events:
+            return
+        yield scribe.EventPid(pid=pid)
+        count += 1
+        for _ in xrange(4):
+            events = syscall()
+            for e in events:
+                yield e
+            count += len(events)
+
+def _instance_bytes(obj):
+    # The Event class proxies unknown attributes, don't go through it.
+    total = sys.getsizeof(obj)
+    try:
+        attrs = object.__getattribute__(obj, '__dict__')
+    except AttributeError:
+        return total
+    total += sys.getsizeof(attrs)
+    for value in attrs.values():
+        if isinstance(value, dict):
+            total += sys.getsizeof(value)
+    return total
+
+def _event_list_bytes(event_list):
+    total = 0
+    for name in ('_events', '_indices'):
+        container = getattr(event_list, name, None)
+        if container is not None:
+            total += sys.getsizeof(container)
+    return total
+
+def session_bytes(session):
+    """ Bytes used by the Event wrappers and the event lists of a session,
+        not counting the scribe events themselves.
+    """
+    total = sys.getsizeof(session.events)
+    for e in session.events:
+        total += _instance_bytes(e)
+    for proc in session.processes.values():
+        total += _event_list_bytes(proc.events)
+        total += _event_list_bytes(proc.syscalls)
+    return total
+
+def bench_event_memory(num_events, num_procs=8):
+    events = list(synthetic_events(num_events, num_procs))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    session = Session(events)
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    num_events = len(session.events)
+    return {
+        'events':          num_events,
+        'load_time':       elapsed,
+        'bytes_per_event': float(session_bytes(session)) / num_events,
+        'rss_per_event':   float(rss_after - rss_before) * 1024 / num_events,
+    }
+
+def bench_mutator_pipeline(num_events, num_procs=8):
+    session = Session(synthetic_events(num_events, num_procs))
+    proc = session.init_proc
+    victim = proc.syscalls[len(proc.syscalls) / 2]
+
+    start = time.time()
+    events  = session | mutator.DeleteEvent([victim])
+    events |= mutator.AdjustResources()
+    events |= mutator.InsertPidEvents()
+    events |= mutator.ToRawEvents()
+    num_out = sum(1 for _ in events)
+    elapsed = time.time() - start
+
+    num_events = len(session.events)
+    return {
+        'events':         num_events,
+        'events_out':     num_out,
+        'time':           elapsed,
+        'usec_per_event': elapsed * 1e6 / num_events,
+    }
+
+def bench_sharded_pipeline(num_events, num_procs=8, jobs=4):
+    """ A few per process mutations in each process, run over the
+        interleaved stream and sharded by process.
+    """
+    session = Session(synthetic_events(num_events, num_procs))
+    def pipeline():
+        m = mutator.Nop()
+        for proc in session.processes.values():
+            syscalls = proc.syscalls
+            m |= mutator.DeleteEvent([syscalls[len(syscalls) / 3]])
+            m |= mutator.InsertEvent(
+                    Location(syscalls[2 * len(syscalls) / 3], 'before'),
+                    [Event(scribe.EventNop(), proc)])
+        m |= mutator.AdjustResources()
+        m |= mutator.InsertPidEvents()
+        return m
+
+    result = {'events': len(session.events)}
+    for (name, m) in (('serial', pipeline()),
+                      ('sharded', mutator.shard(pipeline(), jobs))):
+        start = time.time()
+        for e in session | m:
+            pass
+        result[name] = time.time() - start
+    return result
+
+def write_synthetic_log(num_events, num_procs=8, **params):
+    """ Returns the path of a temporary log file, and its mapping. params
+        go to synthetic_events().
+    """
+    (fd, path) = tempfile.mkstemp(prefix='mreplay-bench-')
+    with os.fdopen(fd, 'wb') as logfile:
+        for e in synthetic_events(num_events, num_procs, **params):
+            logfile.write(e.encode())
+    with open(path, 'rb') as logfile:
+        buf = mmap.mmap(logfile.fileno(), 0, prot=mmap.PROT_READ)
+    return (path, buf)
+
+def bench_load(num_events, num_procs=8, jobs=4):
+    """ Indexing a log in a single process, and with 2, 4... up to jobs
+        processes. scan is the first pass of the parallel indexing, which
+        only reads the event headers.
+    """
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        start = time.time()
+        for header in log_index.scan_headers(buf):
+            pass
+        scan = time.time() - start
+
+        start = time.time()
+        log_index.build_index(buf)
+        sequential = time.time() - start
+
+        parallel = dict()
+        n = 2
+        while n <= jobs:
+            start = time.time()
+            log_index.build_index_parallel(path, buf, n)
+            parallel[n] = time.time() - start
+            n *= 2
+        return {
+            'scan':       scan,
+            'sequential': sequential,
+            'parallel':   parallel,
+        }
+    finally:
+        os.unlink(path)
+
+def bench_streaming(num_events, num_procs=8, memory_cap=16 << 20):
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+
+        start = time.time()
+        session = StreamingSession(buf, memory_cap=memory_cap)
+        load_time = time.time() - start
+
+        # Walk every process like the explorer does when it picks a victim
+        start = time.time()
+        for proc in session.processes.values():
+            for e in proc.syscalls:
+                pass
+        walk_time = time.time() - start
+
+        result = session.stats()
+        result['events'] = len(session.events)
+        result['load_time'] = load_time
+        result['walk_time'] = walk_time
+        session.close()
+        return result
+    finally:
+        os.unlink(path)
+
+def bench_mutation_chain(num_events, num_procs=8, depth=200):
+    """ A chain of depth mutations, like an execution depth deep in the
+        exploration tree, applied as nested mutators and as an EditPlan.
+    """
+    session = Session(synthetic_events(num_events, num_procs))
+    syscalls = [s for proc in session.processes.values()
+                  for s in proc.syscalls]
+    step = max(1, len(syscalls) / (depth + 1))
+
+    chain = []
+    for i in xrange(depth):
+        target = syscalls[i * step]
+        if i % 2:
+            chain.append(mutator.DeleteEvent([target]))
+        else:
+            nop = Event(scribe.EventNop(), target.proc)
+            chain.append(mutator.InsertEvent(Location(target, 'before'), [nop]))
+
+    start = time.time()
+    events = session
+    for m in chain:
+        events |= m
+    try:
+        num_out = sum(1 for _ in events)
+        nested_time = time.time() - start
+    except RuntimeError:
+        # maximum recursion depth exceeded
+        nested_time = None
+
+    start = time.time()
+    plan = mutator.EditPlan(session, chain)
+    compile_time = time.time() - start
+    start = time.time()
+    num_out = sum(1 for _ in session | plan)
+    apply_time = time.time() - start
+    return {
+        'nested_time':  nested_time,
+        'compile_time': compile_time,
+        'apply_time':   apply_time,
+    }
+
+def bench_log_writer(num_events, num_procs=8):
+    """ Writes the same mutated session by encoding each event, by reusing
+        the bytes the events were read from (eager session), and by splicing
+        the log buffer (lazy session).
+    """
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        def mutated(session):
+            proc = session.init_proc
+            victim = proc.syscalls[len(proc.syscalls) * 9 / 10]
+            events  = session | mutator.DeleteEvent([victim])
+            events |= mutator.AdjustResources()
+            events |= mutator.InsertPidEvents()
+            return list(events)
+
+        # The mutators run once, only the writing is measured
+        session = LazySession(buf)
+        start = time.time()
+        events = mutated(session)
+        pipeline_time = time.time() - start
+        rss_before = peak_rss()
+        start = time.time()
+        eager_session = Session(events_from_buffer(buf))
+        load_time = time.time() - start
+        load_rss = peak_rss() - rss_before
+        eager_events = mutated(eager_session)
+
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            for e in events | mutator.ToRawEvents():
+                devnull.write(e.encode())
+            encode_time = time.time() - start
+
+            start = time.time()
+            reuse_writer = LogWriter(devnull)
+            for e in eager_events:
+                reuse_writer.write(e)
+            reuse_writer.flush()
+            reuse_time = time.time() - start
+
+            start = time.time()
+            writer = LogWriter(devnull, session)
+            for e in events:
+                writer.write(e)
+            writer.flush()
+            splice_time = time.time() - start
+
+        mb = len(buf) / float(1 << 20)
+        return {
+            'load_time':     load_time,
+            'load_rss':      load_rss,
+            'pipeline_time': pipeline_time,
+            'encode_mbps':   mb / encode_time,
+            'reuse_mbps':    mb / reuse_time,
+            'reused':        reuse_writer.bytes_reused,
+            'splice_mbps':   mb / splice_time,
+            'copied':        writer.bytes_copied,
+            'encoded':       writer.bytes_encoded,
+            'copies':        writer.num_copies,
+            'writes':        writer.num_writes,
+        }
+    finally:
+        os.unlink(path)
+
+def bench_sibling_logs(num_events, num_procs=8, num_siblings=3):
+    """ Writes the logs of num_siblings mutations of a lazy session, one
+        traversal each and then all in a single traversal.
+    """
+    from mreplay.log_writer import write_log, write_sibling_logs
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        session = LazySession(buf)
+        proc = session.init_proc
+        step = len(proc.syscalls) / (num_siblings + 1)
+        def pipelines():
+            for i in xrange(num_siblings):
+                victim = proc.syscalls[(i + 1) * step]
+                m  = mutator.EditPlan(session, [mutator.DeleteEvent([victim])])
+                m |= mutator.AdjustResources(single_pass=True)
+                m |= mutator.InsertPidEvents()
+                yield m
+
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            for m in pipelines():
+                write_log(devnull, session | m)
+            separate_time = time.time() - start
+
+            start = time.time()
+            write_sibling_logs(session, [(devnull, m) for m in pipelines()])
+            batch_time = time.time() - start
+
+        mb = num_siblings * len(buf) / float(1 << 20)
+        return {
+            'separate_time': separate_time,
+            'batch_time':    batch_time,
+            'separate_mbps': mb / separate_time,
+            'batch_mbps':    mb / batch_time,
+        }
+    finally:
+        os.unlink(path)
+
+def bench_adjust_resources(num_events, num_procs=8):
+    """ Renumbering the serials of a lazy session missing a syscall, in a
+        single pass and then in two passes. Peak RSS only goes up, so the
+        single pass runs first.
+    """
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        session = LazySession(buf)
+        session.lock_serials()
+        proc = session.init_proc
+        victim = proc.syscalls[len(proc.syscalls) / 2]
+        plan = mutator.EditPlan(session, [mutator.DeleteEvent([victim])])
+
+        result = {'events': len(session.events)}
+        for single_pass in (True, False):
+            name = 'single' if single_pass else 'double'
+            rss_before = peak_rss()
+            start = time.time()
+            events  = session | plan
+            events |= mutator.AdjustResources(single_pass=single_pass)
+            for e in events:
+                pass
+            result[name + '_time'] = time.time() - start
+            result[name + '_rss'] = peak_rss() - rss_before
+        return result
+    finally:
+        os.unlink(path)
+
+def bench_split(num_events, num_procs=8, max_pending=10000):
+    """ Extracting the head of a log on a bookmark that never comes, so that
+        every event waits until the end. Peak RSS only goes up, so the
+        bounded modes run first.
+    """
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        modes = [('buffer', dict(buf=buf)),
+                 ('spill', dict(max_pending=max_pending)),
+                 ('memory', dict())]
+        result = {}
+        for (name, kwargs) in modes:
+            rss_before = peak_rss()
+            start = time.time()
+            events = scribe.EventsFromBuffer(buf)
+            events |= mutator.SplitOnBookmark(cutoff=0, **kwargs)
+            for e in events:
+                pass
+            result[name + '_time'] = time.time() - start
+            result[name + '_rss'] = peak_rss() - rss_before
+        return result
+    finally:
+        os.unlink(path)
+
+class _Candidate:
+    """ What the scheduler looks at in an execution """
+    def __init__(self, seq, score, state):
+        self.seq = seq
+        self.score = score
+        self.state = state
+
+def bench_frontier(sizes=(1000, 10000, 100000), picks=200):
+    """ Cost of a scheduling step of Explorer.run once size executions were
+        added: with a scan of the executions, like it used to be, and with
+        the Frontier and state counters. Each step fails the execution it
+        picks, and adds two children.
+    """
+    from mreplay.explorer import Frontier, ExecutionStates
+    TODO = ExecutionStates.TODO
+    FAILED = ExecutionStates.FAILED
+    SUCCESS = ExecutionStates.SUCCESS
+
+    def candidates(size):
+        rand = random.Random(size)
+        return [_Candidate(seq, rand.randint(0, 1000), (TODO, FAILED)[seq % 2])
+                for seq in xrange(size)]
+
+    def num_state(executions, state):
+        return len(filter(lambda e: e.state == state, executions))
+
+    result = dict()
+    for size in sizes:
+        executions = candidates(size)
+        start = time.time()
+        for i in xrange(picks):
+            for state in (SUCCESS, FAILED, TODO):
+                num_state(executions, state)
+            todos = filter(lambda e: e.state == TODO, executions)
+            execution = max(todos, key=lambda e: e.score)
+            execution.state = FAILED
+            for score in (execution.score - 1, execution.score + 1):
+                executions.append(_Candidate(len(executions), score, TODO))
+        scan = (time.time() - start) / picks
+
+        executions = candidates(size)
+        frontier = Frontier()
+        counts = collections.defaultdict(int)
+        for e in executions:
+            counts[e.state] += 1
+            if e.state == TODO:
+                frontier.push(e)
+        start = time.time()
+        for i in xrange(picks):
+            for state in (SUCCESS, FAILED, TODO):
+                counts[state]
+            execution = frontier.top()
+            execution.state = FAILED
+            counts[TODO] -= 1
+            counts[FAILED] += 1
+            for score in (execution.score - 1, execution.score + 1):
+                e = _Candidate(len(executions), score, TODO)
+                executions.append(e)
+                frontier.push(e)
+                counts[TODO] += 1
+        heap = (time.time() - start) / picks
+        result[size] = {'scan': scan, 'heap': heap}
+    return result
+
+def bench_columns(num_events, num_procs=8):
+    # numpy is only needed for this one
+    from mreplay.columns import EventColumns
+
+    (path, buf) = write_synthetic_log(num_events, num_procs)
+    try:
+        session = LazySession(buf)
+
+        start = time.time()
+        columns = EventColumns(session)
+        build_time = time.time() - start
+
+        start = time.time()
+        counts = dict()
+        for proc in session.processes.values():
+            for e in proc.syscalls:
+                key = (proc.pid, e.nr)
+                counts[key] = counts.get(key, 0) + 1
+        loop_time = time.time() - start
+
+        start = time.time()
+        assert columns.syscall_counts() == counts
+        columns.hottest_resources()
+        columns.rdtsc()
+        query_time = time.time() - start
+        return {
+            'build_time': build_time,
+            'loop_time':  loop_time,
+            'query_time': query_time,
+        }
+    finally:
+        os.unlink(path)
+
+def _mutators(session):
+    """ (name, mutator factory) of each mutator, working on session """
+    proc = session.init_proc
+    victim = proc.syscalls[len(proc.syscalls) / 2]
+    where = Location(victim, 'before')
+    halfway = [Location(p.syscalls[len(p.syscalls) / 2], 'before')
+               for p in session.processes.values() if len(p.syscalls)]
+    replacement = Event(scribe.EventSyscallExtra(nr=victim.nr, ret=0), proc)
+    flags = scribe.SCRIBE_PS_ENABLE_ALL & ~scribe.SCRIBE_PS_STRICT_REPLAY
+    return [
+        ('Nop',             lambda: mutator.Nop()),
+        ('DeleteEvent',     lambda: mutator.DeleteEvent([victim])),
+        ('InsertEvent',     lambda: mutator.InsertEvent(where,
+                                        [Event(scribe.EventNop(), proc)])),
+        ('Replace',         lambda: mutator.Replace({victim: replacement})),
+        ('IgnoreNextSyscall', lambda: mutator.IgnoreNextSyscall(where, 0)),
+        ('SetFlagsInit',    lambda: mutator.SetFlagsInit(session, flags)),
+        ('Bookmark',        lambda: mutator.Bookmark(halfway)),
+        ('TruncateQueue',   lambda: mutator.TruncateQueue(halfway)),
+        ('EditPlan',        lambda: mutator.EditPlan(session,
+                                        [mutator.DeleteEvent([victim])])),
+        ('AdjustResources', lambda: mutator.AdjustResources()),
+        ('AdjustResources.single_pass',
+                            lambda: mutator.AdjustResources(single_pass=True)),
+        ('InsertPidEvents', lambda: mutator.InsertPidEvents()),
+        ('InsertEoqEvents', lambda: mutator.InsertEoqEvents()),
+        ('ToRawEvents',     lambda: mutator.ToRawEvents()),
+    ]
+
+def bench_mutators(num_events, num_procs=8, **params):
+    """ Each mutator alone on a session, Nop being the cost of going
+        through the session. SplitOnBookmark works on raw events.
+    """
+    session = Session(synthetic_events(num_events, num_procs, **params))
+    num_events = len(session.events)
+    result = {'events': num_events}
+    for (name, make_mutator) in _mutators(session):
+        start = time.time()
+        for e in session | make_mutator():
+            pass
+        elapsed = time.time() - start
+        result[name] = {'time': elapsed,
+                        'usec_per_event': elapsed * 1e6 / num_events}
+
+    raw_events = list(session | mutator.ToRawEvents())
+    start = time.time()
+    for e in raw_events | mutator.SplitOnBookmark(cutoff=0):
+        pass
+    elapsed = time.time() - start
+    result['SplitOnBookmark'] = {'time': elapsed,
+                                 'usec_per_event': elapsed * 1e6 / num_events}
+    return result
+
+def bench_load_session(num_events, num_procs=8, jobs=4,
+                       memory_cap=16 << 20, **params):
+    """ Explorer's load_session() in each of its modes. The lazy ones are
+        timed without and then with the sidecar index of the log, and so is
+        the default one, which reuses the index once there is one.
+    """
+    from mreplay.explorer import load_session
+    (path, buf) = write_synthetic_log(num_events, num_procs, **params)
+    modes = [('eager',     dict()),
+             ('lazy',      dict(lazy=True)),
+             ('lazy_indexed', dict(lazy=True)),
+             ('eager_indexed', dict()),
+             ('parallel',  dict(jobs=jobs)),
+             ('streaming', dict(memory_cap=memory_cap))]
+    try:
+        result = {'events': None, 'mb': len(buf) / float(1 << 20)}
+        for (name, kwargs) in modes:
+            if name == 'parallel' and os.path.exists(log_index.index_path(path)):
+                os.unlink(log_index.index_path(path))
+            rss_before = peak_rss()
+            start = time.time()
+            session = load_session(path, **kwargs)
+            elapsed = time.time() - start
+            result['events'] = len(session.events)
+            result[name] = {'time': elapsed,
+                            'events_per_sec': len(session.events) / elapsed,
+                            'rss': peak_rss() - rss_before}
+            if hasattr(session, 'close'):
+                session.close()
+            del session
+        return result
+    finally:
+        os.unlink(path)
+        if os.path.exists(log_index.index_path(path)):
+            os.unlink(log_index.index_path(path))
+
+class _ExplorerDir:
+    """ The explorer writes its logs in the current directory, and talks a
+        lot: it runs in a temporary directory, quietly.
+    """
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix='mreplay-bench-')
+        os.chdir(self.path)
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        logger = logging.getLogger()
+        self.level = logger.level
+        logger.setLevel(logging.WARNING)
+        return self
+
+    def __exit__(self, *args):
+        logging.getLogger().setLevel(self.level)
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+def _new_explorer(logfile_path, **kargs):
+    # The defaults of the mreplay script
+    from mreplay.explorer import Explorer
+    options = dict(on_the_fly=False, var_io=False, num_success_to_stop=1,
+                   isolate=False, linear=True, pattern=None, add_constant=-1,
+                   del_constant=-1, match_constant=3, max_delete=100,
+                   max_otf=10000)
+    options.update(kargs)
+    return Explorer(logfile_path, **options)
+
+def bench_generate_log(num_events, num_procs=8, num_children=4, **params):
+    """ Explorer's log generation for the root execution and num_children
+        children deleting a syscall, with an eager and a lazy session.
+    """
+    from mreplay.explorer import Execution
+    (path, buf) = write_synthetic_log(num_events, num_procs, **params)
+    try:
+        result = {'logs': num_children + 1}
+        for lazy in (False, True):
+            with _ExplorerDir():
+                explorer = _new_explorer(path, lazy=lazy)
+                root = explorer.root
+                explorer.add_execution(None, root)
+                proc = root.session.init_proc
+                step = len(proc.syscalls) / (num_children + 1)
+                executions = [root]
+                for i in xrange(num_children):
+                    victim = proc.syscalls[(i + 1) * step]
+                    child = Execution(root, mutator.DeleteEvent([victim]))
+                    explorer.add_execution(root, child)
+                    executions.append(child)
+
+                start = time.time()
+                for execution in executions:
+                    execution.generate_log()
+                elapsed = time.time() - start
+            mb = explorer.bytes_written / float(1 << 20)
+            result['lazy' if lazy else 'eager'] = {
+                'time':        elapsed,
+                'time_per_log': elapsed / len(executions),
+                'mbps':        mb / elapsed,
+            }
+        return result
+    finally:
+        os.unlink(path)
+        if os.path.exists(log_index.index_path(path)):
+            os.unlink(log_index.index_path(path))
+
+def _diverging(events, num_syscalls, every):
+    """ The events of the target of an exploration: every every-th syscall
+        returns something else, num_syscalls times.
+    """
+    count = 0
+    for e in events:
+        if isinstance(e, scribe.EventSyscallExtra):
+            count += 1
+            if count % every == 0 and count / every <= num_syscalls:
+                e = scribe.EventSyscallExtra(nr=e.nr, ret=e.ret + 1,
+                                             args=e.args)
+        yield e
+
+def bench_explore(num_events, num_procs=8, num_divergences=3,
+                  on_the_fly=False, jobs=1, **params):
+    """ A full exploration against the simulated replay backend: the
+        program, the target, returns something else on num_divergences
+        syscalls of the log.
+    """
+    from mreplay.explorer import ExecutionStates
+    from mreplay.simulate import SimulatedBackend
+    (path, buf) = write_synthetic_log(num_events, num_procs, **params)
+    try:
+        num_syscalls = sum(1 for e in scribe.EventsFromBuffer(buf)
+                           if isinstance(e, scribe.EventSyscallExtra))
+        every = max(1, num_syscalls / (num_divergences + 1))
+        backend = SimulatedBackend(_diverging(
+                synthetic_events(num_events, num_procs, **params),
+                num_divergences, every))
+
+        with _ExplorerDir():
+            rss_before = peak_rss()
+            start = time.time()
+            explorer = _new_explorer(path, on_the_fly=on_the_fly, jobs=jobs,
+                                     context_class=backend)
+            load_time = time.time() - start
+            rss_loaded = peak_rss()
+            start = time.time()
+            explorer.run()
+            run_time = time.time() - start
+            rss_after = peak_rss()
+
+        executions = explorer.executions
+        num_run = len([e for e in executions
+                       if e.state in (ExecutionStates.SUCCESS,
+                                      ExecutionStates.FAILED)])
+        return {
+            'events':            len(explorer.root.session.events),
+            'executions':        len(executions),
+            'replays':           num_run,
+            'success':           explorer.num_state(ExecutionStates.SUCCESS),
+            'load_time':         load_time,
+            'run_time':          run_time,
+            'replays_per_sec':   num_run / run_time,
+            'session_rss':       rss_loaded - rss_before,
+            'rss_per_execution': (rss_after - rss_loaded) / len(executions),
+            'logs_written':      explorer.logs_written,
+            'mb_written':        explorer.bytes_written / float(1 << 20),
+        }
+    finally:
+        os.unlink(path)
+        if os.path.exists(log_index.index_path(path)):
+            os.unlink(log_index.index_path(path))
+
+def main():
+    usage = 'usage: %prog [options]'
+    desc = 'Measure the cost of sessions and mutators'
+    parser = OptionParser(usage=usage, description=desc)
+    parser.add_option("-b", "--bench",
+            dest="bench", default="all",
+            help="Benchmark to run: memory, pipeline, load, streaming, "
+                 "columns, writer, siblings, chain, adjust, sharded, split, "
+                 "frontier, session, mutators, generate, explore or all")
+    parser.add_option("-n", "--num-events",
+            type="int", dest="num_events", default=1000000,
+            help="Number of events of the synthetic session")
+    parser.add_option("-p", "--num-procs",
+            type="int", dest="num_procs", default=8,
+            help="Number of processes of the synthetic session")
+    parser.add_option("-d", "--depth",
+            type="int", dest="depth", default=200,
+            help="Length of the mutation chain")
+    parser.add_option("-j", "--jobs",
+            type="int", dest="jobs", default=4,
+            help="Number of processes for the parallel load and mutators")
+    parser.add_option("-M", "--memory-cap",
+            type="int", dest="memory_cap", default=16, metavar="MB",
+            help="Memory cap of the streaming session")
+    parser.add_option("-m", "--syscall-mix",
+            dest="syscall_mix", default=None, metavar="NAME:WEIGHT,...",
+            help="Syscalls of the synthetic session, e.g. read:4,write:2,open:1")
+    parser.add_option("-r", "--resources",
+            type="int", dest="num_resources", default=1,
+            help="Number of resources the syscalls contend for")
+    parser.add_option("-s", "--data-size",
+            type="int", dest="data_size", default=5,
+            help="Bytes of data of the reads and writes")
+    parser.add_option("-S", "--seed",
+            type="int", dest="seed", default=0,
+            help="Seed of the synthetic session")
+    parser.add_option("-x", "--divergences",
+            type="int", dest="num_divergences", default=3,
+            help="Number of syscalls the explored log gets wrong")
+    parser.add_option("-f", "--on-the-fly",
+            action="store_true", dest="on_the_fly", default=False,
+            help="Explore with the on the fly optimization")
+    parser.add_option("-J", "--json",
+            action="store_true", dest="json", default=False,
+            help="Print the results as JSON")
+    (options, args) = parser.parse_args()
+
+    syscall_mix = None
+    if options.syscall_mix is not None:
+        try:
+            syscall_mix = []
+            for item in options.syscall_mix.split(','):
+                (name, weight) = item.split(':')
+                syscall_mix.append((getattr(unistd, 'NR_' + name), int(weight)))
+        except (ValueError, AttributeError):
+            parser.error('bad syscall mix: %s' % options.syscall_mix)
+    params = dict(syscall_mix=syscall_mix,
+                  num_resources=options.num_resources,
+                  data_size=options.data_size, seed=options.seed)
+
+    # With --json, the results are kept instead of printed
+    results = collections.OrderedDict()
+    stdout = sys.stdout
+    if options.json:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        run_benchmarks(options, params, results)
+    finally:
+        if options.json:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    if options.json:
+        options = dict(vars(options), syscall_mix=syscall_mix)
+        json.dump({'options': options, 'results': results}, sys.stdout,
+                  indent=2, sort_keys=True)
+        print("")
+
+def run_benchmarks(options, params, results):
+    if options.bench in ('memory', 'all'):
+        result = bench_event_memory(options.num_events, options.num_procs)
+        results['memory'] = result
+        print("events:          %d" % result['events'])
+        print("load time:       %.2fs" % result['load_time'])
+        print("bytes/event:     %.1f (wrappers and lists)" % result['bytes_per_event'])
+        print("max rss/event:   %.1f" % result['rss_per_event'])
+
+    if options.bench in ('pipeline', 'all'):
+        result = bench_mutator_pipeline(options.num_events, options.num_procs)
+        results['pipeline'] = result
+        print("pipeline:        %.2fs" % result['time'])
+        print("usec/event:      %.2f" % result['usec_per_event'])
+
+    if options.bench in ('sharded', 'all'):
+        result = bench_sharded_pipeline(options.num_events, options.num_procs,
+                                        options.jobs)
+        results['sharded'] = result
+        print("serial mutators: %.2fs" % result['serial'])
+        print("sharded (%d jobs): %.2fs" % (options.jobs, result['sharded']))
+
+    if options.bench in ('load', 'all'):
+        result = bench_load(options.num_events, options.num_procs,
+                            options.jobs)
+        results['load'] = result
+        print("header scan:     %.2fs" % result['scan'])
+        print("index (1 job):   %.2fs" % result['sequential'])
+        for (n, elapsed) in sorted(result['parallel'].items()):
+            print("index (%d jobs):  %.2fs (x%.2f)" %
+                  (n, elapsed, result['sequential'] / elapsed))
+
+    if options.bench in ('columns', 'all'):
+        result = bench_columns(options.num_events, options.num_procs)
+        results['columns'] = result
+        print("columns build:   %.2fs" % result['build_time'])
+        print("syscall counts:  %.3fs with events, %.3fs for 3 column queries" %
+              (result['loop_time'], result['query_time']))
+
+    if options.bench in ('chain', 'all'):
+        result = bench_mutation_chain(options.num_events, options.num_procs,
+                                      options.depth)
+        results['chain'] = result
+        if result['nested_time'] is None:
+            print("nested chain:    recursion limit exceeded")
+        else:
+            print("nested chain:    %.2fs" % result['nested_time'])
+        print("edit plan:       %.3fs compile, %.2fs apply" %
+              (result['compile_time'], result['apply_time']))
+
+    if options.bench in ('siblings', 'all'):
+        result = bench_sibling_logs(options.num_events, options.num_procs)
+        results['siblings'] = result
+        print("3 sibling logs:  %.2fs separately (%.1f MB/s), "
+              "%.2fs in one pass (%.1f MB/s)" %
+              (result['separate_time'], result['separate_mbps'],
+               result['batch_time'], result['batch_mbps']))
+
+    if options.bench in ('adjust', 'all'):
+        result = bench_adjust_resources(options.num_events, options.num_procs)
+        results['adjust'] = result
+        print("adjust, 1 pass:  %.2fs, peak rss +%d MB" %
+              (result['single_time'], result['single_rss'] >> 20))
+        print("adjust, 2 pass:  %.2fs, peak rss +%d MB" %
+              (result['double_time'], result['double_rss'] >> 20))
+
+    if options.bench in ('split', 'all'):
+        result = bench_split(options.num_events, options.num_procs)
+        results['split'] = result
+        for name in ('buffer', 'spill', 'memory'):
+            print("split, %-7s   %.2fs, peak rss +%d MB" %
+                  (name + ':', result[name + '_time'],
+                   result[name + '_rss'] >> 20))
+
+    if options.bench in ('frontier', 'all'):
+        result = bench_frontier()
+        results['frontier'] = result
+        for size in sorted(result):
+            print("pick (%6d):    %.1f usec scanning, %.1f usec with the "
+                  "frontier" % (size, result[size]['scan'] * 1e6,
+                                result[size]['heap'] * 1e6))
+
+    if options.bench in ('writer', 'all'):
+        result = bench_log_writer(options.num_events, options.num_procs)
+        results['writer'] = result
+        print("eager load:      %.2fs, peak rss +%d MB" %
+              (result['load_time'], result['load_rss'] >> 20))
+        print("mutators:        %.2fs" % result['pipeline_time'])
+        print("encode writer:   %.1f MB/s" % result['encode_mbps'])
+        print("reuse writer:    %.1f MB/s (%d KB reused)" %
+              (result['reuse_mbps'], result['reused'] >> 10))
+        print("splice writer:   %.1f MB/s (%d KB copied in %d ranges, "
+              "%d KB encoded, %d writelines)" %
+              (result['splice_mbps'], result['copied'] >> 10,
+               result['copies'], result['encoded'] >> 10, result['writes']))
+
+    if options.bench in ('streaming', 'all'):
+        result = bench_streaming(options.num_events, options.num_procs,
+                                 options.memory_cap << 20)
+        results['streaming'] = result
+        print("streaming load:  %.2fs" % result['load_time'])
+        print("streaming walk:  %.2fs" % result['walk_time'])
+        print("index resident:  %d KB (peak %d KB)" %
+              (result['resident_bytes'] >> 10,
+               result['peak_resident_bytes'] >> 10))
+        print("spills/loads:    %d/%d" % (result['spills'], result['loads']))
+        print("peak rss:        %d MB" % (result['peak_rss'] >> 20))
+
+    if options.bench in ('session', 'all'):
+        result = bench_load_session(options.num_events, options.num_procs,
+                                    options.jobs, options.memory_cap << 20,
+                                    **params)
+        results['session'] = result
+        for name in ('eager', 'lazy', 'lazy_indexed', 'eager_indexed',
+                     'parallel', 'streaming'):
+            print("load %-15s %.2fs, %d events/s, peak rss +%d MB" %
+                  (name + ':', result[name]['time'],
+                   result[name]['events_per_sec'], result[name]['rss'] >> 20))
+
+    if options.bench in ('mutators', 'all'):
+        result = bench_mutators(options.num_events, options.num_procs,
+                                **params)
+        results['mutators'] = result
+        for name in sorted(result):
+            if name != 'events':
+                print("%-28s %.2fs, %.2f usec/event" %
+                      (name + ':', result[name]['time'],
+                       result[name]['usec_per_event']))
+
+    if options.bench in ('generate', 'all'):
+        result = bench_generate_log(options.num_events, options.num_procs,
+                                    **params)
+        results['generate'] = result
+        for name in ('eager', 'lazy'):
+            print("generate, %-6s %.2fs per log, %.1f MB/s" %
+                  (name + ':', result[name]['time_per_log'],
+                   result[name]['mbps']))
+
+    if options.bench in ('explore', 'all'):
+        result = bench_explore(options.num_events, options.num_procs,
+                               options.num_divergences, options.on_the_fly,
+                               options.jobs, **params)
+        results['explore'] = result
+        print("explore:         %d replays of %d executions in %.2fs "
+              "(%.1f replays/s), %d success" %
+              (result['replays'], result['executions'], result['run_time'],
+               result['replays_per_sec'], result['success']))
+        print("explore memory:  %d MB for the session, %d KB per execution" %
+              (result['session_rss'] >> 20, result['rss_per_execution'] >> 10))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import scribe
+import numpy
+from array import array
+from session import LazySession
+
+EVENT_DTYPE = numpy.dtype([
+    ('pid',      numpy.int32),  # -1 when the event has no process
+    ('type',     numpy.uint16), # scribe native type
+    ('nr',       numpy.int32),  # syscalls only
+    ('ret',      numpy.int64),  # syscalls only
+    ('resource', numpy.int64),  # resource locks and unlocks only
+    ('serial',   numpy.int64),  # resource locks/unlocks and memory ownership
+    ('offset',   numpy.int64),  # in the log buffer
+])
+
+SYSCALL = scribe.EventSyscallExtra.native_type
+RESOURCE_LOCK = scribe.EventResourceLockExtra.native_type
+RESOURCE_UNLOCK = scribe.EventResourceUnlock.native_type
+MEM_OWNED = (scribe.EventMemOwnedReadExtra.native_type,
+             scribe.EventMemOwnedWriteExtra.native_type)
+
+def _column(a):
+    if isinstance(a, array):
+        return numpy.frombuffer(a, dtype=numpy.dtype(a.typecode))
+    return numpy.fromiter(iter(a), dtype=numpy.dtype(a.typecode), count=len(a))
+
+def _new_columns(num_events):
+    columns = numpy.empty(num_events, dtype=EVENT_DTYPE)
+    for name in EVENT_DTYPE.names:
+        columns[name] = -1
+    return columns
+
+def _lazy_columns(session):
+    # The log index already has the pids, types and offsets. Only the
+    # syscalls, locks and memory events get decoded.
+    index = session.log_index
+    columns = _new_columns(len(index))
+    columns['pid'] = _column(index.pids)
+    columns['type'] = _column(index.types)
+    columns['offset'] = _column(index.offsets)
+
+    types = columns['type']
+    for o in numpy.flatnonzero(types == SYSCALL):
+        e = session.events[o]
+        columns['nr'][o] = e.nr
+        columns['ret'][o] = e.ret
+    for o in numpy.flatnonzero(types == RESOURCE_LOCK):
+        e = session.events[o]
+        columns['resource'][o] = e.id
+        columns['serial'][o] = e.serial
+    for o in numpy.flatnonzero(numpy.in1d(types, MEM_OWNED)):
+        columns['serial'][o] = session.events[o].serial
+    return columns
+
+def _eager_columns(session):
+    columns = _new_columns(len(session.events))
+    pids = []
+    types = []
+    offsets = []
+    offset = 0
+    for (o, e) in enumerate(session.events):
+        pids.append(e.proc.pid if e.proc is not None else -1)
+        types.append(e.native_type)
+        offsets.append(offset)
+        offset += len(e.encode())
+        if e.is_a(scribe.EventSyscallExtra):
+            columns['nr'][o] = e.nr
+            columns['ret'][o] = e.ret
+        elif e.is_a(scribe.EventResourceLockExtra):
+            columns['resource'][o] = e.id
+            columns['serial'][o] = e.serial
+        elif e.is_a(scribe.EventMemOwnedReadExtra) or \
+             e.is_a(scribe.EventMemOwnedWriteExtra):
+            columns['serial'][o] = e.serial
+    columns['pid'] = pids
+    columns['type'] = types
+    columns['offset'] = offsets
+    return columns
+
+def _pair_unlocks(columns):
+    # Same rule as Session._index_resources(): locks are nested, an unlock
+    # goes with the last open lock of its process.
+    types = columns['type']
+    open_locks = dict()
+    for o in numpy.flatnonzero((types == RESOURCE_LOCK) |
+                               (types == RESOURCE_UNLOCK)):
+        locks = open_locks.setdefault(columns['pid'][o], [])
+        if types[o] == RESOURCE_LOCK:
+            locks.append(o)
+        elif locks:
+            lock = locks.pop()
+            columns['resource'][o] = columns['resource'][lock]
+            columns['serial'][o] = columns['serial'][lock]
+
+class EventColumns:
+    """ Columnar view of a session: one row per event of session.events,
+        see EVENT_DTYPE. Fields that don't apply to an event are -1.
+        Unlocks get the resource id and serial of their lock.
+    """
+    def __init__(self, session):
+        if isinstance(session, LazySession):
+            self.events = _lazy_columns(session)
+        else:
+            self.events = _eager_columns(session)
+        _pair_unlocks(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def select(self, type=None, pid=None, nr=None):
+        """ Returns the event ordinals matching all the given criteria.
+            type is a scribe event class.
+        """
+        mask = numpy.ones(len(self.events), dtype=bool)
+        if type is not None:
+            mask &= self.events['type'] == type.native_type
+        if pid is not None:
+            mask &= self.events['pid'] == pid
+        if nr is not None:
+            mask &= self.events['nr'] == nr
+        return numpy.flatnonzero(mask)
+
+    def syscall_counts(self):
+        """ Returns {(pid, nr): number of syscalls} """
+        syscalls = self.events[self.events['type'] == SYSCALL]
+        keys = numpy.empty(len(syscalls),
+                           dtype=[('pid', numpy.int32), ('nr', numpy.int32)])
+        keys['pid'] = syscalls['pid']
+        keys['nr'] = syscalls['nr']
+        (uniques, counts) = numpy.unique(keys, return_counts=True)
+        return dict(((int(pid), int(nr)), int(count))
+                    for ((pid, nr), count) in zip(uniques, counts))
+
+    def rdtsc(self, pid=None):
+        """ Returns the ordinals of the RDTSC events """
+        return self.select(scribe.EventRdtsc, pid)
+
+    def hottest_resources(self, n=10):
+        """ Returns [(resource id, number of locks)] for the n most
+            locked resources.
+        """
+        ids = self.events['resource'][self.events['type'] == RESOURCE_LOCK]
+        (uniques, counts) = numpy.unique(ids, return_counts=True)
+        order = numpy.argsort(-counts, kind='mergesort')[:n]
+        return [(int(uniques[i]), int(counts[i])) for i in order]
@@ -1,5 +1,7 @@
 import itertools
+import bisect
 from location import Location
+from mreplay import session
 from mreplay.session import Event
 import scribe
 import struct
@@ -15,11 +17,10 @@ def head(seq, n=1):
 
 
 def is_data(event):
-    return event.is_a(scribe.EventDataExtra) or \
-           event.is_a(scribe.EventData)
+    return event.tag in session.TAGS_DATA
 
 def is_data_extra(event):
-    return event.is_a(scribe.EventDataExtra)
+    return event.tag == session.TAG_DATA_EXTRA
 
 def is_string_data(event):
     if not is_data_extra(event):
@@ -50,7 +51,8 @@ class DivergeHandler:
         self.pid = self.diverge_event.pid
         self.execution.update_progress(self.pid, num)
         self.execution.state = ExecutionStates.FAILED
-        self.proc = self.execution.running_session.processes[self.pid]
+        self.session = self.execution.running_session
+        self.proc = self.session.processes[self.pid]
         self.culprit = self.proc.events[num]
         self.mutations = map(lambda e: Event(e, self.proc), self.mutations)
 
@@ -158,15 +160,13 @@ class DivergeHandler:
             self.delete_event([self.culprit])
             self.status = "deleting internal event"
         elif self.diverge_event.type == scribe.EventResourceLockExtra.native_type:
-            def is_resource_orphan(e):
-                if not e.is_a(scribe.EventResourceLockExtra):
-                    return False
-                if e.has_syscall():
-                    return False
-                return True
-            events = list(itertools.takewhile(
-                    lambda e: not is_resource_orphan(e),
-                    head(self.proc.events.after(self.culprit), self.explorer.max_delete)))
+            start = self.culprit.index + 1
+            end = start + self.explorer.max_delete
+            orphans = self.session.resource_orphans(self.pid)
+            i = bisect.bisect_left(orphans, start)
+            if i < len(orphans):
+                end = min(end, orphans[i])
+            events = self.proc.events[start:end]
             events.insert(0, self.culprit)
             self.delete_event(events)
             self.status = "deleting until next out-of-syscall resource (signal ?)"
@@ -187,7 +187,7 @@ class DivergeHandler:
         # syscall event before the signals...
         if self.syscall is not None:
             try:
-                first_signal = itertools.takewhile(lambda e: e.is_a(scribe.EventSignal),
+                first_signal = itertools.takewhile(lambda e: e.tag == session.TAG_SIGNAL,
                                             self.syscall.proc.events.before(self.syscall)).next()
                 add_location = Location(first_signal, 'before')
             except StopIteration:
@@ -249,22 +249,15 @@ class DivergeHandler:
         self.delete_event(self.take_until_match(start, end))
         self.status = "unhandled case: %s" % self.diverge_event.__class__
 
-    def handle(self):
-        if isinstance(self.diverge_event, scribe.EventDivergeMemOwned):
-            self.handle_mem_owned()
-        elif isinstance(self.diverge_event, scribe.EventDivergeEventType) and \
-                self.diverge_event.type == scribe.EventRdtsc.native_type:
+    def handle_event_type(self):
+        if self.diverge_event.type == scribe.EventRdtsc.native_type:
             self.handle_rdtsc()
-        elif isinstance(self.diverge_event, scribe.EventDivergeEventType):
-            self.handle_type()
-        elif isinstance(self.diverge_event, scribe.EventDivergeSyscall):
-            self.handle_syscall()
-        elif isinstance(self.diverge_event, scribe.EventDivergeSyscallRet):
-            self.handle_syscall_ret()
-        elif isinstance(self.diverge_event, scribe.EventDivergeDataContent):
-            self.handle_data_content()
         else:
-            self.handle_default()
+            self.handle_type()
+
+    def handle(self):
+        handler = _diverge_handler(self.diverge_event.__class__)
+        handler(self)
 
         self.execution.info("%s %s" % (self.get_diverge_str(), self.status))
 
@@ -272,8 +265,8 @@ class DivergeHandler:
         events = []
 
         def is_memory(e):
-            return e is not None and isinstance(e, Event) and (e.is_a(scribe.EventMemOwnedWriteExtra) or
-                   e.is_a(scribe.EventMemOwnedReadExtra))
+            return e is not None and isinstance(e, Event) and \
+                   e.tag in session.TAGS_MEM_OWNED
 
         if is_memory(start) and is_memory(end) and not start.has_syscall():
             events = list(itertools.takewhile(
@@ -285,17 +278,33 @@ class DivergeHandler:
 
         if end is not None and start.has_syscall():
             if end.nr in unistd.SYS_exit:
-                return [start] + list(start.proc.events.after(start.syscall))[:-1]
-            events = list(itertools.takewhile(
-                    lambda e: not self.sys_match(e, end),
-                    head(start.proc.syscalls.after(start.syscall),
-                        self.explorer.max_delete)))
-            if len(events) > 0 and not self.sys_match(events[-1].next_syscall(), end):
+                return [start] + start.proc.events[start.syscall.index + 1:-1]
+            events = self.take_syscalls_until_match(start, end)
+            if events is None:
                 return None
 
         events.insert(0, start)
         return events
 
+    def take_syscalls_until_match(self, start, end):
+        # The syscalls following start.syscall, up to the first one that
+        # matches end. The match is looked up among the syscalls with the
+        # same number, and can be at most max_delete+1 syscalls away.
+        syscalls = start.proc.syscalls
+        base = start.syscall.syscall_index
+        num = min(self.explorer.max_delete, len(syscalls) - base - 1)
+        if num <= 0:
+            return []
+
+        positions = self.session.syscall_positions(end.nr).get(start.proc.pid, [])
+        for i in xrange(bisect.bisect_right(positions, base), len(positions)):
+            position = positions[i]
+            if position > base + num + 1:
+                break
+            if self.sys_match(syscalls[position], end):
+                return syscalls[base + 1:position]
+        return None
+
     def mem_match(self, m1, m2):
         if m1 is None or m2 is None:
             return False
@@ -344,3 +353,26 @@ class DivergeHandler:
             except StopIteration:
                 return False
         return True
+
+_DIVERGE_HANDLERS = {
+    scribe.EventDivergeMemOwned:    DivergeHandler.handle_mem_owned,
+    scribe.EventDivergeEventType:   DivergeHandler.handle_event_type,
+    scribe.EventDivergeSyscall:     DivergeHandler.handle_syscall,
+    scribe.EventDivergeSyscallRet:  DivergeHandler.handle_syscall_ret,
+    scribe.EventDivergeDataContent: DivergeHandler.handle_data_content,
+}
+
+_diverge_handlers_cache = dict()
+
+def _diverge_handler(klass):
+    try:
+        return _diverge_handlers_cache[klass]
+    except KeyError:
+        pass
+    handler = DivergeHandler.handle_default
+    for base in klass.__mro__:
+        if base in _DIVERGE_HANDLERS:
+            handler = _DIVERGE_HANDLERS[base]
+            break
+    _diverge_handlers_cache[klass] = handler
+    return handler
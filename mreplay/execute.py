@@ -2,6 +2,7 @@ import os
 import tempfile
 import subprocess
 import errno
+import time
 
 def _popen(cmd, stdin=None, stdout=None, stderr=None, notty=False):
     if notty:
@@ -153,6 +154,11 @@ class ExecuteJail(Execute):
         # mark our scratch area as jailed ..
         sudo(['touch', os.path.join(self.scratch, '.JAILED')])
 
+        self._mount()
+        self.mounted = True
+        self.dirty = False
+
+    def _mount(self):
         mount_dirs = '%s=rw:%s=ro' % \
             (os.path.abspath(self.scratch), os.path.abspath(self.root))
         mount_point = os.path.abspath(self.chroot)
@@ -165,16 +171,60 @@ class ExecuteJail(Execute):
         if self.persist:
             self.bind(self.persist)
 
-        self.mounted = True
-
-    def close(self):
-        assert(self.mounted)
-
+    def _unmount(self):
         for d in list(self._binded_dirs):
             self.unbind(d)
 
         sudo('fusermount -z -u'.split() + [self.chroot])
 
+    def processes(self):
+        """ Returns the pids of the processes running in the jail """
+        chroot = os.path.realpath(self.chroot)
+        pids = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                if os.readlink('/proc/%s/root' % pid) == chroot:
+                    pids.append(int(pid))
+            except OSError:
+                # gone, or not ours to look at
+                pass
+        return pids
+
+    def kill(self, timeout=5):
+        """ Kills the processes left in the jail, and waits for them to
+            go away.
+        """
+        deadline = time.time() + timeout
+        pids = self.processes()
+        while pids:
+            cmd = ['kill', '-KILL'] + map(str, pids)
+            ret = sudo(cmd)
+            if time.time() > deadline:
+                raise ExecuteError(' '.join(cmd), ret)
+            time.sleep(0.01)
+            pids = self.processes()
+
+    def reset(self):
+        """ Brings an open jail back to how open() left it: the processes
+            left by the previous execution are killed, and the scratch layer
+            is cleared while unmounted, so that unionfs has nothing cached
+            about it. The scratch and chroot directories are kept.
+        """
+        assert(self.mounted)
+        self.kill()
+        self._unmount()
+        sudo(['find', self.scratch, '-mindepth', '1', '-maxdepth', '1',
+              '!', '-name', '.JAILED', '-exec', 'rm', '-rf', '{}', '+'])
+        self._mount()
+        self.dirty = False
+
+    def close(self):
+        assert(self.mounted)
+
+        self._unmount()
+
         for d in self._rmdirs:
             sudo(['rm', '-rf', d])
 
@@ -197,13 +247,63 @@ class ExecuteJail(Execute):
         self._rmdirs = list()
         self._binded_dirs = list()
         self.mounted = False
+        self.dirty = False # an execution ran since open() or reset()
+
+#############################################################################
+
+class JailPool:
+    """ size jails, mounted once for all the executions. An execution
+        reuses a jail with open(jail=...), which resets it instead of
+        mounting a new one. Only one execution at a time in a jail.
+    """
+    def __init__(self, size, **kwargs):
+        self.jails = [ExecuteJail(**kwargs) for i in range(size)]
+
+    def open(self):
+        # A jail failing to mount must not leak the ones already mounted
+        try:
+            for jail in self.jails:
+                jail.open()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        for jail in self.jails:
+            if jail.mounted:
+                jail.close()
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+class ReusedJail:
+    """ A jail of a JailPool in a with statement: reset on enter when an
+        execution already ran in it, left mounted on exit.
+    """
+    def __exit__(self, type, value, tb):
+        pass
+
+    def __enter__(self):
+        if self.jail.dirty:
+            self.jail.reset()
+        self.jail.dirty = True
+        return self.jail
+
+    def __init__(self, jail):
+        self.jail = jail
 
 #############################################################################
 
 def is_jailed():
     return os.path.exists("/.JAILED")
 
-def open(jailed=False, chroot='', **kwargs):
+def open(jailed=False, chroot='', jail=None, **kwargs):
+    if jail is not None:
+        return ReusedJail(jail)
     if not jailed:
         return Execute(chroot)
     else:
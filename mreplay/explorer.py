@@ -5,23 +5,43 @@ import shutil
 import os
 import logging
 import signal
-import errno
 import subprocess
 import unistd
 import execute
-from session import Session, Event
-import datetime
+import log_index
+import session
+from session import Session, LazySession, Event, events_from_buffer
+from streaming import StreamingSession, peak_rss
+from log_writer import write_log, write_sibling_logs
+from replay import ScribeReplay, ReplayWorkers, ReplayOutcomes
+import collections
+import heapq
 import math
+import time
 
 MREPLAY_DIR = ".mreplay"
 
 def is_verbose():
     return logging.getLogger().getEffectiveLevel() == logging.DEBUG
 
-def load_session(logfile_path):
+def load_session(logfile_path, lazy=False, memory_cap=None, jobs=1):
+    """ jobs > 1 indexes the log with a pool of processes, which implies a
+        lazy session: the events themselves cannot be shared between
+        processes. Otherwise, a valid sidecar index of the log also gives a
+        lazy session, rather than decoding the whole log.
+    """
     with open(logfile_path, 'r') as logfile:
         logfile_map = mmap.mmap(logfile.fileno(), 0, prot=mmap.PROT_READ)
-        return Session(scribe.EventsFromBuffer(logfile_map))
+        if memory_cap is not None:
+            return StreamingSession(logfile_map, memory_cap=memory_cap)
+        if lazy or jobs > 1:
+            return LazySession(logfile_map,
+                               log_index.open_index(logfile_path, logfile_map,
+                                                    jobs))
+        index = log_index.load_index(logfile_path)
+        if index is not None:
+            return LazySession(logfile_map, index)
+        return Session(events_from_buffer(logfile_map))
 
 class ExecutionStates:
     TODO = 0
@@ -29,12 +49,48 @@ class ExecutionStates:
     FAILED = 2
     RUNNING = 3
 
-class Execution:
+class Frontier:
+    """ The executions left to run, best score first. Among equal scores,
+        the execution added first wins, like max() over the executions.
+        Executions are not taken out when they leave the TODO state or
+        when their score changes (they are pushed again then): their
+        stale entries are dropped when they come on top.
+    """
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, execution):
+        heapq.heappush(self.heap, (-execution.score, execution.seq, execution))
+
+    def pop(self):
+        """ Same as top(), but the execution is taken out """
+        execution = self.top()
+        if execution is not None:
+            heapq.heappop(self.heap)
+        return execution
+
+    def top(self):
+        """ Returns the best execution left to run, or None """
+        heap = self.heap
+        while heap:
+            (score, seq, execution) = heap[0]
+            if execution.state != ExecutionStates.TODO or \
+               -score != execution.score:
+                heapq.heappop(heap)
+            else:
+                return execution
+        return None
+
+class Execution(object):
     def __init__(self, parent, mutation, state=ExecutionStates.TODO,
                  running_session=None, mutation_index=0, fly_offset_delta=0, mutation_pid=0):
 
         self.explorer = parent.explorer
         self.parent = parent
+        self.seq = None # order in explorer.executions, once added
         self.score = parent.score
         self.depth = parent.depth + 1
 
@@ -44,12 +100,23 @@ class Execution:
             self.depth_otf = parent.depth_otf + 1
 
         self.mutation = mutation
+        # The session the events of the mutation come from
+        if isinstance(parent, Execution):
+            self.frame = parent.running_session
+        else:
+            self.frame = parent.mutated_session
         self.children = []
-        self.state = state
+        self._state = state
         self._session = None
         self._running_session = running_session
         self.name = None
 
+        self._has_log = False
+        self.evicted = False
+        self.generate_time = 0
+        self.last_used = 0
+        self.num_todo = 0 # executions in TODO, this one and its descendants
+
         self.fly_offsets = dict(parent.fly_offsets)
         self.fly_offsets[mutation_pid] = self.fly_offsets.get(mutation_pid, 0) + fly_offset_delta
 
@@ -69,12 +136,12 @@ class Execution:
 
         def penalize_sacred_events(events):
             for e in events:
-                if e.is_a(scribe.EventSetFlags) or e.is_a(scribe.EventNop):
+                if e.tag == session.TAG_SET_FLAGS or e.tag == session.TAG_NOP:
                     if len(e.extra) > 0:
                         e = Event(scribe.Event.from_bytes(e.extra), e.proc)
 
                 syscall = None
-                if e.is_a(scribe.EventSyscallExtra):
+                if e.tag == session.TAG_SYSCALL:
                     syscall = e
                 elif e.has_syscall():
                     syscall = e.syscall
@@ -104,7 +171,16 @@ class Execution:
 
     def __str__(self):
         if self.name is None:
-            self.name = "%s_%s" % (self.parent, self.mutation)
+            # Not recursive, the tree can be deeper than the stack
+            pending = []
+            execution = self
+            while execution.name is None and \
+                  not isinstance(execution, RootExecution):
+                pending.append(execution)
+                execution = execution.parent
+            name = str(execution)
+            for execution in reversed(pending):
+                name = execution.name = "%s_%s" % (name, execution.mutation)
         return self.name
 
     def __eq__(self, other):
@@ -116,28 +192,110 @@ class Execution:
         a = map(lambda s: ''.join(sorted(s)), self.signature())
         return hash(','.join(a))
 
+    @property
+    def score(self):
+        return self._score
+
+    @score.setter
+    def score(self, score):
+        self._score = score
+        if self.seq is not None and self.state == ExecutionStates.TODO:
+            self.explorer.frontier.push(self)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        old_state = self._state
+        self._state = state
+        if self.seq is not None:
+            self.explorer.state_changed(self, old_state, state)
+
+    @property
+    def has_log(self):
+        return self._has_log
+
+    @has_log.setter
+    def has_log(self, has_log):
+        self._has_log = has_log
+        self.explorer.log_changed(self)
+
     @property
     def logfile_path(self):
         return MREPLAY_DIR + "/" + str(self.id)
 
     def generate_log(self):
+        explorer = self.explorer
         if os.path.exists(self.logfile_path):
+            explorer.regen_time_saved += self.generate_time
             return
 
-        events  = self.mutated_session
-        events |= mutator.AdjustResources()
-        events |= mutator.InsertPidEvents()
-        events |= mutator.ToRawEvents()
-
+        start = time.time()
+        (session, m) = self.log_pipeline()
+        events = session | m
+        stats = None
+        if explorer.instrument:
+            (events, stats) = mutator.instrument(events)
         with open(self.logfile_path, 'w') as logfile:
-            for event in events:
-                logfile.write(event.encode())
+            write_log(logfile, events)
+        self.log_written(time.time() - start)
+        if stats is not None:
+            self.record_stage_stats(stats)
+
+    def record_stage_stats(self, stats):
+        """ Dumps the StageStats of the log generation, and adds them to
+            the run-wide ones. What is left of the generation time is the
+            log writer's.
+        """
+        writer = mutator.StageStats('LogWriter')
+        writer.events_in = writer.events_out = stats[-1].events_out
+        writer.self_time = max(0.0, self.generate_time -
+                                    sum(s.self_time for s in stats))
+        stats = stats + [writer]
+
+        self.info("Log generation:")
+        for line in mutator.format_stats(stats):
+            self.info(line)
+        self.explorer.add_stage_stats(stats)
+
+    def log_written(self, generate_time):
+        explorer = self.explorer
+        self.generate_time = generate_time
+        self.has_log = True
+        explorer.logs_written += 1
+        explorer.bytes_written += os.path.getsize(self.logfile_path)
+        if self.evicted:
+            explorer.regen_time += self.generate_time
+
+    def log_pipeline(self):
+        """ Returns (session, m): the log of the execution is session | m.
+            Executions with the same session can be generated together, see
+            Explorer.pregenerate_logs().
+        """
+        if self._session is not None:
+            session = self._session
+            m = mutator.AdjustResources(single_pass=True)
+        else:
+            (base, mutations) = self.mutation_chain()
+            self.explorer.touch(base)
+            session = base.mutated_session
+            m  = mutator.EditPlan(session, mutations)
+            m |= mutator.AdjustResources(single_pass=True)
+        m |= mutator.InsertPidEvents()
+        if self.explorer.mutate_jobs > 1:
+            m = mutator.shard(m, self.explorer.mutate_jobs)
+        return (session, m)
 
     @property
     def session(self):
         if self._session is None:
             self.generate_log()
-            self._session = load_session(self.logfile_path)
+            self._session = load_session(self.logfile_path,
+                                         lazy=self.explorer.lazy,
+                                         memory_cap=self.explorer.memory_cap,
+                                         jobs=self.explorer.load_jobs)
         return self._session
 
     @property
@@ -151,7 +309,38 @@ class Execution:
         if self._session is not None:
             return self._session
 
-        return self.parent.mutated_session | self.mutation
+        (base, mutations) = self.mutation_chain()
+        self.explorer.touch(base)
+        session = base.mutated_session
+        return session | mutator.EditPlan(session, mutations)
+
+    def mutation_chain(self, use_own_session=True):
+        """ Returns the closest execution this one can be built from, and
+            the mutations going from it to this one, oldest first.
+            That's the closest ancestor whose session is the one the
+            mutations refer to (the root's parent at worst).
+        """
+        mutations = []
+        frame = None
+        execution = self
+        while isinstance(execution, Execution):
+            session = execution._session
+            if session is not None:
+                if frame is None and use_own_session or session is frame:
+                    break
+            mutations.append(execution.mutation)
+            frame = execution.frame
+            execution = execution.parent
+
+        mutations.reverse()
+        return (execution, mutations)
+
+    def descendants(self):
+        todo = list(self.children)
+        while todo:
+            execution = todo.pop()
+            yield execution
+            todo.extend(execution.children)
 
     def print_diff(self):
         self.generate_log()
@@ -206,8 +395,7 @@ class Execution:
         return None
 
     def diverged(self, diverge_event, mutations):
-        from diverge_handler import DivergeHandler
-        DivergeHandler(self, diverge_event, mutations).handle()
+        diverge_handler.DivergeHandler(self, diverge_event, mutations).handle()
 
     def success(self):
         self.state = ExecutionStates.SUCCESS
@@ -224,7 +412,10 @@ class RootExecution(Execution):
         parent.depth_otf = 0
         parent.score = 0
         parent.explorer = explorer
-        parent.mutated_session = load_session(explorer.logfile_path)
+        parent.mutated_session = load_session(explorer.logfile_path,
+                                              lazy=explorer.lazy,
+                                              memory_cap=explorer.memory_cap,
+                                              jobs=explorer.load_jobs)
         parent.fly_offsets = dict()
         parent.mutation_indices = dict()
         parent.sig = ""
@@ -249,102 +440,93 @@ class RootExecution(Execution):
 # An execution is not the same as a replay:
 # A Replay can mutate and thus represent different executions
 class Replayer:
-    def __init__(self, execution):
+    def __init__(self, execution, context_class=None):
         self.execution = execution
         self.explorer = execution.explorer
-        self.context = None
+        self.replay = ScribeReplay(context_class)
 
     def stop(self):
-        self.context.close()
+        self.replay.stop()
 
-    def run(self, exe):
+    def prepare(self):
         if is_verbose():
             self.execution.info("Running %s (%d)" % (self.execution, self.execution.score))
             self.execution.print_diff()
-
-        def _on_mutation(diverge_event, mutations):
-            if self.execution is None:
-                return
-
-            self.execution.diverged(diverge_event, mutations)
-            old_execution = self.execution
-            try:
-                self.execution = [e for e in self.explorer.executions
-                                  if e.state == ExecutionStates.RUNNING][0]
-            except IndexError:
-                # user pattern aborted the replay, must abort.
-                self.execution = None
-                ps.kill()
-                return
-            if is_verbose():
-                self.execution.info("Continue Running %s" % self.execution)
-            self.execution.num_run = old_execution.num_run
-            self.execution.num_success = old_execution.num_success
-
-        class ReplayContext(scribe.Context):
-            def __init__(self, logfile, **kargs):
-                scribe.Context.__init__(self, logfile, **kargs)
-                self.start = datetime.datetime.now()
-                self.last = self.start
-
-            def on_mutation(self, diverge_event, mutations):
-                _on_mutation(diverge_event, mutations)
-
-            def on_bookmark(self, id, npr):
-                now = datetime.datetime.now()
-                dstart = now - self.start
-                dlast = now - self.last
-                self.last = now
-                print("Reached bmark %d at %d.%ds, +%d.%ds" %
-                        (id, dstart.seconds, dstart.microseconds,
-                            dlast.seconds, dlast.microseconds))
-                self.resume()
-
         self.execution.generate_log()
-        with open(self.execution.logfile_path, 'r') as logfile:
-            self.context = ReplayContext(logfile, backtrace_len = 0)
-            self.context.add_init_loader(lambda argv, envp: exe.prepare())
-            ps = scribe.Popen(self.context, replay = True)
 
-        def do_check_deadlock(signum, stack):
-            try:
-                self.context.check_deadlock()
-            except OSError as e:
-                if e.errno != errno.EPERM:
-                    logging.error("Cannot check for deadlock (%s)" % str(e))
-        signal.signal(signal.SIGALRM, do_check_deadlock)
-        signal.setitimer(signal.ITIMER_REAL, 1, 1)
+    def on_mutation(self, diverge_event, mutations):
+        """ Returns False when the replay must be aborted """
+        if self.execution is None:
+            return True
+
+        self.execution.diverged(diverge_event, mutations)
+        old_execution = self.execution
+        self.execution = self.explorer.running_execution()
+        if self.execution is None:
+            # user pattern aborted the replay, must abort.
+            return False
+        if is_verbose():
+            self.execution.info("Continue Running %s" % self.execution)
+        self.execution.num_run = old_execution.num_run
+        self.execution.num_success = old_execution.num_success
+        return True
 
-        try:
-            self.context.wait()
-            if self.execution is not None:
-                self.execution.success()
-        except scribe.DeadlockError:
-            if self.execution is not None:
-                self.execution.deadlocked()
-        except scribe.DivergeError as diverge:
-            if self.execution is not None:
-                self.execution.diverged(diverge.event, [])
-        except scribe.ContextClosedError:
-            pass
-        finally:
-            signal.setitimer(signal.ITIMER_REAL, 0, 0)
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    def finish(self, outcome, diverge_event):
+        if self.execution is None:
+            return
+        if outcome == ReplayOutcomes.SUCCESS:
+            self.execution.success()
+        elif outcome == ReplayOutcomes.DEADLOCK:
+            self.execution.deadlocked()
+        elif outcome == ReplayOutcomes.DIVERGE:
+            self.execution.diverged(diverge_event, [])
 
-        ps.wait()
-        self.context.close()
+    def run(self, exe):
+        self.prepare()
+        (outcome, diverge_event) = self.replay.run(self.execution.logfile_path,
+                                                   exe, self.on_mutation)
+        self.finish(outcome, diverge_event)
 
 class Explorer:
     def __init__(self, logfile_path, on_the_fly, var_io,
                  num_success_to_stop, isolate, linear, pattern,
                  add_constant, del_constant, match_constant,
-                 max_delete, max_otf):
+                 max_delete, max_otf, lazy=False, memory_cap=None,
+                 load_jobs=1, materialize_every=1, materialize_children=None,
+                 max_logs=None, pregenerate=False, mutate_jobs=1,
+                 instrument=False, jobs=1, context_class=None):
 
         self.add_constant = add_constant
         self.del_constant = del_constant
         self.match_constant = match_constant
         self.max_delete = max_delete
         self.max_otf = max_otf
+        self.lazy = lazy
+        self.memory_cap = memory_cap
+        self.load_jobs = load_jobs
+        self.mutate_jobs = mutate_jobs
+        self.jobs = jobs
+        self.context_class = context_class
+
+        # Materialization policy, see checkpoint()
+        self.materialize_every = materialize_every
+        self.materialize_children = materialize_children
+        self.max_logs = max_logs
+        self._clock = 0
+        self.logs_written = 0
+        self.bytes_written = 0
+        self.logs_evicted = 0
+        self.bytes_freed = 0
+        self.regen_time = 0
+        self.regen_time_saved = 0
+        self.pregenerate = pregenerate
+        self.instrument = instrument
+        self.stage_stats = collections.OrderedDict() # stage name -> totals
+        self.logs_batched = 0
+        self.num_setups = 0
+        self.setup_time = 0
+        self.max_setup_time = 0
+        self.jails_open_time = 0
         self.logfile_path = logfile_path
         self.num_success_to_stop = num_success_to_stop
         self.isolate = isolate
@@ -354,6 +536,12 @@ class Explorer:
         self.pattern = pattern
         self.executions = []
         self.execution_set = set()
+        self.frontier = Frontier()
+        self.state_counts = collections.defaultdict(int)
+        self.running_executions = collections.OrderedDict() # id -> execution
+        # id -> execution with a log, the root aside, least recently used first
+        self.materialized = collections.OrderedDict()
+        self.new_executions = [] # added since the last pregenerate_logs()
         self.make_mreplay_dir()
         self._next_id = 0
         self.root = RootExecution(self, on_the_fly, var_io)
@@ -379,11 +567,179 @@ class Explorer:
                     (child.id, child.score, child.score - parent.score,
                     child.signature()))
 
+        child.seq = len(self.executions)
         self.executions.append(child)
         self.execution_set.add(child)
+        self.enter_state(child, child.state)
+        if parent is not None:
+            parent.children.append(child)
+            self.new_executions.append(child)
+
+    def enter_state(self, execution, state):
+        self.state_counts[state] += 1
+        if state == ExecutionStates.TODO:
+            self.frontier.push(execution)
+            self.count_todo(execution, 1)
+        elif state == ExecutionStates.RUNNING:
+            self.running_executions[id(execution)] = execution
+
+    def state_changed(self, execution, old_state, state):
+        self.state_counts[old_state] -= 1
+        if old_state == ExecutionStates.TODO:
+            self.count_todo(execution, -1)
+        if old_state == ExecutionStates.RUNNING:
+            del self.running_executions[id(execution)]
+        self.enter_state(execution, state)
 
     def num_state(self, state):
-        return len(filter(lambda e: e.state == state, self.executions))
+        return self.state_counts[state]
+
+    def running_execution(self):
+        """ The execution an on the fly mutation continues with, the first
+            one added if there are several.
+        """
+        for execution in self.running_executions.itervalues():
+            return execution
+        return None
+
+    def count_todo(self, execution, delta):
+        while isinstance(execution, Execution):
+            execution.num_todo += delta
+            execution = execution.parent
+
+    def tick(self):
+        self._clock += 1
+        return self._clock
+
+    def touch(self, execution):
+        """ execution, or its session, was just used """
+        execution.last_used = self.tick()
+        key = id(execution)
+        if key in self.materialized:
+            self.materialized[key] = self.materialized.pop(key)
+
+    def log_changed(self, execution):
+        key = id(execution)
+        if execution.has_log and execution is not self.root:
+            if key not in self.materialized:
+                self.materialized[key] = execution
+        else:
+            self.materialized.pop(key, None)
+
+    def should_materialize(self, execution):
+        if execution is self.root:
+            return True
+        if execution.depth % self.materialize_every == 0:
+            return True
+        return self.materialize_children is not None and \
+               len(execution.children) >= self.materialize_children
+
+    def on_frontier(self, execution):
+        """ Whether an execution left to run derives from this one """
+        return execution.num_todo > 0
+
+    def checkpoint(self, execution):
+        """ Materialization policy, applied once execution has been
+            replayed: its log (and session) is kept if it is at a
+            materialize_every depth, or has at least materialize_children
+            children. Beyond max_logs logs, the least recently used logs that
+            are not on the frontier are evicted.
+        """
+        self.touch(execution)
+        if execution.has_log and not self.should_materialize(execution):
+            self.evict(execution)
+
+        if self.max_logs is None:
+            return
+        excess = len(self.materialized) - self.max_logs
+        if excess <= 0:
+            return
+        victims = []
+        for e in self.materialized.itervalues():
+            if not self.on_frontier(e):
+                victims.append(e)
+                if len(victims) == excess:
+                    break
+        for e in victims:
+            self.evict(e)
+
+    def pregenerate_logs(self):
+        """ Writes the logs of the executions added since the last call,
+            the siblings the last divergence made, when they are still to
+            run. Executions built from the same session are written together
+            with a single traversal of that session. These logs are on the
+            frontier, where checkpoint() cannot evict them: no more are
+            written than max_logs allows.
+        """
+        executions = [e for e in self.new_executions
+                      if e.state == ExecutionStates.TODO and not e.has_log
+                      and not os.path.exists(e.logfile_path)]
+        self.new_executions = []
+        if self.max_logs is not None:
+            room = self.max_logs - len(self.materialized)
+            executions = executions[:max(room, 0)]
+
+        groups = dict()
+        for e in executions:
+            (session, m) = e.log_pipeline()
+            stats = None
+            if self.instrument:
+                (m, stats) = mutator.instrument(m)
+            groups.setdefault(id(session), (session, []))[1].append(
+                    (e, m, stats))
+
+        for (session, outputs) in groups.values():
+            start = time.time()
+            logfiles = [open(e.logfile_path, 'w') for (e, m, stats) in outputs]
+            try:
+                write_sibling_logs(session,
+                                   [(logfile, m) for (logfile, (e, m, stats))
+                                    in zip(logfiles, outputs)])
+            finally:
+                for logfile in logfiles:
+                    logfile.close()
+            generate_time = (time.time() - start) / len(outputs)
+            for (e, m, stats) in outputs:
+                e.log_written(generate_time)
+                if stats is not None:
+                    e.record_stage_stats(stats)
+            if len(outputs) > 1:
+                self.logs_batched += len(outputs)
+
+    def add_stage_stats(self, stats):
+        for s in stats:
+            total = self.stage_stats.get(s.name)
+            if total is None:
+                total = self.stage_stats[s.name] = mutator.StageStats(s.name)
+            total.add(s)
+
+    def evict(self, execution):
+        """ Deletes the log of an execution and drops its session.
+            The mutations of its descendants that refer to its session are
+            rewritten in terms of the session it derives from.
+        """
+        session = execution._session
+        if session is not None:
+            (base, mutations) = execution.mutation_chain(use_own_session=False)
+            base_session = base.mutated_session
+            plan = mutator.EditPlan(base_session, mutations)
+            for e in execution.descendants():
+                if e.frame is session:
+                    str(e) # names are made of the original mutations
+                    e.mutation = plan.translate(e.mutation, session)
+                    e.frame = base_session
+                if e._running_session is session:
+                    e._running_session = None
+            execution._session = None
+
+        if execution.has_log:
+            self.bytes_freed += os.path.getsize(execution.logfile_path)
+            os.unlink(execution.logfile_path)
+            self.bytes_freed += log_index.remove_index(execution.logfile_path)
+            execution.has_log = False
+        execution.evicted = True
+        self.logs_evicted += 1
+        execution.info("Evicted log")
 
     def print_status(self, num_run):
         logging.info("-" * 80)
@@ -407,28 +763,41 @@ class Explorer:
 
         self.add_execution(None, self.root)
 
-        num_run = 0
-        while not stop_requested[0]:
-            if self.num_state(ExecutionStates.SUCCESS) >= self.num_success_to_stop:
-                break
-
-            todos = filter(lambda e: e.state == ExecutionStates.TODO, self.executions)
-            if len(todos) == 0:
-                break
-            self.print_status(num_run)
-            execution = max(todos, key=lambda e: e.score)
-
-            num_run += 1
-            with execute.open(jailed=self.isolate) as exe:
-                execution.num_run = num_run
-                execution.num_success = len(list([e for e in self.executions if e.state == ExecutionStates.SUCCESS]))
-
-                replayer[0] = Replayer(execution)
-                replayer[0].run(exe)
+        if self.jobs > 1:
+            run_all = self.run_workers
+        else:
+            run_all = self.run_replays
+        if self.isolate:
+            # The jails are mounted once, one per replay at a time
+            start = time.time()
+            with execute.JailPool(self.jobs) as jails:
+                self.jails_open_time = time.time() - start
+                num_run = run_all(stop_requested, replayer, jails)
+        else:
+            num_run = run_all(stop_requested, replayer)
 
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         print("Number of Replays: %d" % num_run)
+        print("Logs: %d written (%d MB, %d in batches), %d evicted (%d MB), "
+              "regeneration: %.1fs spent, %.1fs saved" %
+              (self.logs_written, self.bytes_written >> 20,
+               self.logs_batched, self.logs_evicted, self.bytes_freed >> 20,
+               self.regen_time, self.regen_time_saved))
+        if self.num_setups:
+            jails = ""
+            if self.isolate:
+                jails = ", %d jails opened in %.1fs" % \
+                        (self.jobs, self.jails_open_time)
+            print("Replay setup: %.1f ms on average, %.1f ms at most%s" %
+                  (self.setup_time * 1000 / self.num_setups,
+                   self.max_setup_time * 1000, jails))
+        if self.memory_cap is not None:
+            print("Peak RSS: %d MB" % (peak_rss() >> 20))
+        if self.instrument:
+            print("Log generation stages:")
+            for line in mutator.format_stats(self.stage_stats.values()):
+                print(line)
 
         if self.num_success_to_stop != 1:
             print("")
@@ -440,3 +809,88 @@ class Explorer:
                     print("%d %d %d %s:" % (execution.score, execution.num_run, execution.num_success+1, execution))
                     execution.print_diff()
                     print("")
+
+    def replay_ready(self, execution, setup_time):
+        """ The replay of execution took setup_time to set up """
+        self.num_setups += 1
+        self.setup_time += setup_time
+        self.max_setup_time = max(self.max_setup_time, setup_time)
+        execution.info("Replay set up in %.1f ms" % (setup_time * 1000))
+
+    def run_replays(self, stop_requested, replayer, jails=None):
+        num_run = 0
+        while not stop_requested[0]:
+            if self.num_state(ExecutionStates.SUCCESS) >= self.num_success_to_stop:
+                break
+
+            execution = self.frontier.top()
+            if execution is None:
+                break
+            self.print_status(num_run)
+
+            num_run += 1
+            start = time.time()
+            jail = jails.jails[0] if jails is not None else None
+            with execute.open(jailed=self.isolate, jail=jail) as exe:
+                self.replay_ready(execution, time.time() - start)
+                execution.num_run = num_run
+                execution.num_success = self.num_state(ExecutionStates.SUCCESS)
+
+                replayer[0] = Replayer(execution, self.context_class)
+                replayer[0].run(exe)
+            self.checkpoint(execution)
+            if self.pregenerate:
+                self.pregenerate_logs()
+        return num_run
+
+    def run_workers(self, stop_requested, replayer, jails=None):
+        """ Replays up to jobs executions at a time, each in a worker
+            process. Their outcomes and on the fly mutations are handled
+            here, one replay after the other in the order they started, so
+            that the exploration does not depend on which replay finishes
+            first.
+        """
+        workers = ReplayWorkers(self.jobs, self.isolate, self.context_class,
+                                jails)
+        replayer[0] = workers
+        in_flight = collections.deque()
+        num_run = 0
+        try:
+            while not stop_requested[0]:
+                if self.num_state(ExecutionStates.SUCCESS) >= self.num_success_to_stop:
+                    break
+
+                while len(in_flight) < self.jobs:
+                    execution = self.frontier.pop()
+                    if execution is None:
+                        break
+                    self.print_status(num_run)
+                    num_run += 1
+                    execution.num_run = num_run
+                    execution.num_success = self.num_state(ExecutionStates.SUCCESS)
+                    execution_replayer = Replayer(execution, self.context_class)
+                    execution_replayer.prepare()
+                    worker = workers.submit(execution.logfile_path)
+                    in_flight.append((execution, execution_replayer, worker))
+
+                if not in_flight:
+                    break
+                (execution, execution_replayer, worker) = in_flight.popleft()
+                (outcome, diverge_event) = workers.wait(worker,
+                        execution_replayer.on_mutation)
+                if stop_requested[0]:
+                    break
+                if worker.setup_time is not None:
+                    self.replay_ready(execution, worker.setup_time)
+                execution_replayer.finish(outcome, diverge_event)
+                self.checkpoint(execution)
+                if self.pregenerate:
+                    self.pregenerate_logs()
+        finally:
+            workers.close()
+        return num_run
+
+# Last, as diverge_handler imports Execution from this module. Not lazily
+# in Execution.diverged(): the mreplay path may be relative, and the
+# explorer changes directory.
+import diverge_handler
@@ -0,0 +1,453 @@
+import scribe
+import unistd
+import os
+import errno
+import mmap
+import cPickle
+import hashlib
+import struct
+import tempfile
+import itertools
+import multiprocessing
+from array import array
+
+INDEX_MAGIC = 'mreplay-index'
+INDEX_VERSION = 3
+INDEX_SUFFIX = '.idx'
+INDEX_HASH_CHUNK = 1 << 20
+
+# The events with a variable size. Their header is a struct
+# scribe_event_sized: the type on a byte, then the size of the payload on
+# 16 bits. The other events are only a type byte ahead of a payload of a
+# fixed size for the type.
+SIZED_EVENTS = (scribe.EventInit, scribe.EventData, scribe.EventDataExtra,
+                scribe.EventSyscallExtra, scribe.EventResourceLockExtra,
+                scribe.EventSetFlags, scribe.EventNop)
+_SIZED_HEADER = struct.Struct('<BH')
+_event_sizes = None
+
+def event_sizes():
+    """ native type -> size of the events of the type, None when sized """
+    global _event_sizes
+    if _event_sizes is None:
+        sizes = dict()
+        for klass in vars(scribe).itervalues():
+            if isinstance(klass, type) and issubclass(klass, scribe.Event) \
+               and hasattr(klass, 'native_type'):
+                if issubclass(klass, SIZED_EVENTS):
+                    sizes[klass.native_type] = None
+                else:
+                    sizes[klass.native_type] = len(klass().encode())
+        _event_sizes = sizes
+    return _event_sizes
+
+def scan_headers(buf, offset=0, end=None):
+    """ Yields (offset, length, native type) for each event of a log buffer,
+        from offset to end. Only the event headers are read.
+    """
+    sizes = event_sizes()
+    unpack_sized = _SIZED_HEADER.unpack_from
+    if end is None:
+        end = len(buf)
+    while offset < end:
+        type = ord(buf[offset])
+        try:
+            length = sizes[type]
+        except KeyError:
+            raise ValueError("Unknown event type %d at offset %d" %
+                             (type, offset))
+        if length is None:
+            length = _SIZED_HEADER.size + unpack_sized(buf, offset)[1]
+        yield (offset, length, type)
+        offset += length
+
+def scan_events(buf):
+    """ Yields (offset, length, event) for each event of a log buffer """
+    for ((offset, length, type), e) in \
+            itertools.izip(scan_headers(buf), scribe.EventsFromBuffer(buf)):
+        yield (offset, length, e)
+
+class LogIndex:
+    """ Header-level description of a log: where each event lives in the
+        buffer, who owns it, and the per process event/syscall lists.
+        Events are designated by their ordinal in the log.
+        new_array(typecode) makes the arrays, it can be replaced by anything
+        that behaves like an array (see streaming.ChunkedArray).
+    """
+    def __init__(self, new_array=array):
+        self.new_array = new_array
+        self.offsets = new_array('L')
+        self.lengths = new_array('L')
+        self.types = new_array('H')
+        self.pids = new_array('l')     # -1 when the event has no process
+        self.syscalls = new_array('l') # enclosing syscall, -1 outside syscalls
+
+        self.proc_events = dict()
+        self.proc_syscalls = dict()
+        # Indices in proc_events of each syscall and of its end, -1 when the
+        # syscall never ends. See Process.syscall_span().
+        self.proc_syscall_starts = dict()
+        self.proc_syscall_ends = dict()
+        # Indices in proc_events of the successful forks, and of the exit
+        self.proc_forks = dict()
+        self.proc_exits = dict()
+        self.proc_names = dict()
+        self.bookmarks = dict()         # bookmark id -> ordinals
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add_process(self, pid, indexer):
+        """ Takes the lists built by a ProcessIndexer """
+        self.proc_events[pid] = indexer.events
+        self.proc_syscalls[pid] = indexer.syscalls
+        self.proc_syscall_starts[pid] = indexer.syscall_starts
+        self.proc_syscall_ends[pid] = indexer.syscall_ends
+        self.proc_forks[pid] = indexer.forks
+        if indexer.exit is not None:
+            self.proc_exits[pid] = indexer.exit
+        if indexer.name is not None:
+            self.proc_names[pid] = indexer.name
+
+    def add_bookmarks(self, indexers):
+        bookmarks = [b for indexer in indexers for b in indexer.bookmarks]
+        bookmarks.sort(key=lambda (id, ordinal): ordinal)
+        for (id, ordinal) in bookmarks:
+            if id not in self.bookmarks:
+                self.bookmarks[id] = array('L')
+            self.bookmarks[id].append(ordinal)
+
+# The events ProcessIndexer looks into
+_SYSCALL_EXTRA = scribe.EventSyscallExtra.native_type
+_SYSCALL_END = scribe.EventSyscallEnd.native_type
+_BOOKMARK = scribe.EventBookmark.native_type
+_DATA_EXTRA = scribe.EventDataExtra.native_type
+_DECODED_TYPES = (_SYSCALL_EXTRA, _BOOKMARK)
+
+class ProcessIndexer:
+    """ Per process part of build_index(): event and syscall lists, syscall
+        spans, forks, exit and execve name. Same logic as Process.add_event().
+    """
+    def __init__(self, new_array=array):
+        self.events = new_array('L')
+        self.syscalls = new_array('L')
+        self.syscall_starts = new_array('l')
+        self.syscall_ends = new_array('l')
+        self.forks = array('l')
+        self.exit = None
+        self.name = None
+        self.bookmarks = []             # (bookmark id, ordinal)
+
+        self._current_syscall = -1
+        self._open_syscalls = []
+        self._execve = False
+        self._execve_name = None
+
+    def needs_event(self, type):
+        """ Whether add_event() looks into the next event, of native type
+            type, rather than only at its type.
+        """
+        if type == _DATA_EXTRA:
+            return self._execve and self._execve_name is None
+        return type in _DECODED_TYPES
+
+    def add_event(self, ordinal, type, e=None):
+        """ Returns the ordinal of the syscall enclosing the event. e is the
+            decoded event, needed only when needs_event(type).
+        """
+        self.events.append(ordinal)
+        position = len(self.events) - 1
+
+        if type == _BOOKMARK:
+            self.bookmarks.append((e.id, ordinal))
+
+        if type == _SYSCALL_EXTRA:
+            self.syscalls.append(ordinal)
+            self.syscall_starts.append(position)
+            self.syscall_ends.append(-1)
+            self._open_syscalls.append(len(self.syscall_ends) - 1)
+            self._current_syscall = ordinal
+            self._execve = e.nr == unistd.NR_execve and e.ret >= 0
+            self._execve_name = None
+            if e.nr in unistd.SYS_fork and e.ret > 0:
+                self.forks.append(position)
+            elif e.nr in unistd.SYS_exit:
+                self.exit = position
+
+        syscall = self._current_syscall
+
+        if self._execve and self._execve_name is None and \
+           type == _DATA_EXTRA and \
+           e.data_type == scribe.SCRIBE_DATA_INPUT | scribe.SCRIBE_DATA_STRING:
+            self._execve_name = e.data
+
+        if type == _SYSCALL_END:
+            if self._execve_name is not None:
+                self.name = self._execve_name
+            self._execve = False
+            self._execve_name = None
+            for i in self._open_syscalls:
+                self.syscall_ends[i] = position
+            self._open_syscalls = []
+            self._current_syscall = -1
+
+        return syscall
+
+def _decode(buf, offset, length):
+    return scribe.EventsFromBuffer(buffer(buf, offset, length)).next()
+
+def build_index(buf, new_array=array):
+    """ Indexes a log buffer from its event headers. Only the events that
+        the index needs to look into are decoded: the EventPid events, and
+        the ones the ProcessIndexer asks for.
+    """
+    index = LogIndex(new_array)
+    indexers = dict()
+
+    pid_type = scribe.EventPid.native_type
+    pid = -1
+    indexer = None
+    for (ordinal, (offset, length, type)) in enumerate(scan_headers(buf)):
+        index.offsets.append(offset)
+        index.lengths.append(length)
+        index.types.append(type)
+
+        if type == pid_type:
+            pid = _decode(buf, offset, length).pid
+            indexer = indexers.get(pid)
+            if indexer is None:
+                indexer = indexers[pid] = ProcessIndexer(new_array)
+            index.pids.append(-1)
+            index.syscalls.append(-1)
+            continue
+
+        index.pids.append(pid)
+        if indexer is None:
+            index.syscalls.append(-1)
+            continue
+        e = None
+        if indexer.needs_event(type):
+            e = _decode(buf, offset, length)
+        index.syscalls.append(indexer.add_event(ordinal, type, e))
+
+    for (pid, indexer) in indexers.iteritems():
+        index.add_process(pid, indexer)
+    index.add_bookmarks(indexers.values())
+    return index
+
+###############################################################################
+# Parallel indexing
+###############################################################################
+
+# The log of the pool workers, mapped once per worker
+_worker_buffer = None
+
+def _init_worker(logfile_path):
+    global _worker_buffer
+    with open(logfile_path, 'rb') as logfile:
+        _worker_buffer = mmap.mmap(logfile.fileno(), 0, prot=mmap.PROT_READ)
+
+def _index_process((pid, runs)):
+    indexer = ProcessIndexer()
+    syscalls = array('l')
+    for (ordinal, start, end) in runs:
+        for (offset, length, type) in scan_headers(_worker_buffer, start, end):
+            e = None
+            if indexer.needs_event(type):
+                e = _decode(_worker_buffer, offset, length)
+            syscalls.append(indexer.add_event(ordinal, type, e))
+            ordinal += 1
+    return (pid, indexer, syscalls)
+
+def build_index_parallel(logfile_path, buf, jobs):
+    """ Same as build_index(), with the per process work spread over a pool
+        of jobs processes. A first pass only records where the events are
+        and splits the log into runs of events of the same process (the
+        bytes between two EventPid). Each process runs are then decoded and
+        indexed by a worker. Like in build_index(), only the events the index
+        looks into are decoded.
+    """
+    index = LogIndex()
+    runs = dict()   # pid -> [[first ordinal, start offset, end offset]]
+
+    pid_type = scribe.EventPid.native_type
+    pid = -1
+    run = None
+    for (ordinal, (offset, length, type)) in enumerate(scan_headers(buf)):
+        index.offsets.append(offset)
+        index.lengths.append(length)
+        index.types.append(type)
+
+        if type == pid_type:
+            pid = _decode(buf, offset, length).pid
+            run = [ordinal + 1, offset + length, offset + length]
+            runs.setdefault(pid, []).append(run)
+            index.pids.append(-1)
+            continue
+
+        index.pids.append(pid)
+        if run is not None:
+            run[2] = offset + length
+
+    index.syscalls = array('l', [-1]) * len(index)
+
+    # Biggest processes first, they bound the wall clock time
+    tasks = sorted(runs.iteritems(),
+                   key=lambda (pid, runs): -sum(end - start
+                                                for (_, start, end) in runs))
+    indexers = []
+    pool = multiprocessing.Pool(jobs, _init_worker, (logfile_path,))
+    try:
+        for (pid, indexer, syscalls) in pool.imap_unordered(_index_process,
+                                                            tasks):
+            index.add_process(pid, indexer)
+            indexers.append(indexer)
+            for (ordinal, syscall) in zip(indexer.events, syscalls):
+                index.syscalls[ordinal] = syscall
+    finally:
+        pool.terminate()
+        pool.join()
+
+    index.add_bookmarks(indexers)
+    return index
+
+###############################################################################
+# Sidecar index files
+###############################################################################
+
+def index_path(logfile_path):
+    return logfile_path + INDEX_SUFFIX
+
+def remove_index(logfile_path):
+    """ Removes the sidecar index of a log, if any. Returns its size. """
+    path = index_path(logfile_path)
+    try:
+        size = os.path.getsize(path)
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+    return size
+
+def index_key(logfile_path):
+    """ An index is valid for a log as long as its size, mtime and sampled
+        content hash (head and tail) are the same.
+    """
+    st = os.stat(logfile_path)
+    digest = hashlib.sha1()
+    with open(logfile_path, 'rb') as logfile:
+        digest.update(logfile.read(INDEX_HASH_CHUNK))
+        if st.st_size > INDEX_HASH_CHUNK:
+            logfile.seek(max(INDEX_HASH_CHUNK, st.st_size - INDEX_HASH_CHUNK))
+            digest.update(logfile.read())
+    return (st.st_size, st.st_mtime, digest.hexdigest(), array('L').itemsize)
+
+def _pack(a):
+    return (a.typecode, a.tostring())
+
+def _unpack((typecode, data)):
+    a = array(typecode)
+    a.fromstring(data)
+    return a
+
+def _pack_dict(d):
+    return dict((k, _pack(a)) for (k, a) in d.iteritems())
+
+def _unpack_dict(d):
+    return dict((k, _unpack(a)) for (k, a) in d.iteritems())
+
+def save_index(index, logfile_path, key=None):
+    """ Writes the sidecar index of a log. key is the index_key() of the
+        log, when already computed.
+    """
+    if key is None:
+        key = index_key(logfile_path)
+    state = {
+        'offsets':             _pack(index.offsets),
+        'lengths':             _pack(index.lengths),
+        'types':               _pack(index.types),
+        'pids':                _pack(index.pids),
+        'syscalls':            _pack(index.syscalls),
+        'proc_events':         _pack_dict(index.proc_events),
+        'proc_syscalls':       _pack_dict(index.proc_syscalls),
+        'proc_syscall_starts': _pack_dict(index.proc_syscall_starts),
+        'proc_syscall_ends':   _pack_dict(index.proc_syscall_ends),
+        'proc_forks':          _pack_dict(index.proc_forks),
+        'proc_exits':          index.proc_exits,
+        'proc_names':          index.proc_names,
+        'bookmarks':           _pack_dict(index.bookmarks),
+    }
+
+    # Each writer has its own temporary file, in the same directory so
+    # that the rename is atomic.
+    path = index_path(logfile_path)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                      prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump((INDEX_MAGIC, INDEX_VERSION, key),
+                         f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def load_index(logfile_path, key=None):
+    """ Returns the sidecar index of a log, or None if there is none or if
+        it is stale. key is the index_key() of the log, when already
+        computed.
+    """
+    try:
+        f = open(index_path(logfile_path), 'rb')
+    except IOError:
+        return None
+
+    with f:
+        try:
+            header = cPickle.load(f)
+            if key is None:
+                key = index_key(logfile_path)
+            if header != (INDEX_MAGIC, INDEX_VERSION, key):
+                return None
+            state = cPickle.load(f)
+        except (EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+            return None
+
+    index = LogIndex()
+    index.offsets = _unpack(state['offsets'])
+    index.lengths = _unpack(state['lengths'])
+    index.types = _unpack(state['types'])
+    index.pids = _unpack(state['pids'])
+    index.syscalls = _unpack(state['syscalls'])
+    index.proc_events = _unpack_dict(state['proc_events'])
+    index.proc_syscalls = _unpack_dict(state['proc_syscalls'])
+    index.proc_syscall_starts = _unpack_dict(state['proc_syscall_starts'])
+    index.proc_syscall_ends = _unpack_dict(state['proc_syscall_ends'])
+    index.proc_forks = _unpack_dict(state['proc_forks'])
+    index.proc_exits = state['proc_exits']
+    index.proc_names = state['proc_names']
+    index.bookmarks = _unpack_dict(state['bookmarks'])
+    return index
+
+def open_index(logfile_path, buf, jobs=1):
+    """ Returns the index of a log, reusing its sidecar index when valid,
+        and writing one otherwise.
+    """
+    # The log is hashed once, for both checking and writing the index
+    key = index_key(logfile_path)
+    index = load_index(logfile_path, key)
+    if index is not None:
+        return index
+
+    if jobs > 1:
+        index = build_index_parallel(logfile_path, buf, jobs)
+    else:
+        index = build_index(buf)
+    try:
+        save_index(index, logfile_path, key)
+    except (IOError, OSError):
+        # read-only location, we'll scan again next time
+        pass
+    return index
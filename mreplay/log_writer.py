@@ -0,0 +1,134 @@
+import scribe
+import itertools
+from session import LazySession
+from mutator import CatSession
+from mutator.sharded import Counted
+
+class LogWriter:
+    """ Writes the events of a mutated session to a log file.
+        Events that come untouched from a LazySession are not encoded: they
+        are still in the session buffer, and consecutive ones are written
+        with a single write of the corresponding buffer range. Other events
+        read from a log reuse the bytes they were read from (Event.encode()),
+        only the events built by the mutators get encoded.
+        Output is gathered and handed to logfile.writelines() by batches of
+        about buffer_size bytes.
+    """
+    def __init__(self, logfile, session=None, buffer_size=1 << 20):
+        self.logfile = logfile
+        self.session = session if isinstance(session, LazySession) else None
+        self.buffer_size = buffer_size
+        self._run_start = None
+        self._run_end = None
+        self._pending = []
+        self._pending_bytes = 0
+
+        self.bytes_copied = 0
+        self.bytes_reused = 0
+        self.bytes_encoded = 0
+        self.num_copies = 0
+        self.num_writes = 0
+
+    def write(self, e):
+        if not isinstance(e._scribe_event, scribe.Event):
+            return # Same as ToRawEvents
+
+        byte_range = None
+        if self.session is not None:
+            byte_range = self.session.byte_range(e)
+
+        if byte_range is None:
+            self._end_run()
+            data = e.encode()
+            if e._raw is not None:
+                self.bytes_reused += len(data)
+            else:
+                self.bytes_encoded += len(data)
+            self._output(data)
+            return
+
+        (offset, length) = byte_range
+        if offset != self._run_end:
+            self._end_run()
+            self._run_start = offset
+        self._run_end = offset + length
+
+    def _end_run(self):
+        if self._run_start is None:
+            return
+        length = self._run_end - self._run_start
+        self._output(buffer(self.session.buffer, self._run_start, length))
+        self.bytes_copied += length
+        self.num_copies += 1
+        self._run_start = None
+        self._run_end = None
+
+    def _output(self, data):
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.buffer_size:
+            self._drain()
+
+    def _drain(self):
+        if not self._pending:
+            return
+        self.logfile.writelines(self._pending)
+        self.num_writes += 1
+        self._pending = []
+        self._pending_bytes = 0
+
+    def flush(self):
+        self._end_run()
+        self._drain()
+
+def write_log(logfile, events):
+    """ Runs a mutator pipeline and writes its output to logfile.
+        Returns the LogWriter, for its counters.
+    """
+    env = dict()
+    events.start(env)
+    writer = LogWriter(logfile, env.get('session'))
+    for e in events.process_events(None):
+        writer.write(e)
+    writer.flush()
+    return writer
+
+def write_sibling_logs(session, outputs, block_size=4096):
+    """ outputs is a list of (logfile, mutator). Writes session | mutator to
+        each logfile, as write_log() would, with a single traversal of the
+        session: its events are read once and shared by all the mutators.
+        The mutators advance together, block_size session events at a time,
+        so that only the events between the slowest and the fastest of them
+        are kept around.
+        Returns the LogWriters.
+    """
+    source = CatSession(session)
+    env = dict()
+    source.start(env)
+    branches = itertools.tee(source.process_events(None), len(outputs))
+
+    writers = []
+    streams = []
+    for ((logfile, m), branch) in zip(outputs, branches):
+        m.start(dict(env))
+        counted = Counted(branch)
+        writer = LogWriter(logfile, session)
+        writers.append(writer)
+        streams.append((counted, iter(m.process_events(counted)), writer))
+
+    consumed = 0
+    while streams:
+        consumed += block_size
+        for stream in list(streams):
+            (counted, events, writer) = stream
+            while counted.count < consumed:
+                try:
+                    e = events.next()
+                except StopIteration:
+                    streams.remove(stream)
+                    break
+                writer.write(e)
+
+    for writer in writers:
+        writer.flush()
+    return writers
@@ -13,4 +13,7 @@ from delete_event import DeleteEvent
 from nop import Nop
 from insert_event import InsertEvent
 from set_flags import SetFlags, MutateOnTheFly, IgnoreNextSyscall, SetFlagsInit
-from split_on_bookmark import SplitOnBookmark
+from split_on_bookmark import SplitOnBookmark, split_on_bookmarks
+from edit_plan import EditPlan
+from sharded import Sharded, shard
+from instrument import Instrumented, StageStats, instrument, format_stats
@@ -1,17 +1,68 @@
 from mutator import Mutator
-import scribe
 from mreplay import session
+from bisect import bisect_left
+from array import array
 
 class AdjustResources(Mutator):
     """ Rewrite all serial numbers of resources.
-        Sadly this is a two pass mechanism.
+        A lock gets as serial the number of locks of its resource with a
+        smaller serial.
+        By default this is a two pass mechanism. With single_pass=True, the
+        events must come from env['session'], and the locks that were added
+        or removed on the way must be in env['lock_edits'] (EditPlan puts
+        them there). The serials are then rewritten on the fly from the
+        lock serials of the session.
     """
+    global_barrier = True
+
+    def __init__(self, single_pass=False):
+        self.single_pass = single_pass
+
+    def start(self, env):
+        self.serials = None
+        if not self.single_pass:
+            return
+
+        self.serials = env['session'].lock_serials()
+        (removed, added) = env.get('lock_edits', ([], []))
+        self.removed = self._serials_by_id(removed)
+        self.added = self._serials_by_id(added)
+
+    def _serials_by_id(self, locks):
+        serials = dict()
+        for e in locks:
+            serials.setdefault(e.id, array('l')).append(e.serial)
+        for (id, id_serials) in serials.items():
+            serials[id] = array('l', sorted(id_serials))
+        return serials
+
+    def _new_serial(self, id, serial):
+        empty = ()
+        return bisect_left(self.serials.get(id, empty), serial) - \
+               bisect_left(self.removed.get(id, empty), serial) + \
+               bisect_left(self.added.get(id, empty), serial)
+
     def process_events(self, events):
+        if self.serials is None:
+            return self._process_events_two_pass(events)
+        return self._process_events_single_pass(events)
+
+    def _process_events_single_pass(self, events):
+        for e in events:
+            if e.tag == session.TAG_RESOURCE_LOCK:
+                serial = self._new_serial(e.id, e.serial)
+                if e.serial != serial:
+                    ee = e.copy()
+                    ee.serial = serial
+                    e = session.Event(ee, e.proc)
+            yield e
+
+    def _process_events_two_pass(self, events):
         events = list(events)
 
         serials = dict()
         for e in events:
-            if e.is_a(scribe.EventResourceLockExtra):
+            if e.tag == session.TAG_RESOURCE_LOCK:
                 if e.id not in serials:
                     serials[e.id] = dict()
                 if e.serial not in serials[e.id]:
@@ -33,7 +84,7 @@ class AdjustResources(Mutator):
                 last_i = i
 
         for e in events:
-            if e.is_a(scribe.EventResourceLockExtra):
+            if e.tag == session.TAG_RESOURCE_LOCK:
                 if e.serial != serials[e.id][e.serial]:
                     ee = e.copy()
                     ee.serial = serials[e.id][e.serial]
@@ -1,5 +1,6 @@
 from mutator import Mutator
 from location_matcher import LocationMatcher
+from mreplay import session
 from mreplay.session import Event
 import scribe
 
@@ -25,6 +26,6 @@ class Bookmark(Mutator):
                 bmark_event.npr = self.num_procs
                 yield Event(bmark_event, event.proc)
 
-            if not (event.is_a(scribe.EventBookmark) and
+            if not (event.tag == session.TAG_BOOKMARK and
                     self.bookmark_id == 0):
                 yield event
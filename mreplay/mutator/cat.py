@@ -1,6 +1,8 @@
 from mutator import Mutator
 
 class Cat(Mutator):
+    global_barrier = True
+
     def __init__(self, events):
         self.events = events
 
@@ -1,6 +1,8 @@
 from mutator import Mutator
 
 class CatSession(Mutator):
+    global_barrier = True
+
     def __init__(self, session):
         self.session = session
 
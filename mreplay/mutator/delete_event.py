@@ -1,8 +1,16 @@
 from mutator import Mutator
-import scribe
 from mreplay.location import Location
+from mreplay import session
 from location_matcher import LocationMatcher
 
+# (syscall depth, resource depth) changes when going through an event
+_DEPTH_CHANGES = {
+    session.TAG_SYSCALL:         (1, 0),
+    session.TAG_RESOURCE_LOCK:   (0, 1),
+    session.TAG_SYSCALL_END:     (-1, 0),
+    session.TAG_RESOURCE_UNLOCK: (0, -1),
+}
+
 class DeleteEvent(Mutator):
     def __init__(self, events):
         if not isinstance(events, list):
@@ -17,16 +25,13 @@ class DeleteEvent(Mutator):
     def process_events(self, events):
         syscall_depth = 0
         res_depth = 0
+        match = self.matcher.match
+        depth_changes = _DEPTH_CHANGES.get
         for e in events:
-            match = self.matcher.match(e)
-            if match is not None or syscall_depth > 0 or res_depth > 0:
-                if e.is_a(scribe.EventSyscallExtra):
-                    syscall_depth += 1
-                elif e.is_a(scribe.EventResourceLockExtra):
-                    res_depth += 1
-                elif e.is_a(scribe.EventSyscallEnd):
-                    syscall_depth -= 1
-                elif e.is_a(scribe.EventResourceUnlock):
-                    res_depth -= 1
+            if match(e) is not None or syscall_depth > 0 or res_depth > 0:
+                change = depth_changes(e.tag)
+                if change is not None:
+                    syscall_depth += change[0]
+                    res_depth += change[1]
             else:
                 yield e
@@ -0,0 +1,313 @@
+from mutator import Mutator
+from nop import Nop
+from insert_event import InsertEvent
+from delete_event import DeleteEvent, _DEPTH_CHANGES
+from replace import Replace
+from set_flags import SetFlags
+from mreplay.session import Event, TAG_RESOURCE_LOCK
+from mreplay.location import Location
+import scribe
+
+class _Slot(object):
+    __slots__ = ('before', 'body')
+
+    def __init__(self, event):
+        self.before = []    # events inserted before the session event
+        self.body = event   # the session event, its replacement, or None
+
+class EditPlan(Mutator):
+    """ A chain of InsertEvent, DeleteEvent, Replace, SetFlags and Nop
+        mutations, compiled against the session they apply to.
+        session | EditPlan(session, [m1, m2, ...]) yields the same events as
+        session | m1 | m2 | ..., but in a single pass: each session event
+        touched by the chain has a slot saying what is inserted before it and
+        what it became.
+    """
+    cheap = True
+
+    def __init__(self, session, mutations=[]):
+        self.session = session
+        self._first = session.events[0]
+        self._procs = session.processes.values() # CatSession order
+        self._ranks = dict((proc.pid, rank)
+                           for (rank, proc) in enumerate(self._procs))
+
+        self._slots = dict()    # session event -> _Slot
+        self._owners = dict()   # inserted/replacing event -> [session events]
+        self._proc_slots = None # pid -> [(index, slot)], see _output_event()
+
+        for mutation in mutations:
+            self.add(mutation)
+
+    def add(self, mutation):
+        self._proc_slots = None
+        if isinstance(mutation, Nop):
+            pass
+        elif isinstance(mutation, InsertEvent):
+            self._insert(mutation.matcher, lambda e: mutation.events)
+        elif isinstance(mutation, SetFlags):
+            def set_flags(e):
+                return [Event(scribe.EventSetFlags(mutation.flags,
+                                                   mutation.duration,
+                                                   mutation.extra), e.proc)]
+            self._insert(mutation.matcher, set_flags)
+        elif isinstance(mutation, Replace):
+            for (original, new) in mutation.replacements.items():
+                self._replace(original, new)
+        elif isinstance(mutation, DeleteEvent):
+            self._delete(mutation.matcher)
+        else:
+            raise TypeError("Cannot compile mutator: %s" % mutation.__class__)
+
+    ###########################################################################
+    # Where events are in the stream
+    ###########################################################################
+
+    def _proc_index(self, e):
+        # Index of e in its process, None if e is not a session event
+        proc = e.proc
+        if proc is None or self._ranks.get(proc.pid) is None or \
+           self._procs[self._ranks[proc.pid]] is not proc:
+            return None
+        try:
+            return proc.events.index(e)
+        except ValueError:
+            return None
+
+    def _is_session_event(self, e):
+        return e is self._first or self._proc_index(e) is not None
+
+    def _next_key(self, key):
+        if key is self._first:
+            (rank, i) = (0, 0)
+        else:
+            (rank, i) = (self._ranks[key.proc.pid], self._proc_index(key) + 1)
+        while rank < len(self._procs):
+            events = self._procs[rank].events
+            if i < len(events):
+                return events[i]
+            (rank, i) = (rank + 1, 0)
+        return None
+
+    def _position(self, key, i):
+        if key is self._first:
+            return (-1, 0, i)
+        return (self._ranks[key.proc.pid], self._proc_index(key), i)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot(key)
+        return slot
+
+    def _occurrences(self, e):
+        """ Returns [(slot key, i)] where e is in the stream. i is the index
+            of e in slot.before, len(slot.before) for the slot body.
+        """
+        occurrences = []
+        for key in self._owners.get(e, []):
+            slot = self._slots[key]
+            occurrences.extend((key, i) for (i, ee) in enumerate(slot.before)
+                               if ee is e)
+            if slot.body is e:
+                occurrences.append((key, len(slot.before)))
+
+        if self._is_session_event(e):
+            slot = self._slots.get(e)
+            if slot is None:
+                occurrences.append((e, 0))
+            elif slot.body is e:
+                occurrences.append((e, len(slot.before)))
+        return occurrences
+
+    def _own(self, e, key):
+        self._owners.setdefault(e, []).append(key)
+
+    def _disown(self, e, key):
+        if e is key:
+            return
+        keys = self._owners[e]
+        keys.remove(key)
+        if not keys:
+            del self._owners[e]
+
+    ###########################################################################
+    # Mutations
+    ###########################################################################
+
+    def _insert(self, matcher, make_events):
+        for target in matcher.before:
+            # Last first, so that the indices stay valid
+            for (key, i) in sorted(self._occurrences(target),
+                                   key=lambda (key, i): i, reverse=True):
+                events = list(make_events(target))
+                self._slot(key).before[i:i] = events
+                for e in events:
+                    self._own(e, key)
+
+    def _replace(self, original, new):
+        for (key, i) in self._occurrences(original):
+            slot = self._slot(key)
+            if i < len(slot.before):
+                slot.before[i] = new
+            else:
+                slot.body = new
+            self._disown(original, key)
+            self._own(new, key)
+
+    def _delete(self, matcher):
+        # Same walk as DeleteEvent.process_events(): a matched event is
+        # removed, and so is everything after it while it's nested in the
+        # deleted syscall or resource.
+        targets = matcher.before
+        depth = [0, 0]
+        while True:
+            # Targets before the end of the last walk are gone
+            starts = [occurrence for e in targets
+                                 for occurrence in self._occurrences(e)]
+            if not starts:
+                break
+            (key, i) = min(starts, key=lambda (key, i): self._position(key, i))
+            if not self._walk_delete(key, i, targets, depth):
+                break
+
+    def _walk_delete(self, key, i, targets, depth):
+        while key is not None:
+            slot = self._slot(key)
+            while True:
+                if i < len(slot.before):
+                    e = slot.before[i]
+                elif i == len(slot.before) and slot.body is not None:
+                    e = slot.body
+                else:
+                    break
+
+                if e not in targets and depth[0] <= 0 and depth[1] <= 0:
+                    return True
+
+                change = _DEPTH_CHANGES.get(e.tag)
+                if change is not None:
+                    depth[0] += change[0]
+                    depth[1] += change[1]
+                if i < len(slot.before):
+                    del slot.before[i]
+                else:
+                    slot.body = None
+                self._disown(e, key)
+
+            (key, i) = (self._next_key(key), 0)
+        return False # end of the stream
+
+    ###########################################################################
+    # Translation of mutations made on a log of the plan output
+    ###########################################################################
+
+    def _output_event(self, pid, i):
+        # The i-th event of pid in the plan output
+        if self._proc_slots is None:
+            self._proc_slots = dict()
+            for (key, slot) in self._slots.iteritems():
+                if key is not self._first:
+                    self._proc_slots.setdefault(key.proc.pid, []).append(
+                            (self._proc_index(key), slot))
+            for slots in self._proc_slots.values():
+                slots.sort(key=lambda (index, slot): index)
+
+        events = self._procs[self._ranks[pid]].events
+        (out, base) = (0, 0)
+        for (index, slot) in self._proc_slots.get(pid, []):
+            untouched = index - base
+            if i < out + untouched:
+                break
+            out += untouched
+            items = slot.before
+            if slot.body is not None:
+                items = items + [slot.body]
+            if i < out + len(items):
+                return items[i - out]
+            (out, base) = (out + len(items), index + 1)
+        return events[base + i - out]
+
+    def translate(self, mutation, frame):
+        """ Returns mutation, made on frame, a session loaded from a log of
+            the output of this plan, rewritten in terms of the plan output:
+            EditPlan(self.session, mutations + [self.translate(m, frame)])
+            then yields what the log of EditPlan(...) | m would.
+            The events of frame are found by position in their process, the
+            other events (inserted ones, Start/End) are moved to the processes
+            of the plan session.
+        """
+        translated = dict()
+        def event(e):
+            if e in translated:
+                return translated[e]
+            proc = e.proc
+            index = None
+            if proc is not None and frame.processes.get(proc.pid) is proc:
+                try:
+                    index = proc.events.index(e)
+                except ValueError:
+                    pass
+
+            if proc is None:
+                new = self._first if e is frame.events[0] else e
+            elif index is not None:
+                new = self._output_event(proc.pid, index)
+            else:
+                new = Event(e._scribe_event,
+                            self._procs[self._ranks[proc.pid]])
+            translated[e] = new
+            return new
+
+        def where(matcher):
+            [target] = matcher.before.keys()
+            return Location(event(target), 'before')
+
+        if isinstance(mutation, Nop):
+            return mutation
+        if isinstance(mutation, InsertEvent):
+            return InsertEvent(where(mutation.matcher),
+                               map(event, mutation.events))
+        if isinstance(mutation, SetFlags):
+            return SetFlags(where(mutation.matcher), mutation.flags,
+                            mutation.duration, mutation.extra)
+        if isinstance(mutation, Replace):
+            return Replace(dict((event(original), event(new))
+                                for (original, new)
+                                in mutation.replacements.items()))
+        if isinstance(mutation, DeleteEvent):
+            return DeleteEvent(map(event, mutation.events))
+        raise TypeError("Cannot translate mutator: %s" % mutation.__class__)
+
+    def lock_edits(self):
+        """ Returns (removed, added): the resource locks of the session that
+            are not in the plan output, and the ones the plan adds to it.
+        """
+        (removed, added) = ([], [])
+        for (key, slot) in self._slots.iteritems():
+            if key.tag == TAG_RESOURCE_LOCK and slot.body is not key:
+                removed.append(key)
+            for e in slot.before:
+                if e.tag == TAG_RESOURCE_LOCK:
+                    added.append(e)
+            body = slot.body
+            if body is not None and body is not key and \
+               body.tag == TAG_RESOURCE_LOCK:
+                added.append(body)
+        return (removed, added)
+
+    def start(self, env):
+        if env.get('session') is self.session:
+            env['lock_edits'] = self.lock_edits()
+
+    def process_events(self, events):
+        slots = self._slots
+        for e in events:
+            slot = slots.get(e)
+            if slot is None:
+                yield e
+                continue
+            for ee in slot.before:
+                yield ee
+            if slot.body is not None:
+                yield slot.body
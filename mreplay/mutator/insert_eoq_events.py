@@ -4,13 +4,15 @@ import scribe
 import operator
 
 class InsertEoqEvents(Mutator):
+    global_barrier = True
+
     def process_events(self, events):
         proc_eoq = dict()
 
         for e in events:
             proc = e.proc
             if proc is not None:
-                proc_eoq[proc] = e.is_a(scribe.EventQueueEof)
+                proc_eoq[proc] = e.tag == session.TAG_QUEUE_EOF
             yield e
 
         procs = (proc for (proc, has_eoq) in proc_eoq.iteritems()
@@ -3,13 +3,17 @@ from mreplay import session
 import scribe
 
 class InsertPidEvents(Mutator):
+    global_barrier = True
+
     def process_events(self, events):
         current = None
         for e in events:
-            if e.is_a(scribe.EventPid):
+            if e.tag == session.TAG_PID:
                 continue
-            proc = e.proc
-            if proc != current:
-                yield session.Event(scribe.EventPid(proc.pid))
-                current = proc
+            # Compare pids: events translated from another session have
+            # their own Process objects.
+            pid = e.proc.pid if e.proc is not None else None
+            if pid != current:
+                yield session.Event(scribe.EventPid(pid))
+                current = pid
             yield e
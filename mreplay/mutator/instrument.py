@@ -0,0 +1,113 @@
+from mutator import Mutator
+from pipe import Pipe, stages
+import time
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.events_in = 0
+        self.events_out = 0
+        self.self_time = 0.0
+        self.peak_buffered = 0 # events read but not output yet
+
+    def add(self, other):
+        self.events_in += other.events_in
+        self.events_out += other.events_out
+        self.self_time += other.self_time
+        self.peak_buffered = max(self.peak_buffered, other.peak_buffered)
+
+    def __repr__(self):
+        return "<StageStats %s in=%d out=%d time=%.3fs peak=%d>" % \
+                (self.name, self.events_in, self.events_out,
+                 self.self_time, self.peak_buffered)
+
+class _Input:
+    """ Iterates over the input of a stage, counting the events and the time
+        spent producing them.
+    """
+    def __init__(self, events, stats):
+        self.events = iter(events)
+        self.stats = stats
+        self.upstream_time = 0.0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            e = self.events.next()
+        finally:
+            self.upstream_time += time.time() - start
+        self.stats.events_in += 1
+        return e
+
+class Instrumented(Mutator):
+    """ Runs a mutator, recording its StageStats. The self time of the
+        mutator is the time spent in it, minus the time spent in the
+        mutators before it.
+    """
+    def __init__(self, mutator, stats=None):
+        self.mutator = mutator
+        if stats is None:
+            stats = StageStats(mutator.__class__.__name__)
+        self.stats = stats
+
+    @property
+    def global_barrier(self):
+        return self.mutator.global_barrier
+
+    @property
+    def cheap(self):
+        return self.mutator.cheap
+
+    def start(self, env):
+        self.mutator.start(env)
+
+    def process_events(self, events):
+        stats = self.stats
+        source = None
+        if events is not None:
+            events = source = _Input(events, stats)
+        events = iter(self.mutator.process_events(events))
+
+        while True:
+            start = time.time()
+            upstream_time = source.upstream_time if source else 0.0
+            done = False
+            try:
+                e = events.next()
+            except StopIteration:
+                done = True
+            elapsed = time.time() - start
+            if source:
+                elapsed -= source.upstream_time - upstream_time
+            stats.self_time += elapsed
+            if done:
+                return
+
+            stats.events_out += 1
+            buffered = stats.events_in - stats.events_out
+            if buffered > stats.peak_buffered:
+                stats.peak_buffered = buffered
+            yield e
+
+def instrument(m):
+    """ Returns (pipeline, stats): the pipeline m with each stage
+        instrumented, and the StageStats of the stages, in order.
+    """
+    wrapped = [Instrumented(stage) for stage in stages(m)]
+    pipeline = wrapped[0]
+    for stage in wrapped[1:]:
+        pipeline = Pipe(pipeline, stage)
+    return (pipeline, [stage.stats for stage in wrapped])
+
+def format_stats(stats):
+    """ Returns the lines of a table of StageStats """
+    lines = ["%-20s %10s %10s %10s %10s" %
+             ('stage', 'in', 'out', 'self time', 'peak buf')]
+    for s in stats:
+        lines.append("%-20s %10d %10d %9.3fs %10d" %
+                     (s.name, s.events_in, s.events_out, s.self_time,
+                      s.peak_buffered))
+    return lines
@@ -1,6 +1,6 @@
+from mreplay import session
 from mreplay.session import Event
 from mreplay.location import Location, Start, End
-import scribe
 
 class LocationMatcher:
     def __init__(self, matchers):
@@ -33,10 +33,10 @@ class LocationMatcher:
 
     def convert_after_to_end_syscalls(self):
         def after_end_sys(obj):
-            if isinstance(obj, Event) and obj.is_a(scribe.EventSyscallExtra):
-                for next_event in obj.proc.events.after(obj):
-                    if next_event.is_a(scribe.EventSyscallEnd):
-                        return next_event
+            if isinstance(obj, Event) and obj.tag == session.TAG_SYSCALL:
+                end = obj.proc.syscall_end(obj)
+                if end is not None:
+                    return end
             return obj
 
         self.after = dict(map(lambda (k,v): (after_end_sys(k), v), \
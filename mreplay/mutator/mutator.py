@@ -1,6 +1,13 @@
 from mreplay.session import Session
 
 class Mutator:
+    # Whether the mutator needs the whole event stream, rather than the
+    # events of each process separately. See sharded.shard().
+    global_barrier = False
+    # Whether the mutator costs less per event than sending the event to a
+    # worker and back: runs of such mutators are not worth sharding.
+    cheap = False
+
     def process_events(self, events, options={}):
         raise NotImplementedError()
 
@@ -1,6 +1,8 @@
 from mutator import Mutator
 
 class Nop(Mutator):
+    cheap = True
+
     def process_events(self, events):
         for event in events:
             yield event
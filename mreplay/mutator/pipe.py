@@ -13,3 +13,9 @@ class Pipe(Mutator):
         events = self.lmutator.process_events(events)
         events = self.rmutator.process_events(events)
         return events
+
+def stages(m):
+    """ Returns the mutators of a pipeline, in order """
+    if isinstance(m, Pipe):
+        return stages(m.lmutator) + stages(m.rmutator)
+    return [m]
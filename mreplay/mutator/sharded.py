@@ -0,0 +1,173 @@
+from mutator import Mutator
+from pipe import Pipe, stages as pipe_stages
+from mreplay.session import Event
+from array import array
+import multiprocessing
+import scribe
+
+# Per process inputs and chain of the running Sharded mutator. The pool
+# workers are forked once they are set, and inherit them.
+_shards = None
+_chain = None
+
+class Counted:
+    """ Iterates over events, counting them """
+    def __init__(self, events):
+        self.events = iter(events)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        e = self.events.next()
+        self.count += 1
+        return e
+
+def _run_chain(chain, inputs):
+    """ Returns [(number of inputs consumed, output event)] """
+    counted = Counted(inputs)
+    events = counted
+    for m in chain:
+        events = m.process_events(events)
+    return [(counted.count, e) for e in events]
+
+def _run_shard(pid):
+    # Events don't cross processes, only what is needed to rebuild them:
+    # the position of the input events and the bytes of the new ones.
+    inputs = _shards[pid]
+    positions = dict((id(e), i) for (i, e) in enumerate(inputs))
+    outputs = []
+    for (consumed, e) in _run_chain(_chain, inputs):
+        i = positions.get(id(e))
+        if i is not None and inputs[i] is e:
+            outputs.append((consumed, i, None, None))
+        elif isinstance(e._scribe_event, scribe.Event):
+            owner = e.proc.pid if e.proc is not None else None
+            outputs.append((consumed, None, str(e.encode()), owner))
+    return (pid, outputs)
+
+class Sharded(Mutator):
+    """ Runs a chain of mutators on the events of each process separately,
+        in a pool of jobs processes, and merges the outputs back in the
+        order of the input: what a mutator outputs after reading the i-th
+        event of a process goes where that event was.
+        The mutators of the chain must only look at the events of one
+        process at a time (see Mutator.global_barrier). Events without a
+        process go through untouched.
+        The input is collected first, so the whole stream is held in memory,
+        and outputs that are not scribe events are dropped when they come
+        back from the pool.
+    """
+    def __init__(self, mutators, jobs=None):
+        self.mutators = list(mutators)
+        self.jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+
+    def start(self, env):
+        for m in self.mutators:
+            m.start(env)
+
+    def process_events(self, events):
+        order = array('l')  # pid of each input, -1 for events without one
+        unowned = []
+        shards = dict()
+        procs = dict()
+        for e in events:
+            proc = e.proc
+            if proc is None:
+                order.append(-1)
+                unowned.append(e)
+                continue
+            order.append(proc.pid)
+            shards.setdefault(proc.pid, []).append(e)
+            procs[proc.pid] = proc
+
+        if self.jobs <= 1 or len(shards) <= 1:
+            outputs = dict((pid, _run_chain(self.mutators, inputs))
+                           for (pid, inputs) in shards.iteritems())
+        else:
+            outputs = self._run_pool(shards, procs)
+
+        for e in self._merge(order, unowned, outputs):
+            yield e
+
+    def _run_pool(self, shards, procs):
+        global _shards, _chain
+        (_shards, _chain) = (shards, self.mutators)
+        pool = multiprocessing.Pool(min(self.jobs, len(shards)))
+        try:
+            pids = sorted(shards.keys(), key=lambda pid: -len(shards[pid]))
+            outputs = dict()
+            for (pid, shard_outputs) in pool.imap_unordered(_run_shard, pids):
+                inputs = shards[pid]
+                events = []
+                for (consumed, i, raw, owner) in shard_outputs:
+                    if i is not None:
+                        e = inputs[i]
+                    else:
+                        e = Event(scribe.Event.from_bytes(raw),
+                                  procs.get(owner))
+                        e._raw = raw
+                    events.append((consumed, e))
+                outputs[pid] = events
+            pool.close()
+        finally:
+            pool.terminate()
+            (_shards, _chain) = (None, None)
+        return outputs
+
+    def _merge(self, order, unowned, outputs):
+        unowned = iter(unowned)
+        consumed = dict((pid, 0) for pid in outputs)
+        next_output = dict((pid, 0) for pid in outputs)
+
+        def flush(pid, upto):
+            events = outputs[pid]
+            i = next_output[pid]
+            while i < len(events) and events[i][0] <= upto:
+                yield events[i][1]
+                i += 1
+            next_output[pid] = i
+
+        for pid in order:
+            if pid == -1:
+                yield unowned.next()
+                continue
+            consumed[pid] += 1
+            for e in flush(pid, consumed[pid]):
+                yield e
+
+        for pid in sorted(outputs.keys()):
+            for e in flush(pid, float('inf')):
+                yield e
+
+def shard(m, jobs=None):
+    """ Returns the pipeline m with each run of consecutive per process
+        mutators replaced by a Sharded mutator. The global barriers stay in
+        place, and run on the merged stream. Runs made of cheap mutators only
+        (see Mutator.cheap) are left alone: sharding them costs more than
+        running them, and pins the stream in memory.
+    """
+    stages = []
+    run = []
+    def flush_run():
+        if all(stage.cheap for stage in run):
+            stages.extend(run)
+        else:
+            stages.append(Sharded(run, jobs))
+        del run[:]
+
+    for stage in pipe_stages(m):
+        if stage.global_barrier:
+            if run:
+                flush_run()
+            stages.append(stage)
+        else:
+            run.append(stage)
+    if run:
+        flush_run()
+
+    result = stages[0]
+    for stage in stages[1:]:
+        result = Pipe(result, stage)
+    return result
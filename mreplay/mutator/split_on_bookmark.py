@@ -1,16 +1,227 @@
 from mutator import Mutator
+from array import array
+import tempfile
 import scribe
 import mreplay.unistd
+from mreplay import log_index
 
-class SplitOnBookmark(Mutator):
-    def __init__(self, cutoff=0, do_tail=False):
+class _Events:
+    """ Keeps the events that wait for a split in memory. Events are
+        referenced by themselves.
+    """
+    new_list = list
+
+    def next(self, e):
+        """ Returns the reference of e, the next event of the log """
+        return e
+
+    def get(self, ref):
+        """ Returns the event of ref. It is only asked once. """
+        return ref
+
+    def discard(self, ref):
+        """ Same as get(), when the event is not needed """
+        pass
+
+    def close(self):
+        pass
+
+class _BufferEvents(_Events):
+    """ The events are the ones of the log buffer buf, in order. They are
+        referenced by their offset in buf, and decoded again from there
+        when they are needed. The offsets come from the LogIndex of buf
+        when there is one, or from its event headers.
+    """
+    new_list = staticmethod(lambda: array('l'))
+
+    def __init__(self, buf, index=None):
+        self.buf = buf
+        if index is not None:
+            self.headers = ((offset,) for offset in index.offsets)
+        else:
+            self.headers = log_index.scan_headers(buf)
+        self.current = None
+        self.num_decodes = 0
+
+    def next(self, e):
+        offset = self.headers.next()[0]
+        self.current = (offset, e)
+        return offset
+
+    def get(self, offset):
+        if self.current[0] == offset:
+            return self.current[1]
+        self.num_decodes += 1
+        return scribe.EventsFromBuffer(buffer(self.buf, offset)).next()
+
+class _SpilledEvents(_Events):
+    """ Keeps up to max_events events in memory. Past that, the events are
+        written to a temporary file and decoded again when they are needed.
+        References are negative for the events in memory, and are an index
+        of the spilled events otherwise.
+    """
+    new_list = staticmethod(lambda: array('l'))
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.events = dict()
+        self.next_key = 0
+        self.file = None
+        self.dirty = False
+        self.offsets = array('l')
+        self.lengths = array('l')
+        self.num_spills = 0
+
+    def next(self, e):
+        if len(self.events) < self.max_events:
+            self.next_key += 1
+            self.events[self.next_key] = e
+            return -self.next_key
+
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='mreplay-split-')
+        data = e.encode()
+        self.file.seek(0, 2)
+        self.offsets.append(self.file.tell())
+        self.lengths.append(len(data))
+        self.file.write(data)
+        self.dirty = True
+        self.num_spills += 1
+        return len(self.offsets) - 1
+
+    def get(self, ref):
+        if ref < 0:
+            return self.events.pop(-ref)
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+        self.file.seek(self.offsets[ref])
+        return scribe.Event.from_bytes(self.file.read(self.lengths[ref]))
+
+    def discard(self, ref):
+        if ref < 0:
+            del self.events[-ref]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def _events_store(buf, max_pending, index=None):
+    if buf is not None:
+        return _BufferEvents(buf, index)
+    if max_pending is not None:
+        return _SpilledEvents(max_pending)
+    return _Events()
+
+class _Splitter:
+    """ State of a split of a log on a bookmark. add() and finish() yield
+        (is_tail, pid, ref) for the events that go in the head or tail,
+        ref being what was given to add() with the event. The references
+        of the pending events are kept in new_list() lists.
+    """
+    def __init__(self, cutoff, new_list=list):
         self.cutoff = cutoff
-        self.do_tail = do_tail
-        self.do_head = not do_tail
-        self.output_pid = 0
+        self.new_list = new_list
+        self.pending_events = {}
+        self.children = {}
+        self.streaming = {}
+        self.done = {}
+        self.bookmarks_count = 0
+        self.npr = None
         self.stream_tail = False
 
-    # Output event, adding pid if necessary
+    def complete(self):
+        return self.npr == self.bookmarks_count and len(self.streaming) == 0
+
+    def add_child(self, parent, child):
+        if parent not in self.children:
+            self.children[parent] = []
+        self.children[parent].append(child)
+
+    def add_pending(self, pid, ref):
+        if pid not in self.pending_events:
+            self.pending_events[pid] = self.new_list()
+        self.pending_events[pid].append(ref)
+
+    def include_child(self, pid):
+        for ref in self.pending_events.pop(pid, []):
+            yield (False, pid, ref)
+        for c in self.children.get(pid, []):
+            for x in self.include_child(c):
+                yield x
+            if c not in self.done:
+                self.streaming[c] = True
+
+    def add(self, pid, e, ref=None):
+        if ref is None:
+            ref = e
+
+        if self.stream_tail:
+            yield (True, pid, ref)
+            return
+
+        if self.complete():
+            self.add_pending(pid, ref)
+            for (pid_, refs) in self.pending_events.items():
+                for ref_ in refs:
+                    yield (True, pid_, ref_)
+            self.pending_events.clear()
+            self.stream_tail = True
+            return
+
+        if pid in self.done:
+            yield (True, pid, ref)
+            return
+
+        if pid == 0:
+            yield (False, pid, ref)
+            return
+
+        if isinstance(e, scribe.EventBookmark) and \
+                e.id == self.cutoff:
+            self.npr = e.npr
+            self.bookmarks_count += 1
+            for x in self.include_child(pid):
+                yield x
+            yield (False, pid, ref)
+            self.done[pid] = True
+            if pid in self.streaming:
+                del self.streaming[pid]
+            return
+
+        if isinstance(e, scribe.EventSyscallExtra) \
+                and e.nr in mreplay.unistd.SYS_fork \
+                and e.ret > 0:
+            self.add_child(pid, e.ret)
+
+        if pid in self.streaming:
+            yield (False, pid, ref)
+        else:
+            self.add_pending(pid, ref)
+
+        if isinstance(e, scribe.EventQueueEof):
+            # Delete from streaming so that we can count streaming. This
+            # won't affect correctness and is only an optimization because
+            # EOF is the last event for a pid by contract.
+            # Note: the event is already yielded
+            self.done[pid] = True
+            if pid in self.streaming:
+                del self.streaming[pid]
+
+    def finish(self):
+        # Once all the bookmarks are seen, what is pending belongs to the
+        # tail, even when the log ends before the split completes.
+        is_tail = self.npr == self.bookmarks_count
+        for (pid, refs) in self.pending_events.items():
+            for ref in refs:
+                yield (is_tail, pid, ref)
+
+class _Output:
+    """ Adds the pid events of an output """
+    def __init__(self):
+        self.output_pid = 0
+
     def output(self, pid, e):
         # pid 0 only occurs once
         if self.output_pid != pid:
@@ -18,117 +229,150 @@ class SplitOnBookmark(Mutator):
             self.output_pid = pid
         yield e
 
-    def output_head(self, pid, e):
-        if self.do_head:
-            for x in self.output(pid, e):
-                yield x
+class SplitOnBookmark(Mutator):
+    """ Keeps the events before the cutoff bookmark (or after, with
+        do_tail). The events of a process wait until we know on which side
+        they are. When the events come from the log buffer buf, only their
+        offsets wait, and they are decoded again from buf. index is the
+        LogIndex of buf, if any. Otherwise, with max_pending, at most
+        max_pending events wait in memory and the others in a temporary
+        file.
+    """
+    global_barrier = True
 
-    def output_tail(self, pid, e):
-        if self.do_tail:
-            for x in self.output(pid, e):
-                yield x
+    def __init__(self, cutoff=0, do_tail=False, buf=None, max_pending=None,
+                 index=None):
+        self.cutoff = cutoff
+        self.do_tail = do_tail
+        self.do_head = not do_tail
+        self.buf = buf
+        self.max_pending = max_pending
+        self.index = index
 
     def process_events(self, events):
-        pending_events = {}
-        children = {}
-        streaming = {}
-        done = {}
-
+        store = _events_store(self.buf, self.max_pending, self.index)
+        splitter = _Splitter(self.cutoff, store.new_list)
+        out = _Output()
         pid = 0
 
-        bookmarks_count = 0
-        npr = None
+        def output(items):
+            for (is_tail, pid_, ref) in items:
+                if is_tail != self.do_tail:
+                    store.discard(ref)
+                    continue
+                for x in out.output(pid_, store.get(ref)):
+                    yield x
 
-        def add_child(parent, child):
-            if parent not in children:
-                children[parent] = []
-            children[parent].append(child)
+        try:
+            for e in events:
+                ref = store.next(e)
+                if isinstance(e, scribe.EventPid):
+                    pid = e.pid
+                    continue
 
-        def add_pending(pid, event):
-            if pid not in pending_events:
-                pending_events[pid] = []
-            pending_events[pid].append(event)
+                if self.do_head and splitter.complete():
+                    return
 
-        def include_child(pid):
-            for e in pending_events.get(pid, []):
-                for x in self.output_head(pid, e):
+                for x in output(splitter.add(pid, e, ref)):
                     yield x
-            for c in children.get(pid, []):
-                for x in include_child(c):
-                    yield x
-                if c not in done:
-                    streaming[c] = True
-            pending_events[pid] = []
-
-        for e in events:
-            if isinstance(e, scribe.EventPid):
-                pid = e.pid
-                continue
 
-            if self.stream_tail:
-                for x in self.output_tail(pid, e):
-                    yield x
-                continue
+            for x in output(splitter.finish()):
+                yield x
+        finally:
+            store.close()
 
-            if npr == bookmarks_count and len(streaming) == 0:
-                if self.do_head:
-                    return
-                else:
-                    add_pending(pid, e)
-                    for (pid_, events_) in pending_events.items():
-                        for e_ in events_:
-                            for x in self.output_tail(pid_, e_):
-                                yield x
-                    pending_events.clear()
-                    self.stream_tail = True
-                    continue
+class _Undecided:
+    """ The events that some splitters have yet to decide on, numbered in
+        the order of the log. For each one, from the oldest undecided one
+        on: how many splitters are left, the lowest segment so far and its
+        reference in the store. They are kept in arrays rather than in an
+        object per event.
+    """
+    def __init__(self, new_list):
+        self.base = 0   # number of the first event of the arrays
+        self.first = 0  # index of the first undecided event
+        self.left = array('l')
+        self.segments = array('l')
+        self.refs = new_list()
 
-            if pid in done:
-                for x in self.output_tail(pid, e):
-                    yield x
-                continue;
+    def add(self, ref, num_splitters):
+        """ Returns the number of the event """
+        self.left.append(num_splitters)
+        self.segments.append(num_splitters)
+        self.refs.append(ref)
+        return self.base + len(self.left) - 1
 
-            if pid == 0:
-                for x in self.output_head(pid, e):
-                    yield x
-                continue
+    def decide(self, num, segment):
+        """ A splitter puts event num in segment, or after it when segment
+            is None. Returns (segment, ref) once all the splitters decided.
+        """
+        i = num - self.base
+        if segment is not None and segment < self.segments[i]:
+            self.segments[i] = segment
+        self.left[i] -= 1
+        if self.left[i] > 0:
+            return None
+        result = (self.segments[i], self.refs[i])
+        self.refs[i] = 0 # the in memory store references the event itself
+        if i == self.first:
+            self._trim()
+        return result
 
-            if isinstance(e, scribe.EventBookmark) and \
-                    e.id == self.cutoff:
-                npr = e.npr
-                bookmarks_count += 1
-                for x in include_child(pid):
-                    yield x
-                for x in self.output_head(pid, e):
-                    yield x
-                done[pid] = True
-                if pid in streaming:
-                    del streaming[pid]
+    def _trim(self):
+        left = self.left
+        first = self.first
+        while first < len(left) and left[first] == 0:
+            first += 1
+        # The decided events go in one go, once they are half the arrays
+        if first >= 1024 and first * 2 >= len(left):
+            for a in (self.left, self.segments, self.refs):
+                del a[:first]
+            self.base += first
+            first = 0
+        self.first = first
 
-                continue
+def split_on_bookmarks(events, cutoffs, buf=None, max_pending=None,
+                       index=None):
+    """ Splits a log on each of the cutoff bookmarks, in a single pass.
+        Yields (segment, event), segment going from 0 (before the first
+        cutoff) to len(cutoffs) (after the last one): an event is in segment
+        i when it's in the tail of SplitOnBookmark() for the i first cutoffs,
+        and in the head for the next one. Each segment has its pid events.
+        buf, max_pending and index are as in SplitOnBookmark.
+    """
+    store = _events_store(buf, max_pending, index)
+    # The splitters wait on the numbers of the events in undecided
+    new_list = lambda: array('l')
+    splitters = [_Splitter(cutoff, new_list) for cutoff in cutoffs]
+    outputs = [_Output() for i in range(len(cutoffs) + 1)]
+    undecided = _Undecided(store.new_list)
 
-            if isinstance(e, scribe.EventSyscallExtra) \
-                    and e.nr in mreplay.unistd.SYS_fork \
-                    and e.ret > 0:
-                add_child(pid, e.ret)
+    def decide(k, items):
+        for (is_tail, pid, num) in items:
+            decided = undecided.decide(num, None if is_tail else k)
+            if decided is not None:
+                (segment, ref) = decided
+                for x in outputs[segment].output(pid, store.get(ref)):
+                    yield (segment, x)
 
-            if pid in streaming:
-                for x in self.output_head(pid, e):
+    pid = 0
+    try:
+        for e in events:
+            ref = store.next(e)
+            if isinstance(e, scribe.EventPid):
+                pid = e.pid
+                continue
+            if not splitters:
+                for x in outputs[0].output(pid, store.get(ref)):
+                    yield (0, x)
+                continue
+            num = undecided.add(ref, len(splitters))
+            for (k, splitter) in enumerate(splitters):
+                for x in decide(k, splitter.add(pid, e, num)):
                     yield x
-            else:
-                add_pending(pid, e)
-
-            if isinstance(e, scribe.EventQueueEof):
-                # Delete from streaming so that we can count streaming. This
-                # won't affect correctness and is only an optimization because
-                # EOF is the last event for a pid by contract.
-                # Note: the event is already yielded
-                done[pid] = True
-                if pid in streaming:
-                    del streaming[pid]
-
-        if npr != bookmarks_count:
-            for pid in pending_events:
-                for e in pending_events[pid]:
-                    for x in self.output_head(pid, e):
-                        yield x
+
+        for (k, splitter) in enumerate(splitters):
+            for x in decide(k, splitter.finish()):
+                yield x
+    finally:
+        store.close()
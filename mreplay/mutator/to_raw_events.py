@@ -2,6 +2,8 @@ from mutator import Mutator
 import scribe
 
 class ToRawEvents(Mutator):
+    global_barrier = True
+
     def process_events(self, events):
         for event in events:
             scribe_event = event._scribe_event
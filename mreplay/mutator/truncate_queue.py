@@ -2,17 +2,20 @@ from mutator import Mutator
 from location_matcher import LocationMatcher
 
 class TruncateQueue(Mutator):
+    global_barrier = True
+
     def __init__(self, where):
         self.matcher = LocationMatcher(where)
         self.num_procs = -1
         self.last_anchors = None
 
     def start(self, env):
-        graph = env.get('graph')
-        if graph is not None:
-            self.num_procs = len(graph.processes)
-            self.last_anchors = set(map(lambda (p): p.last_anchor,
-                                        graph.processes.values()))
+        session = env.get('session')
+        if session is not None:
+            self.num_procs = len(session.processes)
+            self.last_anchors = set(p.last_anchor
+                                    for p in session.processes.values()
+                                    if p.last_anchor is not None)
 
     def process_events(self, events):
         truncate_procs = set()
@@ -0,0 +1,216 @@
+import scribe
+import execute
+import datetime
+import time
+import logging
+import signal
+import errno
+import traceback
+import multiprocessing
+
+class ReplayOutcomes:
+    SUCCESS = 0
+    DEADLOCK = 1
+    DIVERGE = 2
+    CLOSED = 3
+
+class ReplayContext(scribe.Context):
+    """ The scribe context of a replay. on_mutation(diverge_event, mutations)
+        is called on the fly mutations.
+    """
+    def __init__(self, logfile, on_mutation, **kargs):
+        scribe.Context.__init__(self, logfile, **kargs)
+        self._on_mutation = on_mutation
+        self.start = datetime.datetime.now()
+        self.last = self.start
+
+    def spawn(self):
+        return scribe.Popen(self, replay = True)
+
+    def on_mutation(self, diverge_event, mutations):
+        self._on_mutation(diverge_event, mutations)
+
+    def on_bookmark(self, id, npr):
+        now = datetime.datetime.now()
+        dstart = now - self.start
+        dlast = now - self.last
+        self.last = now
+        print("Reached bmark %d at %d.%ds, +%d.%ds" %
+                (id, dstart.seconds, dstart.microseconds,
+                    dlast.seconds, dlast.microseconds))
+        self.resume()
+
+class ScribeReplay:
+    """ Replays logs. context_class makes the context of each replay, it is
+        ReplayContext unless something stands in for scribe: it takes the
+        log file and the on_mutation callback, and spawn() starts the
+        replay.
+    """
+    def __init__(self, context_class=None):
+        if context_class is None:
+            context_class = ReplayContext
+        self.context_class = context_class
+        self.context = None
+
+    def stop(self):
+        if self.context is not None:
+            self.context.close()
+
+    def run(self, logfile_path, exe, on_mutation):
+        """ Replays the log at logfile_path in exe.
+            on_mutation(diverge_event, mutations) is called on the fly
+            mutations, and returns False to abort the replay.
+            Returns (outcome, diverge event or None).
+        """
+        aborted = [False]
+        def _on_mutation(diverge_event, mutations):
+            if aborted[0]:
+                return
+            if not on_mutation(diverge_event, mutations):
+                aborted[0] = True
+                ps.kill()
+
+        with open(logfile_path, 'r') as logfile:
+            self.context = self.context_class(logfile, _on_mutation,
+                                              backtrace_len = 0)
+            self.context.add_init_loader(lambda argv, envp: exe.prepare())
+            ps = self.context.spawn()
+
+        def do_check_deadlock(signum, stack):
+            try:
+                self.context.check_deadlock()
+            except OSError as e:
+                if e.errno != errno.EPERM:
+                    logging.error("Cannot check for deadlock (%s)" % str(e))
+        signal.signal(signal.SIGALRM, do_check_deadlock)
+        signal.setitimer(signal.ITIMER_REAL, 1, 1)
+
+        result = (ReplayOutcomes.CLOSED, None)
+        try:
+            self.context.wait()
+            result = (ReplayOutcomes.SUCCESS, None)
+        except scribe.DeadlockError:
+            result = (ReplayOutcomes.DEADLOCK, None)
+        except scribe.DivergeError as diverge:
+            result = (ReplayOutcomes.DIVERGE, diverge.event)
+        except scribe.ContextClosedError:
+            pass
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+        ps.wait()
+        self.context.close()
+        self.context = None
+        return result
+
+def _encode(e):
+    if e is None:
+        return None
+    return str(e.encode())
+
+def _decode(raw):
+    if raw is None:
+        return None
+    return scribe.Event.from_bytes(raw)
+
+def _worker_main(conn, isolate, context_class, jail):
+    # Stopping is up to the explorer, with SIGTERM
+    replay = ScribeReplay(context_class)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, stack: replay.stop())
+
+    def on_mutation(diverge_event, mutations):
+        conn.send(('mutation', _encode(diverge_event), map(_encode, mutations)))
+        return conn.recv()
+
+    while True:
+        logfile_path = conn.recv()
+        if logfile_path is None:
+            break
+        try:
+            start = time.time()
+            with execute.open(jailed=isolate, jail=jail) as exe:
+                setup_time = time.time() - start
+                (outcome, diverge_event) = replay.run(logfile_path, exe,
+                                                      on_mutation)
+            conn.send(('done', outcome, _encode(diverge_event), setup_time))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.busy = False
+        self.setup_time = None
+
+class ReplayWorkers:
+    """ jobs processes replaying logs, each in its own jail when isolate is
+        set: the jails of a JailPool of jobs jails when given, a new jail
+        per replay otherwise. The diverge events come back to the caller of
+        wait(), which decides what happens to the replay.
+    """
+    def __init__(self, jobs, isolate=False, context_class=None, jails=None):
+        self.workers = []
+        for i in range(jobs):
+            jail = None
+            if jails is not None:
+                jail = jails.jails[i]
+            (conn, worker_conn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_main,
+                    args=(worker_conn, isolate, context_class, jail))
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            self.workers.append(_Worker(process, conn))
+
+    def submit(self, logfile_path):
+        """ Starts the replay of a log on an idle worker, and returns it """
+        worker = [w for w in self.workers if not w.busy][0]
+        worker.busy = True
+        worker.conn.send(logfile_path)
+        return worker
+
+    def wait(self, worker, on_mutation):
+        """ Waits for the replay of worker to finish, calling
+            on_mutation(diverge_event, mutations) on its on the fly
+            mutations. It returns False to abort the replay.
+            Returns (outcome, diverge event or None), like ScribeReplay.run().
+            The time it took to set up the replay is in worker.setup_time.
+        """
+        worker.setup_time = None
+        try:
+            while True:
+                message = worker.conn.recv()
+                if message[0] == 'mutation':
+                    (diverge_event, mutations) = message[1:]
+                    worker.conn.send(bool(on_mutation(_decode(diverge_event),
+                                                      map(_decode, mutations))))
+                elif message[0] == 'done':
+                    (outcome, diverge_event, worker.setup_time) = message[1:]
+                    return (outcome, _decode(diverge_event))
+                else:
+                    raise RuntimeError("Replay worker failed:\n%s" % message[1])
+        except (EOFError, IOError):
+            # stopped
+            return (ReplayOutcomes.CLOSED, None)
+        finally:
+            worker.busy = False
+
+    def stop(self):
+        """ Stops the replays in progress """
+        for worker in self.workers:
+            if worker.busy:
+                worker.process.terminate()
+
+    def close(self):
+        self.stop()
+        for worker in self.workers:
+            if worker.busy:
+                self.wait(worker, lambda diverge_event, mutations: False)
+            if worker.process.is_alive():
+                worker.conn.send(None)
+            worker.process.join()
+            worker.conn.close()
@@ -1,12 +1,100 @@
 import scribe
 import unistd
-import itertools
+import bisect
+from array import array
+import weakref
+import log_index
+
+# Small integer tags for the event types that are looked at in tight loops.
+# An event gets its tag once, when it is wrapped.
+TAG_OTHER           = 0
+TAG_PID             = 1
+TAG_SYSCALL         = 2
+TAG_SYSCALL_END     = 3
+TAG_DATA            = 4
+TAG_DATA_EXTRA      = 5
+TAG_RESOURCE_LOCK   = 6
+TAG_RESOURCE_UNLOCK = 7
+TAG_MEM_OWNED_READ  = 8
+TAG_MEM_OWNED_WRITE = 9
+TAG_SET_FLAGS       = 10
+TAG_NOP             = 11
+TAG_BOOKMARK        = 12
+TAG_QUEUE_EOF       = 13
+TAG_SIGNAL          = 14
+TAG_RDTSC           = 15
+
+TAGS_MEM_OWNED = frozenset([TAG_MEM_OWNED_READ, TAG_MEM_OWNED_WRITE])
+TAGS_DATA = frozenset([TAG_DATA, TAG_DATA_EXTRA])
+
+# Most derived classes first, so that a subclass gets the most specific tag.
+_TAGGED_TYPES = sorted([
+    (scribe.EventPid,                TAG_PID),
+    (scribe.EventSyscallExtra,       TAG_SYSCALL),
+    (scribe.EventSyscallEnd,         TAG_SYSCALL_END),
+    (scribe.EventData,               TAG_DATA),
+    (scribe.EventDataExtra,          TAG_DATA_EXTRA),
+    (scribe.EventResourceLockExtra,  TAG_RESOURCE_LOCK),
+    (scribe.EventResourceUnlock,     TAG_RESOURCE_UNLOCK),
+    (scribe.EventMemOwnedReadExtra,  TAG_MEM_OWNED_READ),
+    (scribe.EventMemOwnedWriteExtra, TAG_MEM_OWNED_WRITE),
+    (scribe.EventSetFlags,           TAG_SET_FLAGS),
+    (scribe.EventNop,                TAG_NOP),
+    (scribe.EventBookmark,           TAG_BOOKMARK),
+    (scribe.EventQueueEof,           TAG_QUEUE_EOF),
+    (scribe.EventSignal,             TAG_SIGNAL),
+    (scribe.EventRdtsc,              TAG_RDTSC),
+], key=lambda (klass, tag): -len(klass.__mro__))
+
+# is_a() can compare tags for the types no other tagged type derives from.
+_LEAF_TAGS = dict((klass, tag) for (klass, tag) in _TAGGED_TYPES
+                  if not any(other is not klass and issubclass(other, klass)
+                             for (other, _) in _TAGGED_TYPES))
+
+_class_tags = dict()
+
+def type_tag(klass):
+    try:
+        return _class_tags[klass]
+    except KeyError:
+        pass
+    tag = TAG_OTHER
+    if isinstance(klass, type):
+        for (tagged_klass, tagged_tag) in _TAGGED_TYPES:
+            if issubclass(klass, tagged_klass):
+                tag = tagged_tag
+                break
+    _class_tags[klass] = tag
+    return tag
 
 class Event(object):
+    # There are millions of events in a session: no per-instance dict.
+    # Positions in event lists are kept by the lists themselves.
+    # nr, ret, serial, id and address are copies of the scribe event fields,
+    # taken when the event is wrapped, for the types that have them. Events
+    # are not modified once wrapped: mutators copy() and wrap a new event.
+    # That's what makes _raw, the bytes the event was read from, safe to reuse.
+    __slots__ = ('_scribe_event', 'proc', '_syscall', '_resource',
+                 '_ordinal', '_raw', 'tag', 'nr', 'ret', 'serial', 'id',
+                 'address', '__weakref__')
+
     def __init__(self, scribe_event, proc=None):
         self._scribe_event = scribe_event
         self.proc = proc
-        self.owners = dict()
+        self._ordinal = None
+        self._raw = None
+
+        tag = type_tag(scribe_event.__class__)
+        self.tag = tag
+        if tag == TAG_SYSCALL:
+            self.nr = scribe_event.nr
+            self.ret = scribe_event.ret
+        elif tag == TAG_RESOURCE_LOCK:
+            self.id = scribe_event.id
+            self.serial = scribe_event.serial
+        elif tag in TAGS_MEM_OWNED:
+            self.serial = scribe_event.serial
+            self.address = scribe_event.address
 
     def __repr__(self):
         return repr(self._scribe_event)
@@ -32,15 +120,13 @@ class Event(object):
 
     @property
     def children(self):
-        # The children list is generated on the fly.
         # Only a syscall event gets to have some fun
         if self.proc is None:
             raise AttributeError
-        if not self.is_a(scribe.EventSyscallExtra):
+        if self.tag != TAG_SYSCALL:
             return []
-        return itertools.takewhile(
-                lambda e: not e.is_a(scribe.EventSyscallEnd),
-                self.proc.events.after(self))
+        (start, end) = self.proc.syscall_span(self)
+        return self.proc.events[start + 1:end]
 
     @property
     def syscall(self):
@@ -83,15 +169,27 @@ class Event(object):
     def resource(self, value):
         self._resource = value
 
+    def encode(self):
+        """ The bytes the event was read from when it comes from a log, its
+            encoding otherwise.
+        """
+        if self._raw is not None:
+            return self._raw
+        return self._scribe_event.encode()
+
     # Proxying attributes getters to the scribe event instance
     def __getattr__(self, name):
         return getattr(self._scribe_event, name)
     def is_a(self, klass):
+        tag = _LEAF_TAGS.get(klass)
+        if tag is not None:
+            return self.tag == tag
         return isinstance(self._scribe_event, klass)
 
 class EventList:
     def __init__(self):
         self._events = list()
+        self._indices = dict()
 
     def __iter__(self):
         return iter(self._events)
@@ -103,7 +201,7 @@ class EventList:
         return self._events[index]
 
     def append(self, e):
-        e.owners[self] = len(self._events)
+        self._indices[e] = len(self._events)
         self._events.append(e)
 
     def extend(self, el):
@@ -112,7 +210,7 @@ class EventList:
 
     def index(self, e):
         try:
-            return e.owners[self]
+            return self._indices[e]
         except KeyError:
             raise ValueError('event not in list')
 
@@ -131,8 +229,43 @@ class EventList:
     def _indices_have_changed(self):
         # Called when the event list has been re-ordered, and the indices
         # need to be reset
-        for i in xrange(0, len(self._events)):
-            self._events[i].owners[self] = i
+        self._indices = dict((e, i) for (i, e) in enumerate(self._events))
+
+class LazyEventList:
+    """ A read-only EventList over a LazySession. Only the ordinals of the
+        events are kept, the events are wrapped when accessed.
+    """
+    def __init__(self, session, ordinals):
+        self._session = session
+        self._ordinals = ordinals
+
+    def __iter__(self):
+        event = self._session._event
+        return (event(ordinal) for ordinal in self._ordinals)
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self._session._event(self._ordinals[index])
+
+    def index(self, e):
+        ordinal = getattr(e, '_ordinal', None)
+        if ordinal is not None and self._session._cache.get(ordinal) is e:
+            i = bisect.bisect_left(self._ordinals, ordinal)
+            if i < len(self._ordinals) and self._ordinals[i] == ordinal:
+                return i
+        raise ValueError('event not in list')
+
+    def after(self, e):
+        i = self.index(e)
+        return (self[j] for j in xrange(i + 1, len(self)))
+
+    def before(self, e):
+        i = self.index(e)
+        return (self[j] for j in xrange(i - 1, -1, -1))
 
 class Process:
     def __init__(self, pid, name=None):
@@ -141,10 +274,44 @@ class Process:
         self.events = EventList()
         self.syscalls = EventList()
 
+        # Event indices of each syscall and of its EventSyscallEnd (-1 when
+        # the syscall never ends), in the same order as syscalls.
+        self.syscall_starts = array('l')
+        self.syscall_ends = array('l')
+
+        # Process tree, see Session._build_process_tree()
+        self.parent = None
+        self.children = []
+        self.fork_syscall = None  # in the parent
+        self.exit_syscall = None
+        self.first_anchor = None
+        self.last_anchor = None
+
         # State for add_event()
         self.current_syscall = None
+        self._open_syscalls = []
+        self._forks = []
+
+    def syscall_span(self, syscall):
+        """ Returns the [start, end) event indices of a syscall: start is
+            the syscall event, end is its EventSyscallEnd.
+        """
+        i = syscall.syscall_index
+        end = self.syscall_ends[i]
+        if end == -1:
+            end = len(self.events)
+        return (self.syscall_starts[i], end)
+
+    def syscall_end(self, syscall):
+        """ Returns the EventSyscallEnd of a syscall, None if it never ends
+        """
+        end = self.syscall_ends[syscall.syscall_index]
+        if end == -1:
+            return None
+        return self.events[end]
 
     def add_event(self, e):
+        index = len(self.events)
         self.events.append(e)
         e.proc = self
 
@@ -154,7 +321,7 @@ class Process:
             if syscall.ret < 0:
                 return
             for e in syscall.children:
-                if not e.is_a(scribe.EventDataExtra):
+                if e.tag != TAG_DATA_EXTRA:
                     continue
                 if e.data_type != scribe.SCRIBE_DATA_INPUT | \
                                   scribe.SCRIBE_DATA_STRING:
@@ -162,14 +329,26 @@ class Process:
                 self.name = e.data
                 break
 
-        if e.is_a(scribe.EventSyscallExtra):
+        tag = e.tag
+        if tag == TAG_SYSCALL:
             self.syscalls.append(e)
+            self.syscall_starts.append(index)
+            self.syscall_ends.append(-1)
+            self._open_syscalls.append(len(self.syscall_ends) - 1)
             self.current_syscall = e
+            if e.nr in unistd.SYS_fork and e.ret > 0:
+                self._forks.append(e)
+            elif e.nr in unistd.SYS_exit:
+                self.exit_syscall = e
 
         if self.current_syscall is not None:
             e.syscall = self.current_syscall
 
-        if e.is_a(scribe.EventSyscallEnd):
+        if tag == TAG_SYSCALL_END:
+            # A syscall body ends at the first EventSyscallEnd
+            for i in self._open_syscalls:
+                self.syscall_ends[i] = index
+            self._open_syscalls = []
             check_execve(self.current_syscall)
             self.current_syscall = None
 
@@ -182,14 +361,44 @@ class Process:
                     self.name if self.name else "??",
                     len(self.events))
 
+def events_from_buffer(buf):
+    """ Same as scribe.EventsFromBuffer(), but the events are wrapped and
+        keep the bytes they were read from, as a buffer of buf.
+    """
+    for (offset, length, e) in log_index.scan_events(buf):
+        event = Event(e)
+        event._raw = buffer(buf, offset, length)
+        yield event
+
+class Resource:
+    def __init__(self, id):
+        self.id = id
+        self.events = EventList() # locks and unlocks, in serial order
+
+    @property
+    def locks(self):
+        return [e for e in self.events if e.tag == TAG_RESOURCE_LOCK]
+
+    def __repr__(self):
+        return "<Resource id=%d events=%d>" % (self.id, len(self.events))
+
 class Session:
     def __init__(self, events):
         self.processes = dict()
-        self.resources = dict()
         self.events = list()
         self._current_proc = None # State for add_event()
+        self._init_indexes()
 
         self._add_events(events)
+        self._build_process_tree()
+
+    def _init_indexes(self):
+        # Inverted indexes, built on first use
+        self._resources = None
+        self._resource_orphans = None
+        self._mem_owned = None
+        self._syscalls_by_nr = None
+        self._lock_serials = None
 
     def _add_events(self, events):
         for e in events:
@@ -205,7 +414,7 @@ class Session:
 
         self.events.append(e)
 
-        if e.is_a(scribe.EventPid):
+        if e.tag == TAG_PID:
             if e.pid not in self.processes:
                 self.processes[e.pid] = Process(pid=e.pid)
 
@@ -215,6 +424,209 @@ class Session:
         if self._current_proc:
             self._current_proc.add_event(e)
 
+    def _build_process_tree(self):
+        # The forks and exits are collected while the events are added
+        for proc in self.processes.values():
+            for fork in proc._forks:
+                child = self.processes.get(fork.ret)
+                if child is None:
+                    continue
+                child.parent = proc
+                child.fork_syscall = fork
+                proc.children.append(child)
+            if len(proc.events) > 0:
+                proc.first_anchor = proc.events[0]
+                proc.last_anchor = proc.events[-1]
+
     @property
     def init_proc(self):
         return self.processes[1]
+
+    @property
+    def root_processes(self):
+        """ The processes that were not forked during the recording """
+        return [p for p in self.processes.values() if p.parent is None]
+
+    @property
+    def resources(self):
+        """ Resource id -> Resource """
+        if self._resources is None:
+            self._index_resources()
+        return self._resources
+
+    def resource_orphans(self, pid):
+        """ Returns the event indices of the resource locks of a process
+            that happen outside of a syscall (signals, page faults, ...)
+        """
+        if self._resource_orphans is None:
+            self._resource_orphans = self._index_resource_orphans()
+        return self._resource_orphans.get(pid, [])
+
+    def mem_owned_events(self, address):
+        """ Returns the memory ownership events of an address, in serial
+            order.
+        """
+        if self._mem_owned is None:
+            self._index_resources()
+        return self._mem_owned.get(address, [])
+
+    def syscall_positions(self, nr):
+        """ Returns pid -> indices in proc.syscalls of the syscalls nr """
+        if self._syscalls_by_nr is None:
+            by_nr = dict()
+            for proc in self.processes.values():
+                for (i, e) in enumerate(proc.syscalls):
+                    by_nr.setdefault(e.nr, dict()) \
+                         .setdefault(proc.pid, array('l')).append(i)
+            self._syscalls_by_nr = by_nr
+        return self._syscalls_by_nr.get(nr, {})
+
+    def lock_serials(self):
+        """ Returns resource id -> sorted array of the serials of its locks """
+        if self._lock_serials is None:
+            self._lock_serials = self._index_lock_serials()
+        return self._lock_serials
+
+    def _index_lock_serials(self):
+        serials = dict()
+        for resource in self.resources.values():
+            serials[resource.id] = array('l', (e.serial for e in resource.locks))
+        return serials
+
+    def _index_resource_orphans(self):
+        orphans = dict()
+        for proc in self.processes.values():
+            orphans[proc.pid] = array('l',
+                    (i for (i, e) in enumerate(proc.events)
+                     if e.tag == TAG_RESOURCE_LOCK and not e.has_syscall()))
+        return orphans
+
+    def _index_resources(self):
+        resources = dict()
+        mem_owned = dict()
+        sort_keys = dict()
+
+        for proc in self.processes.values():
+            locks = []
+            for e in proc.events:
+                tag = e.tag
+                if tag == TAG_RESOURCE_LOCK:
+                    resource = resources.get(e.id)
+                    if resource is None:
+                        resource = resources[e.id] = Resource(e.id)
+                    e.resource = resource
+                    resource.events.append(e)
+                    sort_keys[e] = (e.serial, 0)
+                    locks.append(e)
+                elif tag == TAG_RESOURCE_UNLOCK and locks:
+                    # Locks are nested, the unlock goes with the last lock
+                    lock = locks.pop()
+                    e.resource = lock.resource
+                    lock.resource.events.append(e)
+                    sort_keys[e] = (lock.serial, 1)
+                elif tag in TAGS_MEM_OWNED:
+                    mem_owned.setdefault(e.address, []).append(e)
+
+        for resource in resources.values():
+            resource.events.sort(key=sort_keys.get)
+        for events in mem_owned.values():
+            events.sort(key=lambda e: e.serial)
+
+        self._resources = resources
+        self._mem_owned = mem_owned
+
+class LazySession(Session):
+    """ A Session over a log buffer that does not keep any event around.
+        A single pass over the log builds a LogIndex, and events are only
+        decoded and wrapped when something looks at them. Wrapped events are
+        cached as long as someone holds a reference on them, so the identity
+        of an event is stable.
+    """
+    def __init__(self, buf, index=None):
+        if index is None:
+            index = log_index.build_index(buf)
+
+        self._buffer = buf
+        self._index = index
+        self._cache = weakref.WeakValueDictionary()
+
+        self.processes = dict()
+        self.events = LazyEventList(self, xrange(len(index)))
+        self._init_indexes()
+
+        for pid in index.proc_events:
+            proc = Process(pid=pid, name=index.proc_names.get(pid))
+            proc.events = LazyEventList(self, index.proc_events[pid])
+            proc.syscalls = LazyEventList(self, index.proc_syscalls[pid])
+            proc.syscall_starts = index.proc_syscall_starts[pid]
+            proc.syscall_ends = index.proc_syscall_ends[pid]
+            proc._forks = [proc.events[i] for i in index.proc_forks[pid]]
+            if pid in index.proc_exits:
+                proc.exit_syscall = proc.events[index.proc_exits[pid]]
+            self.processes[pid] = proc
+
+        self._build_process_tree()
+
+    @property
+    def log_index(self):
+        return self._index
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    def byte_range(self, e):
+        """ Returns (offset, length) of e in the log buffer, or None when e
+            is not one of the events of the session.
+        """
+        ordinal = e._ordinal
+        if ordinal is None or self._cache.get(ordinal) is not e:
+            return None
+        index = self._index
+        return (index.offsets[ordinal], index.lengths[ordinal])
+
+    def _index_resource_orphans(self):
+        # Straight from the log index, nothing gets decoded
+        index = self._index
+        lock_type = scribe.EventResourceLockExtra.native_type
+        orphans = dict()
+        for (pid, ordinals) in index.proc_events.iteritems():
+            orphans[pid] = array('l',
+                    (i for (i, o) in enumerate(ordinals)
+                     if index.types[o] == lock_type and
+                        index.syscalls[o] == -1))
+        return orphans
+
+    def _index_lock_serials(self):
+        # Only the locks get decoded, and they are not kept around
+        index = self._index
+        lock_type = scribe.EventResourceLockExtra.native_type
+        serials = dict()
+        for (o, type) in enumerate(index.types):
+            if type == lock_type:
+                e = self.events[o]
+                serials.setdefault(e.id, []).append(e.serial)
+        for (id, id_serials) in serials.items():
+            serials[id] = array('l', sorted(id_serials))
+        return serials
+
+    def _event(self, ordinal):
+        e = self._cache.get(ordinal)
+        if e is not None:
+            return e
+
+        index = self._index
+        offset = index.offsets[ordinal]
+        raw = self._buffer[offset:offset + index.lengths[ordinal]]
+        e = Event(scribe.Event.from_bytes(raw),
+                  self.processes.get(index.pids[ordinal]))
+        e._ordinal = ordinal
+        e._raw = raw
+        self._cache[ordinal] = e
+
+        syscall = index.syscalls[ordinal]
+        if syscall == ordinal:
+            e.syscall = e
+        elif syscall != -1:
+            e.syscall = self._event(syscall)
+        return e
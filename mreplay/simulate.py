@@ -0,0 +1,231 @@
+import struct
+import scribe
+from session import type_tag, TAG_SYSCALL, TAG_SYSCALL_END, TAG_SET_FLAGS, \
+                    TAG_NOP, TAGS_DATA, TAGS_MEM_OWNED, TAG_MEM_OWNED_WRITE
+
+class SimulatedDivergeError(scribe.DivergeError):
+    def __init__(self, event):
+        self.event = event
+
+class _Divergence:
+    """ What a replayed process diverged on. on_the_fly() is how the
+        replay goes on after an on the fly mutation: it returns True when
+        the log event must be replayed again. Divergences without it are
+        always fatal. The culprit, and num_ev_consumed, follow what
+        DivergeHandler.extract_culprit() expects from scribe.
+    """
+    def __init__(self, klass, num_ev_consumed, on_the_fly=None,
+                 mutations=(), **fields):
+        self.klass = klass
+        self.num_ev_consumed = num_ev_consumed
+        self.on_the_fly = on_the_fly
+        self.mutations = list(mutations)
+        self.fields = fields
+
+    def event(self, pid, fatal):
+        num_ev_consumed = self.num_ev_consumed
+        if not fatal and self.klass in (scribe.EventDivergeSyscall,
+                                        scribe.EventDivergeMemOwned):
+            num_ev_consumed -= 1
+        return self.klass(pid=pid, fatal=fatal,
+                          num_ev_consumed=num_ev_consumed, **self.fields)
+
+class _Process:
+    """ Replays the log events of a process against the events of the same
+        process in the target. The target is what the process does: a
+        syscall that the log ignores (SetFlags until the next syscall) is
+        executed, and taken out of the target.
+    """
+    def __init__(self, pid, target):
+        self.pid = pid
+        self.target = target
+        self.next = 0           # in target
+        self.num_consumed = 0   # log events of the process
+        self.ignore_syscall = False
+
+    def target_tag(self):
+        if self.next >= len(self.target):
+            return None
+        return type_tag(self.target[self.next].__class__)
+
+    def execute_syscall(self):
+        while self.next < len(self.target):
+            tag = self.target_tag()
+            self.next += 1
+            if tag == TAG_SYSCALL_END:
+                break
+
+    def target_syscall(self):
+        events = []
+        for e in self.target[self.next:]:
+            events.append(e)
+            if type_tag(e.__class__) == TAG_SYSCALL_END:
+                break
+        return events
+
+    def replay(self, e):
+        """ Returns a _Divergence, or None when e is what the process does """
+        index = self.num_consumed
+        self.num_consumed += 1
+
+        tag = type_tag(e.__class__)
+        if tag == TAG_SET_FLAGS:
+            if e.duration == scribe.SCRIBE_UNTIL_NEXT_SYSCALL:
+                self.ignore_syscall = True
+            return None
+        if tag == TAG_NOP:
+            return None
+
+        if self.ignore_syscall and self.target_tag() == TAG_SYSCALL:
+            self.ignore_syscall = False
+            self.execute_syscall()
+
+        target_tag = self.target_tag()
+        if target_tag is None:
+            # The process is gone
+            return _Divergence(scribe.EventDivergeEventType, index + 1,
+                               type=scribe.EventQueueEof.native_type)
+        t = self.target[self.next]
+
+        if target_tag != tag:
+            if target_tag in TAGS_MEM_OWNED or tag in TAGS_MEM_OWNED:
+                m = t if target_tag in TAGS_MEM_OWNED else e
+                write_access = type_tag(m.__class__) == TAG_MEM_OWNED_WRITE
+                return _Divergence(scribe.EventDivergeMemOwned, index + 1,
+                                   address=m.address,
+                                   write_access=int(write_access))
+            return _Divergence(scribe.EventDivergeEventType, index + 1,
+                               type=t.native_type)
+
+        if tag == TAG_SYSCALL:
+            if e.nr != t.nr:
+                def on_the_fly():
+                    self.num_consumed -= 1
+                    self.execute_syscall()
+                    return True
+                num_args = len(t.args) / struct.calcsize('L')
+                return _Divergence(scribe.EventDivergeSyscall, index + 1,
+                                   on_the_fly, self.target_syscall(),
+                                   nr=t.nr, args=t.args, num_args=num_args)
+            if e.ret != t.ret:
+                def on_the_fly():
+                    self.next += 1
+                    return False
+                return _Divergence(scribe.EventDivergeSyscallRet, index + 1,
+                                   on_the_fly, self.target_syscall(),
+                                   nr=t.nr, ret=t.ret, args=t.args)
+        elif tag in TAGS_DATA:
+            if e.data != t.data:
+                def on_the_fly():
+                    self.next += 1
+                    return False
+                return _Divergence(scribe.EventDivergeDataContent, index,
+                                   on_the_fly, [t],
+                                   data=t.data, size=len(t.data))
+        elif tag in TAGS_MEM_OWNED:
+            if e.address != t.address:
+                return _Divergence(scribe.EventDivergeMemOwned, index + 1,
+                                   address=t.address,
+                                   write_access=int(tag == TAG_MEM_OWNED_WRITE))
+
+        self.next += 1
+        return None
+
+class SimulatedProcess:
+    def __init__(self, context):
+        self.context = context
+
+    def wait(self):
+        pass
+
+    def kill(self):
+        self.context.closed = True
+
+class SimulatedContext:
+    """ The replay of a log by a SimulatedBackend """
+    def __init__(self, backend, logfile, on_mutation):
+        self.backend = backend
+        self.on_mutation = on_mutation
+        self.events = list(scribe.EventsFromBuffer(logfile.read()))
+        self.closed = False
+
+    def add_init_loader(self, loader):
+        # Nothing gets executed
+        pass
+
+    def spawn(self):
+        return SimulatedProcess(self)
+
+    def check_deadlock(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def wait(self):
+        backend = self.backend
+        backend.num_replays += 1
+        on_the_fly = False
+        processes = dict()
+        process = None
+        for e in self.events:
+            if isinstance(e, scribe.EventPid):
+                process = processes.get(e.pid)
+                if process is None:
+                    process = processes[e.pid] = \
+                        _Process(e.pid, backend.target.get(e.pid, []))
+                continue
+            if isinstance(e, scribe.EventSetFlags) and \
+                    e.duration == scribe.SCRIBE_PERMANANT:
+                # The replay flags, in the init events or at the start of
+                # the init process (see SetFlagsInit)
+                on_the_fly = not (e.flags & scribe.SCRIBE_PS_STRICT_REPLAY)
+            if process is None:
+                continue
+
+            backend.num_events += 1
+            while True:
+                if self.closed:
+                    raise scribe.ContextClosedError()
+                divergence = process.replay(e)
+                if divergence is None:
+                    break
+                if not on_the_fly or divergence.on_the_fly is None:
+                    backend.num_diverged += 1
+                    raise SimulatedDivergeError(
+                            divergence.event(process.pid, 1))
+                backend.num_mutations += 1
+                self.on_mutation(divergence.event(process.pid, 0),
+                                 divergence.mutations)
+                if self.closed:
+                    raise scribe.ContextClosedError()
+                if not divergence.on_the_fly():
+                    break
+
+class SimulatedBackend:
+    """ Stands in for scribe when replaying (see ScribeReplay): the logs are
+        compared with the target, a recording of what the program really
+        does, and a replay diverges like scribe would, on the fly or not
+        depending on the flags of the log. Nothing is executed.
+        This is how the search can run and be measured without a scribe
+        kernel.
+    """
+    def __init__(self, target_events):
+        self.target = dict() # pid -> events
+        pid = 0
+        for e in target_events:
+            if isinstance(e, scribe.EventPid):
+                pid = e.pid
+            elif pid != 0:
+                self.target.setdefault(pid, []).append(e)
+
+        self.num_replays = 0
+        self.num_events = 0
+        self.num_mutations = 0
+        self.num_diverged = 0
+
+    def __call__(self, logfile, on_mutation, **kargs):
+        return SimulatedContext(self, logfile, on_mutation)
@@ -0,0 +1,209 @@
+import os
+import shutil
+import tempfile
+import resource
+import itertools
+import collections
+from array import array
+import log_index
+from session import LazySession
+
+def peak_rss():
+    """ Peak resident set size of the current process, in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class SpillStore:
+    """ Keeps the chunks of ChunkedArrays in memory up to memory_cap bytes.
+        Above that, the least recently used full chunks are written to a
+        temporary directory and dropped from memory. They are read back
+        when accessed. The last chunk of each array is always resident
+        since it is where appends go.
+    """
+    def __init__(self, memory_cap, directory=None):
+        self.memory_cap = memory_cap
+        self.directory = directory
+        self._own_directory = False
+        self._resident = collections.OrderedDict() # LRU first
+        self._last_used = None
+        self._ids = itertools.count()
+
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        self.num_spills = 0
+        self.num_loads = 0
+
+    def _path(self, chunk):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='mreplay-spill-')
+            self._own_directory = True
+        return os.path.join(self.directory, str(chunk.id))
+
+    def add(self, chunk):
+        chunk.id = self._ids.next()
+        self._resident[chunk] = True
+        self._last_used = chunk
+
+    def grow(self, chunk, nbytes):
+        self.resident_bytes += nbytes
+        if self.resident_bytes > self.peak_resident_bytes:
+            self.peak_resident_bytes = self.resident_bytes
+        if self.resident_bytes > self.memory_cap:
+            self._enforce_cap(chunk)
+
+    def touch(self, chunk):
+        # Called on every access, most of the time on the same chunk
+        if chunk is not self._last_used:
+            del self._resident[chunk]
+            self._resident[chunk] = True
+            self._last_used = chunk
+
+    def load(self, chunk):
+        data = array(chunk.typecode)
+        with open(self._path(chunk), 'rb') as f:
+            data.fromfile(f, chunk.length)
+        chunk.data = data
+        self.num_loads += 1
+        self._resident[chunk] = True
+        self._last_used = chunk
+        self.grow(chunk, chunk.nbytes)
+        return data
+
+    def _enforce_cap(self, keep):
+        while self.resident_bytes > self.memory_cap:
+            for chunk in self._resident:
+                if chunk.sealed and chunk is not keep:
+                    break
+            else:
+                return
+            self._spill(chunk)
+
+    def _spill(self, chunk):
+        if chunk.dirty:
+            with open(self._path(chunk), 'wb') as f:
+                chunk.data.tofile(f)
+            chunk.dirty = False
+        del self._resident[chunk]
+        self.resident_bytes -= chunk.nbytes
+        chunk.data = None
+        self.num_spills += 1
+
+    def close(self):
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self._own_directory = False
+
+    def __del__(self):
+        self.close()
+
+class _Chunk(object):
+    __slots__ = ('id', 'typecode', 'itemsize', 'length', 'data', 'dirty',
+                 'sealed')
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.length = 0
+        self.data = array(typecode)
+        self.dirty = True
+        self.sealed = False
+
+    @property
+    def nbytes(self):
+        return self.length * self.itemsize
+
+class ChunkedArray:
+    """ An array split in fixed size chunks that live in a SpillStore """
+    def __init__(self, store, typecode, chunk_size=1 << 16):
+        self.typecode = typecode
+        self._store = store
+        self._chunk_size = chunk_size
+        self._chunks = []
+        self._length = 0
+
+    def _data(self, chunk):
+        data = chunk.data
+        if data is None:
+            return self._store.load(chunk)
+        self._store.touch(chunk)
+        return data
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('array index out of range')
+        (c, j) = divmod(i, self._chunk_size)
+        return self._data(self._chunks[c])[j]
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('array assignment index out of range')
+        (c, j) = divmod(i, self._chunk_size)
+        chunk = self._chunks[c]
+        self._data(chunk)[j] = value
+        chunk.dirty = True
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for value in self._data(chunk):
+                yield value
+
+    def append(self, value):
+        if not self._chunks or self._chunks[-1].length == self._chunk_size:
+            if self._chunks:
+                self._chunks[-1].sealed = True
+            chunk = _Chunk(self.typecode)
+            self._chunks.append(chunk)
+            self._store.add(chunk)
+        chunk = self._chunks[-1]
+        self._data(chunk).append(value)
+        chunk.length += 1
+        chunk.dirty = True
+        self._length += 1
+        self._store.grow(chunk, chunk.itemsize)
+
+class StreamingSession(LazySession):
+    """ A LazySession for recordings that don't fit in memory.
+        The log index lives in ChunkedArrays: at most memory_cap bytes of it
+        stay resident, cold chunks (typically the event arrays of processes
+        nobody is looking at) are spilled to disk. On top of the weak event
+        cache, the last `window` events that were accessed are kept alive.
+        By default chunks are small enough for a few hundreds of them to fit
+        under the cap, so that looking up an event doesn't spill the chunks
+        the previous lookup needed.
+    """
+    def __init__(self, buf, memory_cap=64 << 20, window=4096,
+                 spill_dir=None, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = min(1 << 16, max(1 << 10, memory_cap >> 11))
+        self.store = SpillStore(memory_cap, spill_dir)
+        self._window = collections.deque(maxlen=window)
+
+        def new_array(typecode):
+            return ChunkedArray(self.store, typecode, chunk_size)
+
+        LazySession.__init__(self, buf, log_index.build_index(buf, new_array))
+
+    def _event(self, ordinal):
+        e = LazySession._event(self, ordinal)
+        self._window.append(e)
+        return e
+
+    def close(self):
+        self._window.clear()
+        self.store.close()
+
+    def stats(self):
+        return {
+            'resident_bytes':      self.store.resident_bytes,
+            'peak_resident_bytes': self.store.peak_resident_bytes,
+            'spills':              self.store.num_spills,
+            'loads':               self.store.num_loads,
+            'peak_rss':            peak_rss(),
+        }
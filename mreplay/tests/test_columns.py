@@ -0,0 +1,50 @@
+from nose.tools import *
+from mreplay.session import *
+from mreplay.columns import *
+from mreplay.unistd import *
+
+events = [ scribe.EventInit(),                                # 0
+           scribe.EventPid(pid=1),                            # 1
+           scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+           scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+           scribe.EventResourceUnlock(),                      # 4
+           scribe.EventSyscallEnd(),                          # 5
+           scribe.EventRdtsc(),                               # 6
+           scribe.EventPid(pid=2),                            # 7
+           scribe.EventSyscallExtra(nr=NR_read, ret=3),       # 8
+           scribe.EventResourceLockExtra(id=3, serial=1),     # 9
+           scribe.EventResourceLockExtra(id=4, serial=0),     # 10
+           scribe.EventResourceUnlock(),                      # 11
+           scribe.EventResourceUnlock(),                      # 12
+           scribe.EventSyscallEnd(),                          # 13
+           scribe.EventSyscallExtra(nr=NR_write, ret=3),      # 14
+           scribe.EventSyscallEnd() ]                         # 15
+
+def check_columns(session):
+    columns = EventColumns(session)
+    assert_equal(len(columns), len(events))
+
+    e = columns.events
+    assert_equal(list(e['pid']), [-1, -1, 1, 1, 1, 1, 1, -1] + [2] * 8)
+    assert_equal(list(e['type']), [ev.native_type for ev in events])
+    offsets = [0]
+    for ev in events[:-1]:
+        offsets.append(offsets[-1] + len(ev.encode()))
+    assert_equal(list(e['offset']), offsets)
+    assert_equal(e['nr'][14], NR_write)
+    assert_equal(e['ret'][8], 3)
+    assert_equal(e['nr'][3], -1)
+    assert_equal(list(e['resource'][9:13]), [3, 4, 4, 3])
+    assert_equal(list(e['serial'][9:13]), [1, 0, 0, 1])
+
+    assert_equal(columns.syscall_counts(),
+                 {(1, NR_read): 1, (2, NR_read): 1, (2, NR_write): 1})
+    assert_equal(list(columns.rdtsc()), [6])
+    assert_equal(list(columns.rdtsc(pid=2)), [])
+    assert_equal(list(columns.select(scribe.EventSyscallExtra, pid=2)),
+                 [8, 14])
+    assert_equal(columns.hottest_resources(1), [(3, 2)])
+
+def test_event_columns():
+    yield check_columns, Session(events)
+    yield check_columns, LazySession(''.join(map(lambda e: e.encode(), events)))
@@ -0,0 +1,61 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+from mreplay import execute
+from mreplay.execute import JailPool, ReusedJail
+from distutils.spawn import find_executable
+import os
+
+class FakeJail:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.mounted = False
+        self.dirty = False
+        self.num_resets = 0
+
+    def reset(self):
+        self.num_resets += 1
+        self.dirty = False
+
+    def open(self):
+        if self.fail:
+            raise OSError('mount failed')
+        self.mounted = True
+
+    def close(self):
+        self.mounted = False
+
+def test_jail_pool_open_failure():
+    pool = JailPool(0)
+    pool.jails = [FakeJail(), FakeJail(), FakeJail(fail=True), FakeJail()]
+    assert_raises(OSError, pool.open)
+    assert_false(any(jail.mounted for jail in pool.jails))
+
+    pool.jails = [FakeJail(), FakeJail()]
+    with pool:
+        assert_true(all(jail.mounted for jail in pool.jails))
+    assert_false(any(jail.mounted for jail in pool.jails))
+
+def test_reused_jail():
+    # Only a jail that was used gets reset
+    jail = FakeJail()
+    for i in range(3):
+        with ReusedJail(jail) as j:
+            assert_true(j is jail)
+    assert_equal(jail.num_resets, 2)
+
+def test_jail_reset():
+    if os.geteuid() != 0 or not find_executable('unionfs-fuse'):
+        raise SkipTest('needs root and unionfs-fuse')
+    with JailPool(1) as pool:
+        jail = pool.jails[0]
+        with execute.open(jail=jail) as exe:
+            assert_equal(exe.execute(['sh', '-c', 'echo x > /leftover; '
+                                                  'sleep 1000 &']), 0)
+            assert_equal(exe.execute(['test', '-e', '/leftover']), 0)
+            assert_not_equal(jail.processes(), [])
+        # Nothing of the previous execution is left in the next one
+        with execute.open(jail=jail) as exe:
+            assert_equal(jail.processes(), [])
+            assert_not_equal(exe.execute(['test', '-e', '/leftover']), 0)
+            assert_false(os.path.exists(os.path.join(jail.chroot,
+                                                     'leftover')))
@@ -0,0 +1,279 @@
+from nose.tools import *
+from mreplay.explorer import *
+from mreplay.location import Location
+from mreplay import log_index
+from mreplay.unistd import *
+import tempfile
+import logging
+import random
+import time
+
+events = [ scribe.EventInit(),                                # 0
+           scribe.EventPid(pid=1),                            # 1
+           scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+           scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+           scribe.EventResourceUnlock(),                      # 4
+           scribe.EventSyscallEnd(),                          # 5
+           scribe.EventSyscallExtra(nr=NR_write, ret=1),      # 6
+           scribe.EventSyscallEnd(),                          # 7
+           scribe.EventPid(pid=2),                            # 8
+           scribe.EventSyscallExtra(nr=NR_read, ret=3),       # 9
+           scribe.EventResourceLockExtra(id=3, serial=1),     # 10
+           scribe.EventResourceUnlock(),                      # 11
+           scribe.EventSyscallEnd(),                          # 12
+           scribe.EventRdtsc() ]                              # 13
+
+class TempDir:
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+        with open('log', 'w') as logfile:
+            for e in events:
+                logfile.write(e.encode())
+        return self
+
+    def __exit__(self, *args):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+def new_explorer(**kargs):
+    return Explorer('log', on_the_fly=False, var_io=False,
+                    num_success_to_stop=1, isolate=False, linear=False,
+                    pattern=None, add_constant=0, del_constant=0,
+                    match_constant=0, max_delete=10, max_otf=10, **kargs)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def build_tree(explorer):
+    root = explorer.root
+    explorer.add_execution(None, root)
+    s0 = root.session
+    p1 = s0.processes[1]
+    a = Execution(root, mutator.InsertEvent(Location(p1.syscalls[1], 'before'),
+                                            [Event(scribe.EventNop(), p1)]))
+    explorer.add_execution(root, a)
+
+    s1 = a.session
+    b = Execution(a, mutator.DeleteEvent(s1.processes[1].syscalls[0]))
+    explorer.add_execution(a, b)
+    p2 = s1.processes[2]
+    c = Execution(a, mutator.InsertEvent(Location(p2.events[1], 'before'),
+                                         [Event(scribe.EventNop(), p2)]))
+    explorer.add_execution(a, c)
+    return (root, a, b, c)
+
+def test_evict():
+    with TempDir():
+        # Lazy sessions have a sidecar index next to their log
+        explorer = new_explorer(materialize_every=2, lazy=True)
+        (root, a, b, c) = build_tree(explorer)
+        assert_equal(a.children, [b, c])
+        index = log_index.index_path(a.logfile_path)
+        assert_true(os.path.exists(index))
+        expected = dict()
+        for e in (b, c):
+            e.generate_log()
+            expected[e] = read(e.logfile_path)
+            os.unlink(e.logfile_path)
+
+        explorer.checkpoint(a)
+        assert_false(a.has_log)
+        assert_false(os.path.exists(a.logfile_path))
+        assert_false(os.path.exists(index))
+        assert_equal(explorer.logs_evicted, 1)
+
+        for e in (b, c):
+            assert_true(e.frame is root.session)
+            assert_true(e.mutation_chain()[0] is root)
+            e.generate_log()
+            assert_equal(read(e.logfile_path), expected[e])
+        assert_true(explorer.regen_time >= 0)
+
+def test_evict_lru_off_frontier():
+    with TempDir():
+        explorer = new_explorer(max_logs=0)
+        (root, a, b, c) = build_tree(explorer)
+        a.state = ExecutionStates.FAILED
+
+        # b and c are still to run, a is on the frontier
+        assert_equal((root.num_todo, a.num_todo), (3, 2))
+        explorer.checkpoint(a)
+        assert_true(a.has_log)
+        assert_equal(explorer.materialized.values(), [a])
+
+        b.state = ExecutionStates.FAILED
+        c.state = ExecutionStates.SUCCESS
+        explorer.checkpoint(a)
+        assert_false(a.has_log)
+        assert_true(root.has_log)
+        assert_equal((root.num_todo, a.num_todo), (1, 0))
+        assert_equal(len(explorer.materialized), 0)
+
+def test_pregenerate_logs():
+    with TempDir():
+        explorer = new_explorer()
+        (root, a, b, c) = build_tree(explorer)
+        root.state = ExecutionStates.SUCCESS
+        a.state = ExecutionStates.FAILED
+        expected = dict()
+        for e in (b, c):
+            e.generate_log()
+            expected[e] = read(e.logfile_path)
+            os.unlink(e.logfile_path)
+            e.has_log = False
+
+        explorer.pregenerate_logs()
+        assert_equal(explorer.logs_batched, 2)
+        for e in (b, c):
+            assert_true(e.has_log)
+            assert_equal(read(e.logfile_path), expected[e])
+
+def test_pregenerate_logs_max_logs():
+    with TempDir():
+        # a has its log already, there is room for one more
+        explorer = new_explorer(max_logs=2)
+        (root, a, b, c) = build_tree(explorer)
+        explorer.pregenerate_logs()
+        assert_equal([e.has_log for e in (b, c)], [True, False])
+
+        # Only the executions added since the last time
+        p1 = b.session.processes[1]
+        d = Execution(b, mutator.DeleteEvent(p1.syscalls[0]))
+        explorer.add_execution(b, d)
+        explorer.max_logs = None
+        explorer.pregenerate_logs()
+        assert_equal([e.has_log for e in (c, d)], [False, True])
+
+def test_instrumented_log_generation():
+    with TempDir():
+        explorer = new_explorer(instrument=True)
+        (root, a, b, c) = build_tree(explorer)
+        for e in (b, c):
+            e.generate_log()
+        assert_equal(explorer.stage_stats.keys(),
+                     ['CatSession', 'EditPlan', 'AdjustResources',
+                      'InsertPidEvents', 'LogWriter'])
+        writer = explorer.stage_stats['LogWriter']
+        assert_equal(writer.events_in,
+                     explorer.stage_stats['InsertPidEvents'].events_out)
+
+def test_frontier():
+    with TempDir():
+        explorer = new_explorer()
+        (root, a, b, c) = build_tree(explorer)
+        assert_equal(explorer.num_state(ExecutionStates.TODO), 4)
+        assert_true(explorer.frontier.top() is root)
+
+        # Equal scores: the first added
+        root.state = ExecutionStates.SUCCESS
+        assert_true(explorer.frontier.top() is a)
+        c.score += 1
+        assert_true(explorer.frontier.top() is c)
+        c.state = ExecutionStates.FAILED
+        a.state = ExecutionStates.FAILED
+        assert_true(explorer.frontier.top() is b)
+        assert_equal([explorer.num_state(s) for s in
+                      (ExecutionStates.TODO, ExecutionStates.SUCCESS,
+                       ExecutionStates.FAILED, ExecutionStates.RUNNING)],
+                     [1, 1, 2, 0])
+
+        assert_true(explorer.running_execution() is None)
+        d = Execution(b, mutator.Replace({}), state=ExecutionStates.RUNNING)
+        explorer.add_execution(b, d)
+        assert_true(explorer.running_execution() is d)
+        assert_true(explorer.frontier.top() is b)
+        d.state = ExecutionStates.FAILED
+        b.state = ExecutionStates.FAILED
+        assert_true(explorer.running_execution() is None)
+        assert_true(explorer.frontier.top() is None)
+        assert_equal(explorer.num_state(ExecutionStates.FAILED), 4)
+
+class StandInDivergeError(scribe.DivergeError):
+    def __init__(self, event):
+        self.event = event
+
+class StandInProcess:
+    def wait(self):
+        pass
+
+    def kill(self):
+        pass
+
+class StandInContext:
+    """ Stands in for the scribe context of a replay: the first RDTSC of
+        pid 2 diverges, with an on the fly mutation when fly is set.
+        Replays take a random time, so that they finish in any order.
+    """
+    fly = False
+
+    def __init__(self, logfile, on_mutation, **kargs):
+        self.on_mutation = on_mutation
+        self.rdtsc = None
+        pid = 0
+        index = 0
+        for e in scribe.EventsFromBuffer(logfile.read()):
+            if isinstance(e, scribe.EventPid):
+                pid = e.pid
+            elif pid == 2:
+                if isinstance(e, scribe.EventRdtsc) and self.rdtsc is None:
+                    self.rdtsc = index
+                index += 1
+
+    def add_init_loader(self, loader):
+        pass
+
+    def spawn(self):
+        return StandInProcess()
+
+    def wait(self):
+        time.sleep(random.random() * 0.01)
+        if self.rdtsc is None:
+            return
+        event = scribe.EventDivergeEventType(pid=2, fatal=not self.fly,
+                                             num_ev_consumed=self.rdtsc + 1,
+                                             type=scribe.EventRdtsc.native_type)
+        if not self.fly:
+            raise StandInDivergeError(event)
+        self.on_mutation(event, [scribe.EventRdtsc()])
+
+    def check_deadlock(self):
+        pass
+
+    def close(self):
+        pass
+
+class StandInFlyContext(StandInContext):
+    fly = True
+
+def explore(context_class, jobs, num_success_to_stop=1):
+    # Not verbose, no diffs
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        with TempDir():
+            explorer = new_explorer(context_class=context_class, jobs=jobs)
+            explorer.num_success_to_stop = num_success_to_stop
+            explorer.run()
+            return [(e.id, str(e), e.state, e.score)
+                    for e in explorer.executions]
+    finally:
+        logger.setLevel(level)
+
+def test_replay_workers():
+    executions = explore(StandInFlyContext, jobs=1)
+    assert_equal([state for (id, name, state, score) in executions],
+                 [ExecutionStates.FAILED, ExecutionStates.SUCCESS,
+                  ExecutionStates.TODO])
+    assert_equal(explore(StandInFlyContext, jobs=2), executions)
+
+    # Whichever replay finishes first, same exploration
+    executions = explore(StandInContext, jobs=3, num_success_to_stop=3)
+    assert_equal(len([e for e in executions
+                      if e[2] == ExecutionStates.SUCCESS]), 3)
+    for i in range(3):
+        assert_equal(explore(StandInContext, jobs=3, num_success_to_stop=3),
+                     executions)
@@ -0,0 +1,111 @@
+from nose.tools import *
+from mreplay.log_index import *
+from mreplay.unistd import *
+from mreplay.session import LazySession
+from mreplay.explorer import load_session
+import scribe
+import tempfile
+import shutil
+import os
+
+events = [ scribe.EventInit(),                                # 0
+           scribe.EventPid(pid=1),                            # 1
+           scribe.EventSyscallExtra(nr=NR_execve, ret=0),     # 2
+           scribe.EventDataExtra(data_type = scribe.SCRIBE_DATA_INPUT |
+                                             scribe.SCRIBE_DATA_STRING,
+                                 data = 'cmd1'),              # 3
+           scribe.EventSyscallEnd(),                          # 4
+           scribe.EventBookmark(id=0, npr=1),                 # 5
+           scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 6
+           scribe.EventPid(pid=2),                            # 7
+           scribe.EventRdtsc() ]                              # 8
+
+def write_log(path, events):
+    with open(path, 'w') as logfile:
+        for e in events:
+            logfile.write(e.encode())
+
+def test_scan_headers():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    offset = 0
+    headers = list(scan_headers(buf))
+    for (e, (start, length, type)) in zip(events, headers):
+        assert_equal((start, length, type),
+                     (offset, len(e.encode()), e.native_type))
+        offset += length
+    assert_equal(len(headers), len(events))
+
+def test_build_index():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    index = build_index(buf)
+
+    assert_equal(len(index), 9)
+    assert_equal(index.offsets[0], 0)
+    assert_equal(index.offsets[-1] + index.lengths[-1], len(buf))
+    assert_equal(list(index.pids), [-1, -1, 1, 1, 1, 1, 1, -1, 2])
+    assert_equal(list(index.syscalls), [-1, -1, 2, 2, 2, -1, 6, -1, -1])
+    assert_equal(list(index.proc_events[1]), [2, 3, 4, 5, 6])
+    assert_equal(list(index.proc_events[2]), [8])
+    assert_equal(list(index.proc_syscalls[1]), [2, 6])
+    assert_equal(list(index.proc_syscall_starts[1]), [0, 4])
+    assert_equal(list(index.proc_syscall_ends[1]), [2, -1])
+    assert_equal(index.proc_names, {1: 'cmd1'})
+    assert_equal(dict((k, list(v)) for (k, v) in index.bookmarks.items()),
+                 {0: [5]})
+
+def test_sidecar_index():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'log')
+        write_log(path, events)
+        buf = open(path).read()
+
+        assert_equal(load_index(path), None)
+        index = open_index(path, buf)
+        assert_true(os.path.exists(index_path(path)))
+        assert_equal(sorted(os.listdir(tmp_dir)), ['log', 'log.idx'])
+
+        cached = load_index(path)
+        assert_equal(list(cached.offsets), list(index.offsets))
+        assert_equal(list(cached.proc_events[1]), list(index.proc_events[1]))
+        assert_equal(cached.proc_names, index.proc_names)
+
+        # Even without lazy, a session is loaded from a valid index
+        session = load_session(path)
+        assert_true(isinstance(session, LazySession))
+        assert_equal(map(repr, session.events), map(repr, events))
+
+        # A modified log invalidates its index
+        write_log(path, events[:-1])
+        assert_equal(load_index(path), None)
+        assert_false(isinstance(load_session(path), LazySession))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_build_index_parallel():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'log')
+        log = events + [ scribe.EventPid(pid=1),                 # 9
+                         scribe.EventData('hello'),              # 10
+                         scribe.EventSyscallEnd(),               # 11
+                         scribe.EventBookmark(id=0, npr=1) ]     # 12
+        write_log(path, log)
+        buf = open(path).read()
+
+        expected = build_index(buf)
+        index = build_index_parallel(path, buf, 2)
+        for name in ('offsets', 'lengths', 'types', 'pids', 'syscalls'):
+            assert_equal(list(getattr(index, name)),
+                         list(getattr(expected, name)))
+        for name in ('proc_events', 'proc_syscalls', 'proc_syscall_starts',
+                     'proc_syscall_ends', 'proc_forks', 'bookmarks'):
+            assert_equal(dict((k, list(v)) for (k, v) in
+                              getattr(index, name).items()),
+                         dict((k, list(v)) for (k, v) in
+                              getattr(expected, name).items()))
+        assert_equal(index.proc_names, expected.proc_names)
+        assert_equal(index.proc_exits, expected.proc_exits)
+        assert_equal(list(index.syscalls)[9:], [-1, 6, 6, -1])
+    finally:
+        shutil.rmtree(tmp_dir)
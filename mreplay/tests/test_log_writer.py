@@ -0,0 +1,111 @@
+from nose.tools import *
+from mreplay.mutator import *
+from mreplay.session import *
+from mreplay.log_writer import *
+from mreplay.unistd import *
+from mreplay.location import Location
+from StringIO import StringIO
+
+events = [ scribe.EventInit(),                                # 0
+           scribe.EventPid(pid=1),                            # 1
+           scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+           scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+           scribe.EventResourceUnlock(),                      # 4
+           scribe.EventSyscallEnd(),                          # 5
+           scribe.EventPid(pid=2),                            # 6
+           scribe.EventSyscallExtra(nr=NR_read, ret=3),       # 7
+           scribe.EventResourceLockExtra(id=3, serial=1),     # 8
+           scribe.EventResourceUnlock(),                      # 9
+           scribe.EventSyscallEnd(),                          # 10
+           scribe.EventPid(pid=1),                            # 11
+           scribe.EventRdtsc(),                               # 12
+           scribe.EventRdtsc() ]                              # 13
+
+def encoded_log(session, *mutators):
+    out = session
+    for m in mutators:
+        out |= m
+    out |= ToRawEvents()
+    return ''.join(e.encode() for e in out)
+
+def written_log(session, *mutators):
+    out = session
+    for m in mutators:
+        out |= m
+    logfile = StringIO()
+    writer = write_log(logfile, out)
+    return (logfile.getvalue(), writer)
+
+def test_write_log_copies_untouched_events():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    session = LazySession(buf)
+    (log, writer) = written_log(session, AdjustResources(), InsertPidEvents())
+    assert_equal(log, encoded_log(Session(events),
+                                  AdjustResources(), InsertPidEvents()))
+    # init, then pid 1 runs 2-5 and 12-13, then pid 2 run 7-10
+    assert_equal(writer.num_copies, 4)
+    assert_equal(writer.bytes_encoded, 2 * len(scribe.EventPid(pid=1).encode()))
+
+def test_write_log_encodes_mutated_events():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    session = LazySession(buf)
+    eager = Session(events)
+    p1 = session.processes[1]
+
+    # Deleting the first syscall of pid 1 shifts the serials of resource 3
+    (log, writer) = written_log(session, DeleteEvent(p1.syscalls[0]),
+                                AdjustResources(), InsertPidEvents())
+    assert_equal(log, encoded_log(eager,
+                                  DeleteEvent(eager.processes[1].syscalls[0]),
+                                  AdjustResources(), InsertPidEvents()))
+    assert_true(writer.bytes_encoded > 0)
+    assert_true(writer.bytes_copied > 0)
+
+def test_write_log_eager_session():
+    session = Session(events)
+    (log, writer) = written_log(session, InsertPidEvents())
+    assert_equal(log, encoded_log(session, InsertPidEvents()))
+    assert_equal(writer.bytes_copied, 0)
+
+def test_write_log_reuses_read_bytes():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    session = Session(events_from_buffer(buf))
+    logfile = StringIO()
+    writer = LogWriter(logfile, buffer_size=16)
+    for e in session | InsertPidEvents():
+        writer.write(e)
+    writer.flush()
+    assert_equal(logfile.getvalue(), encoded_log(Session(events),
+                                                 InsertPidEvents()))
+    assert_equal(writer.bytes_encoded, 2 * len(scribe.EventPid(pid=1).encode()))
+    assert_equal(writer.bytes_reused + writer.bytes_encoded,
+                 len(logfile.getvalue()))
+    assert_true(writer.num_writes > 1)
+
+def test_write_sibling_logs():
+    buf = ''.join(map(lambda e: e.encode(), events))
+    session = LazySession(buf)
+    p1 = session.processes[1]
+    p2 = session.processes[2]
+    siblings = [
+        [DeleteEvent(p1.syscalls[0])],
+        [InsertEvent(Location(p2.syscalls[0], 'before'),
+                     [Event(scribe.EventNop(), p2)])],
+        [],
+    ]
+
+    def pipeline(mutations):
+        m  = EditPlan(session, mutations)
+        m |= AdjustResources(single_pass=True)
+        m |= InsertPidEvents()
+        return m
+
+    logfiles = [StringIO() for mutations in siblings]
+    writers = write_sibling_logs(session,
+                                 [(logfile, pipeline(mutations)) for
+                                  (logfile, mutations) in zip(logfiles, siblings)],
+                                 block_size=2)
+    assert_equal(len(writers), 3)
+    for (logfile, mutations) in zip(logfiles, siblings):
+        (log, writer) = written_log(session, pipeline(mutations))
+        assert_equal(logfile.getvalue(), log)
@@ -4,6 +4,8 @@ from mreplay.session import *
 from mreplay.location import *
 from mreplay.unistd import *
 from mreplay.mutator.location_matcher import *
+from mreplay.mutator.pipe import stages
+from mreplay import log_index
 
 class ToStr(Mutator):
     def process_events(self, events):
@@ -29,8 +31,41 @@ def test_pipe():
     assert_equal(list(out), ['5','2','5'])
 
 def test_adjust_resources():
-    # The tests were written at some point. Where are they ?
-    pass
+    events = [
+               scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+               scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+               scribe.EventResourceUnlock(),                      # 4
+               scribe.EventSyscallEnd(),                          # 5
+               scribe.EventResourceLockExtra(id=3, serial=2),     # 6
+               scribe.EventResourceUnlock(),                      # 7
+               scribe.EventPid(pid=2),                            # 8
+               scribe.EventResourceLockExtra(id=3, serial=1),     # 9
+               scribe.EventResourceUnlock(),                      # 10
+               scribe.EventResourceLockExtra(id=4, serial=0),     # 11
+               scribe.EventResourceUnlock(),                      # 12
+             ]
+    s = Session(events)
+    e = list(s.events)
+    p2 = s.processes[2]
+    lock = Event(scribe.EventResourceLockExtra(id=3, serial=1), p2)
+    plan = EditPlan(s, [DeleteEvent(e[2]),
+                        InsertEvent(Location(e[11], 'before'), [lock])])
+    assert_equal(plan.lock_edits(), ([e[3]], [lock]))
+
+    def serials(single_pass):
+        out = s | plan | AdjustResources(single_pass=single_pass)
+        return [(ee.id, ee.serial) for ee in out
+                if ee.is_a(scribe.EventResourceLockExtra)]
+
+    expected = [(3, 2), (3, 0), (3, 0), (4, 0)]
+    assert_equal(serials(False), expected)
+    assert_equal(serials(True), expected)
+
+    out = s | AdjustResources(single_pass=True)
+    assert_equal([ee.serial for ee in out
+                  if ee.is_a(scribe.EventResourceLockExtra)], [0, 2, 1, 0])
 
 def test_insert_pid_events():
     events = [
@@ -351,64 +386,9 @@ def test_bookmark_and_truncate():
 
     assert_equal(list(out), should_be)
 
-def test_bookmark_filter():
-    def assert_events_equal(l1, l2):
-        # XXX FIXME.If we don't wrap l1 and l2 in lists here, calling
-        # Session(l1) modifies l1.
-        l1 = list(l1)
-        l2 = list(l2)
-
-        l1 = Session(l1) | InsertPidEvents() | ToRawEvents()
-        l2 = Session(l2) | InsertPidEvents() | ToRawEvents()
-        assert_equal(list(l1), list(l2))
-
-    events_original = [
-               scribe.EventInit(),                            # 0
-               scribe.EventPid(pid=1),                        # 1
-               scribe.EventFence(),                            # 2
-               scribe.EventSyscallExtra(nr=NR_fork,  ret=-1), # 3
-               scribe.EventBookmark(id=0, npr=1),             # 4
-               scribe.EventSyscallExtra(nr=NR_fork,  ret=2),  # 5
-               scribe.EventSyscallExtra(nr=NR_fork,  ret=3),  # 6
-               scribe.EventSyscallExtra(nr=NR_wait4, ret=-1), # 7
-
-                # stuff from 3
-               scribe.EventPid(pid=3),                        # 17
-               scribe.EventFence(),                            # 2
-
-               scribe.EventPid(pid=1),                        # 1
-               scribe.EventBookmark(id=1, npr=3),             # 8
-               scribe.EventSyscallExtra(nr=NR_wait4, ret=3),  # 9
-               scribe.EventSyscallExtra(nr=NR_wait4, ret=2),  # 10
-               scribe.EventBookmark(id=2, npr=2),             # 11
-               scribe.EventSyscallExtra(nr=NR_wait4, ret=4),  # 12
-               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),  # 13
-               scribe.EventQueueEof(),
-
-
-               scribe.EventPid(pid=2),                        # 14
-               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
-               scribe.EventBookmark(id=1, npr=3),             # 15
-               scribe.EventSyscallExtra(nr=NR_fork,  ret=4),  # 16
-               scribe.EventFence(),
-               scribe.EventQueueEof(),
-
-
-               scribe.EventPid(pid=3),                        # 17
-               scribe.EventSyscallExtra(nr=NR_read,  ret=0),  # 18
-               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
-               scribe.EventBookmark(id=1, npr=3),             # 19
-               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),  # 20
-               scribe.EventQueueEof(),
-
-               scribe.EventPid(pid=4),                        # 21
-               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
-               scribe.EventBookmark(id=2, npr=2),             # 22
-               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),   # 23
-               scribe.EventQueueEof(),
-             ]
-
-    events = [
+# The log of test_bookmark_filter, interleaved as scribe would record it
+def bookmark_filter_events():
+    return [
                scribe.EventInit(),                            # 0
                scribe.EventPid(pid=1),                        # 1
                scribe.EventFence(),                            # 2
@@ -486,6 +466,66 @@ def test_bookmark_filter():
              ]
 
 
+def test_bookmark_filter():
+    def assert_events_equal(l1, l2):
+        # XXX FIXME.If we don't wrap l1 and l2 in lists here, calling
+        # Session(l1) modifies l1.
+        l1 = list(l1)
+        l2 = list(l2)
+
+        l1 = Session(l1) | InsertPidEvents() | ToRawEvents()
+        l2 = Session(l2) | InsertPidEvents() | ToRawEvents()
+        assert_equal(list(l1), list(l2))
+
+    events_original = [
+               scribe.EventInit(),                            # 0
+               scribe.EventPid(pid=1),                        # 1
+               scribe.EventFence(),                            # 2
+               scribe.EventSyscallExtra(nr=NR_fork,  ret=-1), # 3
+               scribe.EventBookmark(id=0, npr=1),             # 4
+               scribe.EventSyscallExtra(nr=NR_fork,  ret=2),  # 5
+               scribe.EventSyscallExtra(nr=NR_fork,  ret=3),  # 6
+               scribe.EventSyscallExtra(nr=NR_wait4, ret=-1), # 7
+
+                # stuff from 3
+               scribe.EventPid(pid=3),                        # 17
+               scribe.EventFence(),                            # 2
+
+               scribe.EventPid(pid=1),                        # 1
+               scribe.EventBookmark(id=1, npr=3),             # 8
+               scribe.EventSyscallExtra(nr=NR_wait4, ret=3),  # 9
+               scribe.EventSyscallExtra(nr=NR_wait4, ret=2),  # 10
+               scribe.EventBookmark(id=2, npr=2),             # 11
+               scribe.EventSyscallExtra(nr=NR_wait4, ret=4),  # 12
+               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),  # 13
+               scribe.EventQueueEof(),
+
+
+               scribe.EventPid(pid=2),                        # 14
+               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
+               scribe.EventBookmark(id=1, npr=3),             # 15
+               scribe.EventSyscallExtra(nr=NR_fork,  ret=4),  # 16
+               scribe.EventFence(),
+               scribe.EventQueueEof(),
+
+
+               scribe.EventPid(pid=3),                        # 17
+               scribe.EventSyscallExtra(nr=NR_read,  ret=0),  # 18
+               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
+               scribe.EventBookmark(id=1, npr=3),             # 19
+               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),  # 20
+               scribe.EventQueueEof(),
+
+               scribe.EventPid(pid=4),                        # 21
+               scribe.EventSyscallExtra(nr=NR_write,  ret=1),   # 23
+               scribe.EventBookmark(id=2, npr=2),             # 22
+               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),   # 23
+               scribe.EventQueueEof(),
+             ]
+
+    events = bookmark_filter_events()
+
+
     assert_events_equal(events_original, events)
 
 
@@ -566,3 +606,337 @@ def test_bookmark_filter():
 
     out = events | SplitOnBookmark(cutoff=20)
     assert_events_equal(out, events)
+
+def test_split_on_bookmarks():
+    events = bookmark_filter_events()
+
+    # All the segments in one pass: each event is where the splits on the
+    # whole log put it, in the same order for each process.
+    def by_pid(events):
+        pids = {}
+        pid = 0
+        for e in events:
+            if isinstance(e, scribe.EventPid):
+                pid = e.pid
+            else:
+                pids.setdefault(pid, []).append(e)
+        return pids
+
+    cutoffs = [0, 1, 2]
+    heads = [set(map(id, events | SplitOnBookmark(cutoff=c)))
+             for c in cutoffs]
+    segments = [[] for i in range(len(cutoffs) + 1)]
+    for (i, e) in split_on_bookmarks(events, cutoffs):
+        segments[i].append(e)
+    for (i, segment) in enumerate(segments):
+        expected = set(id(e) for e in events
+                    if not isinstance(e, scribe.EventPid) and
+                       all(id(e) not in head for head in heads[:i]) and
+                       (i == len(cutoffs) or id(e) in heads[i]))
+        expected = dict((pid, [e for e in pid_events if id(e) in expected])
+                        for (pid, pid_events) in by_pid(events).items())
+        expected = dict((pid, pid_events)
+                        for (pid, pid_events) in expected.items() if pid_events)
+        assert_equal(by_pid(segment), expected)
+    assert_true(all(segments))
+    assert_equal(sum(map(len, by_pid(sum(segments, [])).values())),
+                 len([e for e in events if not isinstance(e, scribe.EventPid)]))
+
+    # Without cutoffs, the log is a single segment, with its pid events
+    expected = []
+    (pid, output_pid) = (0, 0)
+    for e in events:
+        if isinstance(e, scribe.EventPid):
+            pid = e.pid
+            continue
+        if pid != output_pid:
+            expected.append(scribe.EventPid(pid=pid))
+            output_pid = pid
+        expected.append(e)
+    out = list(split_on_bookmarks(events, []))
+    assert_true(all(i == 0 for (i, e) in out))
+    assert_equal(map(repr, [e for (i, e) in out]), map(repr, expected))
+
+def reprs(events):
+    return [repr(x) for x in events]
+
+def test_split_on_bookmarks_long():
+    # Enough events for the decided ones to be trimmed while pid 2 waits
+    events = [scribe.EventInit()]
+    for i in range(3000):
+        events.append(scribe.EventPid(pid=1 + i % 2))
+        if i == 2000:
+            events.append(scribe.EventBookmark(id=0, npr=2))
+        if i == 2501:
+            events.append(scribe.EventBookmark(id=0, npr=2))
+        events.append(scribe.EventSyscallExtra(nr=NR_read, ret=i))
+
+    head = events | SplitOnBookmark(0)
+    tail = events | SplitOnBookmark(0, do_tail=True)
+    segments = [[], []]
+    for (i, e) in split_on_bookmarks(events, [0]):
+        segments[i].append(e)
+    assert_equal(map(reprs, segments), [reprs(head), reprs(tail)])
+    assert_true(segments[1])
+
+def test_split_on_bookmark_pending_stores():
+    # The waiting events as offsets in the log buffer, or spilled to a file
+    events = bookmark_filter_events()
+    cutoffs = [0, 1, 2]
+
+    buf = ''.join(e.encode() for e in events)
+    index = log_index.build_index(buf)
+    for cutoff in cutoffs + [20]:
+        for do_tail in [False, True]:
+            expected = reprs(events | SplitOnBookmark(cutoff, do_tail))
+            out = scribe.EventsFromBuffer(buf) | \
+                    SplitOnBookmark(cutoff, do_tail, buf=buf)
+            assert_equal(reprs(out), expected)
+            out = scribe.EventsFromBuffer(buf) | \
+                    SplitOnBookmark(cutoff, do_tail, buf=buf, index=index)
+            assert_equal(reprs(out), expected)
+            for max_pending in [0, 2]:
+                out = events | SplitOnBookmark(cutoff, do_tail,
+                                               max_pending=max_pending)
+                assert_equal(reprs(out), expected)
+
+    expected = reprs(split_on_bookmarks(events, cutoffs))
+    out = split_on_bookmarks(scribe.EventsFromBuffer(buf), cutoffs, buf=buf)
+    assert_equal(reprs(out), expected)
+    out = split_on_bookmarks(scribe.EventsFromBuffer(buf), cutoffs, buf=buf,
+                             index=index)
+    assert_equal(reprs(out), expected)
+    out = split_on_bookmarks(events, cutoffs, max_pending=2)
+    assert_equal(reprs(out), expected)
+
+def test_split_on_bookmark_log_ends():
+    # The log ends once all the bookmarks are seen, but before the split
+    # completes: pid 2 still streams in the head, and what waits goes to
+    # the tail.
+    events = [
+               scribe.EventInit(),                            # 0
+               scribe.EventPid(pid=1),                        # 1
+               scribe.EventSyscallExtra(nr=NR_fork,  ret=2),  # 2
+               scribe.EventBookmark(id=0, npr=1),             # 3
+               scribe.EventPid(pid=2),                        # 4
+               scribe.EventSyscallExtra(nr=NR_write, ret=1),  # 5
+               scribe.EventPid(pid=3),                        # 6
+               scribe.EventSyscallExtra(nr=NR_read,  ret=0),  # 7
+               scribe.EventPid(pid=1),                        # 8
+               scribe.EventSyscallExtra(nr=NR_exit,  ret=0),  # 9
+             ]
+    e = events
+    head = [e[0], e[1], e[2], e[3], e[4], e[5]]
+    tail = [e[8], e[9], e[6], e[7]]
+
+    buf = ''.join(x.encode() for x in events)
+    for (do_tail, expected) in [(False, head), (True, tail)]:
+        expected = reprs(expected)
+        assert_equal(reprs(events | SplitOnBookmark(0, do_tail)), expected)
+        out = scribe.EventsFromBuffer(buf) | \
+                SplitOnBookmark(0, do_tail, buf=buf)
+        assert_equal(reprs(out), expected)
+        out = events | SplitOnBookmark(0, do_tail, max_pending=0)
+        assert_equal(reprs(out), expected)
+
+    segments = [[], []]
+    for (i, x) in split_on_bookmarks(events, [0]):
+        segments[i].append(x)
+    assert_equal(map(reprs, segments), [reprs(head), reprs(tail)])
+
+def test_edit_plan():
+    events = [
+               scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+               scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+               scribe.EventResourceUnlock(),                      # 4
+               scribe.EventData('hello'),                         # 5
+               scribe.EventSyscallEnd(),                          # 6
+               scribe.EventRdtsc(),                               # 7
+               scribe.EventPid(pid=2),                            # 8
+               scribe.EventSyscallExtra(nr=NR_write, ret=3),      # 9
+               scribe.EventResourceLockExtra(id=3, serial=1),     # 10
+               scribe.EventResourceUnlock(),                      # 11
+               scribe.EventSyscallEnd(),                          # 12
+               scribe.EventFence(),                               # 13
+               scribe.EventPid(pid=1),                            # 14
+               scribe.EventSyscallExtra(nr=NR_write, ret=1),      # 15
+               scribe.EventData('x'),                             # 16
+               scribe.EventSyscallEnd(),                          # 17
+             ]
+    s = Session(events)
+    e = list(s.events)
+    p1 = s.processes[1]
+
+    def nop(proc):
+        return Event(scribe.EventNop(), proc)
+
+    a = nop(p1)
+    b = nop(p1)
+    c = nop(p1)
+    new_read = Event(scribe.EventSyscallExtra(nr=NR_read, ret=2), p1)
+
+    chains = [
+        [Nop()],
+        [DeleteEvent(e[2])],
+        [DeleteEvent(e[3]), DeleteEvent([e[10], e[13]])],
+        [InsertEvent(Location(e[15], 'before'), [a]), DeleteEvent(e[2])],
+        [InsertEvent(Location(e[5], 'before'), [a]), DeleteEvent(e[2])],
+        [InsertEvent(Location(e[15], 'before'), [a]),
+         InsertEvent(Location(a, 'before'), [b]),
+         DeleteEvent(a),
+         InsertEvent(Location(e[15], 'before'), [c])],
+        [Replace({e[2]: new_read}),
+         InsertEvent(Location(e[2], 'before'), [a]),
+         InsertEvent(Location(new_read, 'before'), [b])],
+        [Replace({e[15]: new_read}), DeleteEvent(new_read)],
+        [SetFlags(Location(e[9], 'after'), 0, scribe.SCRIBE_PERMANANT),
+         DeleteEvent(e[13])],
+        [SetFlagsInit(s, scribe.SCRIBE_PS_ENABLE_ALL),
+         DeleteEvent(e[7]),
+         InsertEvent(Location(e[16], 'before'), [a])],
+    ]
+
+    def ident(e):
+        # SetFlags makes new events on each pass
+        if e.tag == TAG_SET_FLAGS:
+            return repr(e)
+        return id(e)
+
+    for chain in chains:
+        expected = s
+        for m in chain:
+            expected |= m
+        out = s | EditPlan(s, chain)
+        assert_equal(map(ident, out), map(ident, expected))
+
+    assert_raises(TypeError, EditPlan, s, [InsertPidEvents()])
+
+def test_edit_plan_translate():
+    events = [
+               scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+               scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+               scribe.EventResourceUnlock(),                      # 4
+               scribe.EventSyscallEnd(),                          # 5
+               scribe.EventRdtsc(),                               # 6
+               scribe.EventSyscallExtra(nr=NR_write, ret=1),      # 7
+               scribe.EventSyscallEnd(),                          # 8
+               scribe.EventPid(pid=2),                            # 9
+               scribe.EventSyscallExtra(nr=NR_write, ret=3),      # 10
+               scribe.EventResourceLockExtra(id=3, serial=1),     # 11
+               scribe.EventResourceUnlock(),                      # 12
+               scribe.EventSyscallEnd(),                          # 13
+               scribe.EventFence(),                               # 14
+             ]
+    s = Session(events)
+    e = list(s.events)
+
+    def log(events):
+        events |= AdjustResources()
+        events |= InsertPidEvents()
+        events |= ToRawEvents()
+        return [ee.encode() for ee in events]
+
+    chain = [InsertEvent(Location(e[6], 'before'),
+                         [Event(scribe.EventNop(), s.processes[1])]),
+             DeleteEvent(e[2])]
+    plan = EditPlan(s, chain)
+
+    # A session loaded from the log of the plan output
+    f = Session(map(scribe.Event.from_bytes, log(s | plan)))
+    f1 = f.processes[1]
+    f2 = f.processes[2]
+
+    mutations = [
+        DeleteEvent(f1.syscalls[0]),
+        DeleteEvent(f1.events[0]),
+        InsertEvent(Location(f1.events[1], 'after'),
+                    [Event(scribe.EventNop(), f1)]),
+        InsertEvent(Location(f2.syscalls[0], 'after'),
+                    [Event(scribe.EventNop(), f2)]),
+        Replace({f2.events[1]: Event(scribe.EventResourceLockExtra(id=3,
+                                     serial=0), f2)}),
+        SetFlags(Location(f1.events[1], 'before'), 0,
+                 scribe.SCRIBE_PERMANANT),
+    ]
+    for m in mutations:
+        translated = plan.translate(m, f)
+        assert_equal(log(s | EditPlan(s, chain + [translated])), log(f | m))
+
+def test_shard():
+    events = [
+               scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+               scribe.EventResourceLockExtra(id=3, serial=0),     # 3
+               scribe.EventResourceUnlock(),                      # 4
+               scribe.EventSyscallEnd(),                          # 5
+               scribe.EventPid(pid=2),                            # 6
+               scribe.EventSyscallExtra(nr=NR_write, ret=3),      # 7
+               scribe.EventResourceLockExtra(id=3, serial=1),     # 8
+               scribe.EventResourceUnlock(),                      # 9
+               scribe.EventSyscallEnd(),                          # 10
+               scribe.EventPid(pid=1),                            # 11
+               scribe.EventRdtsc(),                               # 12
+               scribe.EventPid(pid=2),                            # 13
+               scribe.EventRdtsc(),                               # 14
+             ]
+    s = Session(events)
+    e = list(s.events)
+
+    def pipeline():
+        m  = DeleteEvent(e[2])
+        m |= InsertEvent(Location(e[14], 'before'),
+                         [Event(scribe.EventNop(), s.processes[2])])
+        m |= Replace({e[12]: Event(scribe.EventRdtsc(tsc=42), s.processes[1])})
+        m |= AdjustResources()
+        m |= InsertPidEvents()
+        return m
+
+    sharded = shard(pipeline(), jobs=2)
+    assert_true(isinstance(sharded.lmutator.lmutator, Sharded))
+    assert_equal(len(sharded.lmutator.lmutator.mutators), 3)
+    assert_true(isinstance(sharded.lmutator.rmutator, AdjustResources))
+
+    # A run of cheap mutators is not worth sharding
+    plan = shard(EditPlan(s, [DeleteEvent(e[2])]) | AdjustResources(), jobs=2)
+    assert_false(any(isinstance(stage, Sharded) for stage in stages(plan)))
+
+    # Both on the session and on the interleaved stream of its log
+    for source in (lambda: s, lambda: e):
+        expected = map(repr, source() | pipeline())
+        for jobs in (1, 2):
+            assert_equal(map(repr, source() | shard(pipeline(), jobs)),
+                         expected)
+
+def test_instrument():
+    events = [
+               scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 2
+               scribe.EventData('hello'),                         # 3
+               scribe.EventSyscallEnd(),                          # 4
+               scribe.EventRdtsc(),                               # 5
+             ]
+    s = Session(events)
+    e = list(s.events)
+
+    m  = DeleteEvent(e[2])
+    m |= InsertEvent(Location(e[5], 'before'),
+                     [Event(scribe.EventNop(), s.processes[1])])
+    m |= InsertEoqEvents()
+    (pipeline, stats) = instrument(s | m)
+    out = list(pipeline)
+
+    assert_equal(map(lambda s: s.name, stats),
+                 ['CatSession', 'DeleteEvent', 'InsertEvent', 'InsertEoqEvents'])
+    assert_equal(map(lambda s: (s.events_in, s.events_out), stats),
+                 [(0, 5), (5, 2), (2, 3), (3, 4)])
+    # DeleteEvent reads the syscall before it outputs anything after it
+    assert_equal(stats[1].peak_buffered, 3)
+    assert_equal(len(out), 4)
+    assert_true(all(s.self_time >= 0 for s in stats))
+    assert_equal(len(format_stats(stats)), 5)
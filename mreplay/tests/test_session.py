@@ -22,6 +22,16 @@ def test_event_is():
     assert_true(e.is_a(scribe.EventSyscallExtra))
     assert_false(e.is_a(scribe.EventResourceLockExtra))
 
+def test_event_tag():
+    e = Event(scribe.EventSyscallExtra(nr = 3, ret = 4))
+    assert_equal(e.tag, TAG_SYSCALL)
+    assert_equal((e.nr, e.ret), (3, 4))
+    e = Event(scribe.EventResourceLockExtra(id = 3, serial = 5))
+    assert_equal(e.tag, TAG_RESOURCE_LOCK)
+    assert_equal((e.id, e.serial), (3, 5))
+    assert_equal(Event(scribe.EventRegs()).tag, TAG_OTHER)
+    assert_true(Event(scribe.EventRegs()).is_a(scribe.Event))
+
 def test_event_list():
     e1 = Event(scribe.EventRegs())
     e2 = Event(scribe.EventRegs())
@@ -63,6 +73,22 @@ def test_event_list():
     el1.extend(el2)
     assert_equal(list(el1), [e1, e2, e3, e2, e3])
 
+def test_event_list_sort():
+    events = map(lambda nr: Event(scribe.EventSyscallExtra(nr=nr)), [3, 1, 2])
+    el = EventList()
+    el.extend(events)
+    el.sort(key=lambda e: e.nr)
+
+    assert_equal(map(lambda e: e.nr, el), [1, 2, 3])
+    assert_equal(el.index(events[0]), 2)
+    assert_equal(el.index(events[1]), 0)
+    assert_equal(list(el.after(events[1])), [events[2], events[0]])
+
+def test_event_has_no_dict():
+    e = Event(scribe.EventRegs())
+    def set_attr():
+        e.foo = 1
+    assert_raises(AttributeError, set_attr)
 
 def test_event_doesnt_belong_to_proc_by_default():
     e = Event(scribe.EventRegs())
@@ -132,6 +158,30 @@ def test_process_syscall():
 
     assert_equal(list(proc.syscalls), [events[1], events[5], events[9]])
 
+    assert_equal(proc.syscall_span(events[5]), (5, 8))
+    assert_equal(proc.syscall_end(events[5]), events[8])
+    assert_equal(proc.syscall_end(events[9]), events[10])
+
+def test_process_syscall_without_end():
+    events = map(lambda se: Event(se), [
+               scribe.EventSyscallExtra(1),     # 0
+               scribe.EventRegs(),              # 1
+               scribe.EventSyscallExtra(2),     # 2
+               scribe.EventRegs(),              # 3
+               scribe.EventSyscallEnd(),        # 4
+               scribe.EventSyscallExtra(3),     # 5
+               scribe.EventRegs() ])            # 6
+
+    proc = Process(pid=1)
+    for event in events:
+        proc.add_event(event)
+
+    assert_equal(list(events[0].children), events[1:4])
+    assert_equal(list(events[2].children), [events[3]])
+    assert_equal(list(events[5].children), [events[6]])
+    assert_equal(proc.syscall_end(events[0]), events[4])
+    assert_equal(proc.syscall_end(events[5]), None)
+
 
 def test_process_name():
     events = [ scribe.EventSyscallExtra(nr=unistd.NR_execve, ret=0),
@@ -218,3 +268,117 @@ def test_process_pid():
     assert_equal(list(session.processes[2].events), [events[5]])
 
     assert_equal(session.processes[1], session.init_proc)
+
+def test_lazy_session():
+    events = [ scribe.EventInit(),                                # 0
+               scribe.EventPid(pid=1),                            # 1
+               scribe.EventSyscallExtra(nr=NR_execve, ret=0),     # 2
+               scribe.EventDataExtra(data_type = scribe.SCRIBE_DATA_INPUT |
+                                                 scribe.SCRIBE_DATA_STRING,
+                                     data = 'cmd1'),              # 3
+               scribe.EventSyscallEnd(),                          # 4
+               scribe.EventPid(pid=2),                            # 5
+               scribe.EventRdtsc(),                               # 6
+               scribe.EventPid(pid=1),                            # 7
+               scribe.EventSyscallExtra(nr=NR_read, ret=5),       # 8
+               scribe.EventData('hello'),                         # 9
+               scribe.EventSyscallEnd() ]                         # 10
+    buf = ''.join(map(lambda e: e.encode(), events))
+
+    session = LazySession(buf)
+    assert_equal(len(session.events), 11)
+    assert_equal(map(repr, session.events), map(repr, events))
+    assert_equal(sorted(session.processes.keys()), [1, 2])
+    assert_equal(session.init_proc.name, 'cmd1')
+
+    p1 = session.processes[1]
+    assert_equal(len(p1.events), 6)
+    assert_equal(len(p1.syscalls), 2)
+    assert_true(p1.events[0] is session.events[2])
+    assert_true(p1.events[-1] is session.events[10])
+    assert_equal(session.events[0].proc, None)
+    assert_equal(session.events[6].proc, session.processes[2])
+
+    read = p1.syscalls[1]
+    assert_equal(read.nr, NR_read)
+    assert_equal(read.index, 3)
+    assert_equal(read.syscall_index, 1)
+    assert_true(read.syscall is read)
+    assert_equal(list(read.children), [p1.events[4]])
+    assert_true(p1.events[4].syscall is read)
+    assert_true(p1.events[5].syscall is read)
+    assert_equal(list(p1.events.before(read)), list(reversed(p1.events[0:3])))
+
+    assert_raises(ValueError, p1.events.index, session.events[6])
+    assert_raises(ValueError, p1.events.index, Event(scribe.EventRdtsc()))
+
+def test_session_indexes():
+    events = [ scribe.EventPid(pid=1),                           # 0
+               scribe.EventSyscallExtra(nr=NR_read, ret=0),      # 1
+               scribe.EventResourceLockExtra(id=7, serial=1),    # 2
+               scribe.EventResourceUnlock(),                     # 3
+               scribe.EventSyscallEnd(),                         # 4
+               scribe.EventResourceLockExtra(id=7, serial=3),    # 5
+               scribe.EventMemOwnedReadExtra(serial=2,
+                                             address=0x1000),   # 6
+               scribe.EventResourceUnlock(),                     # 7
+               scribe.EventPid(pid=2),                           # 8
+               scribe.EventSyscallExtra(nr=NR_write, ret=0),     # 9
+               scribe.EventResourceLockExtra(id=7, serial=2),    # 10
+               scribe.EventMemOwnedWriteExtra(serial=1,
+                                              address=0x1000),  # 11
+               scribe.EventResourceUnlock(),                     # 12
+               scribe.EventSyscallEnd(),                         # 13
+               scribe.EventSyscallExtra(nr=NR_read, ret=0),      # 14
+               scribe.EventSyscallEnd() ]                        # 15
+
+    session = Session(events)
+    e = list(session.events)
+
+    assert_equal(session.resources.keys(), [7])
+    resource = session.resources[7]
+    assert_equal(list(resource.events), [e[2], e[3], e[10], e[12], e[5], e[7]])
+    assert_equal(resource.locks, [e[2], e[10], e[5]])
+    assert_true(e[3].resource is resource)
+
+    assert_equal(list(session.resource_orphans(1)), [4])
+    assert_equal(list(session.resource_orphans(2)), [])
+
+    assert_equal(session.mem_owned_events(0x1000), [e[11], e[6]])
+    assert_equal(session.mem_owned_events(0x2000), [])
+
+    positions = session.syscall_positions(NR_read)
+    assert_equal(dict((pid, list(p)) for (pid, p) in positions.items()),
+                 {1: [0], 2: [1]})
+    assert_equal(session.syscall_positions(NR_exit), {})
+
+def test_process_tree():
+    events = [ scribe.EventPid(pid=1),                       # 0
+               scribe.EventSyscallExtra(nr=NR_fork, ret=-1), # 1
+               scribe.EventSyscallExtra(nr=NR_fork, ret=2),  # 2
+               scribe.EventSyscallExtra(nr=NR_clone, ret=3), # 3
+               scribe.EventPid(pid=2),                       # 4
+               scribe.EventSyscallExtra(nr=NR_exit, ret=0),  # 5
+               scribe.EventPid(pid=3),                       # 6
+               scribe.EventFence(),                          # 7
+               scribe.EventPid(pid=4) ]                      # 8
+
+    def check(session, e):
+        p = session.processes
+        assert_equal(p[1].parent, None)
+        assert_equal(p[1].children, [p[2], p[3]])
+        assert_equal(p[2].parent, p[1])
+        assert_equal(p[2].fork_syscall, e[2])
+        assert_equal(p[3].fork_syscall, e[3])
+        assert_equal(p[2].exit_syscall, e[5])
+        assert_equal(p[1].exit_syscall, None)
+        assert_equal(p[1].first_anchor, e[1])
+        assert_equal(p[1].last_anchor, e[3])
+        assert_equal(p[4].last_anchor, None)
+        assert_equal(sorted(session.root_processes), sorted([p[1], p[4]]))
+
+    session = Session(events)
+    check(session, list(session.events))
+
+    session = LazySession(''.join(map(lambda e: e.encode(), events)))
+    check(session, list(session.events))
@@ -0,0 +1,148 @@
+from nose.tools import *
+from mreplay.simulate import *
+from mreplay.explorer import Explorer, ExecutionStates
+from mreplay.unistd import *
+from StringIO import StringIO
+import scribe
+import logging
+import tempfile
+import shutil
+import os
+
+def syscall(nr, ret, *body):
+    return [scribe.EventSyscallExtra(nr=nr, ret=ret)] + list(body) + \
+           [scribe.EventSyscallEnd()]
+
+def log(*processes, **kargs):
+    # The flags go at the start of the first process, like SetFlagsInit
+    # puts them
+    events = [scribe.EventInit()]
+    for (pid, process_events) in processes:
+        events.append(scribe.EventPid(pid=pid))
+        if 'flags' in kargs and len(events) == 2:
+            events.append(scribe.EventSetFlags(flags=kargs['flags'],
+                          duration=scribe.SCRIBE_PERMANANT))
+        events.extend(process_events)
+    return events
+
+def replay(target, events):
+    mutations = []
+    def on_mutation(diverge_event, muts):
+        mutations.append((diverge_event, muts))
+    logfile = StringIO(''.join(e.encode() for e in events))
+    context = SimulatedBackend(target)(logfile, on_mutation)
+    context.wait()
+    return mutations
+
+def diverge(target, events):
+    try:
+        replay(target, events)
+    except SimulatedDivergeError as e:
+        assert_equal(e.event.fatal, 1)
+        return e.event
+    assert False, 'no divergence'
+
+read = syscall(NR_read, 3, scribe.EventData(data='abc'))
+target = log((1, read + syscall(NR_write, 1)))
+
+def test_same():
+    assert_equal(replay(target, target), [])
+    # A shorter replay is fine
+    assert_equal(replay(target, log((1, read))), [])
+
+def test_diverge_syscall():
+    e = diverge(target, log((1, syscall(NR_open, 3))))
+    assert_true(isinstance(e, scribe.EventDivergeSyscall))
+    assert_equal((e.pid, e.nr, e.num_ev_consumed), (1, NR_read, 1))
+
+def test_diverge_syscall_ret():
+    e = diverge(target, log((1, read + syscall(NR_write, 0))))
+    assert_true(isinstance(e, scribe.EventDivergeSyscallRet))
+    assert_equal((e.ret, e.num_ev_consumed), (1, 4))
+
+def test_diverge_data_content():
+    e = diverge(target, log((1, syscall(NR_read, 3,
+                                        scribe.EventData(data='abd')))))
+    assert_true(isinstance(e, scribe.EventDivergeDataContent))
+    assert_equal((e.data, e.size, e.num_ev_consumed), ('abc', 3, 1))
+
+def test_diverge_mem_owned():
+    e = diverge(target, log((1, [scribe.EventMemOwnedWriteExtra(address=12)])))
+    assert_true(isinstance(e, scribe.EventDivergeMemOwned))
+    assert_equal((e.address, e.write_access, e.num_ev_consumed), (12, 1, 1))
+
+def test_diverge_event_type():
+    e = diverge(target, log((1, [scribe.EventRdtsc()])))
+    assert_true(isinstance(e, scribe.EventDivergeEventType))
+    assert_equal((e.type, e.num_ev_consumed),
+                 (scribe.EventSyscallExtra.native_type, 1))
+    # pid 2 does nothing
+    e = diverge(target, log((2, [scribe.EventRdtsc()])))
+    assert_equal(e.type, scribe.EventQueueEof.native_type)
+
+def test_on_the_fly():
+    flags = scribe.SCRIBE_PS_ENABLE_ALL & ~scribe.SCRIBE_PS_STRICT_REPLAY
+    mutations = replay(target, log((1, read + syscall(NR_write, 0)),
+                                   flags=flags))
+    assert_equal(len(mutations), 1)
+    (e, muts) = mutations[0]
+    assert_true(isinstance(e, scribe.EventDivergeSyscallRet))
+    # The SetFlags event is one of the process events
+    assert_equal((e.fatal, e.num_ev_consumed), (0, 5))
+    assert_equal(muts, syscall(NR_write, 1))
+
+    # Only some divergences can be fixed on the fly
+    e = diverge(target, log((1, read + syscall(NR_write, 1) + read),
+                            flags=flags))
+    assert_true(isinstance(e, scribe.EventDivergeEventType))
+
+    # The syscall of the target gets executed
+    mutations = replay(target, log((1, syscall(NR_write, 1)), flags=flags))
+    (e, muts) = mutations[0]
+    assert_true(isinstance(e, scribe.EventDivergeSyscall))
+    assert_equal((e.fatal, e.num_ev_consumed), (0, 1))
+    assert_equal(muts, read)
+    assert_equal(len(mutations), 1)
+
+def test_ignore_syscall():
+    ignore = scribe.EventSetFlags(flags=0,
+                                  duration=scribe.SCRIBE_UNTIL_NEXT_SYSCALL)
+    assert_equal(replay(target, log((1, [ignore] + syscall(NR_write, 1)))), [])
+
+def test_explore():
+    # The write of pid 1 returns 2, not 1
+    events = log((1, syscall(NR_read, 5) + syscall(NR_write, 1)),
+                 (2, syscall(NR_read, 3)))
+    target = log((1, syscall(NR_read, 5) + syscall(NR_write, 2)),
+                 (2, syscall(NR_read, 3)))
+
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp()
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        os.chdir(path)
+        with open('log', 'w') as logfile:
+            for e in events:
+                logfile.write(e.encode())
+        for on_the_fly in (False, True):
+            backend = SimulatedBackend(target)
+            explorer = Explorer('log', on_the_fly=on_the_fly, var_io=False,
+                                num_success_to_stop=1, isolate=False,
+                                linear=False, pattern=None, add_constant=0,
+                                del_constant=0, match_constant=0,
+                                max_delete=10, max_otf=10,
+                                context_class=backend)
+            explorer.run()
+            assert_equal(explorer.num_state(ExecutionStates.SUCCESS), 1)
+            assert_equal(explorer.num_setups, backend.num_replays)
+            if on_the_fly:
+                assert_true(backend.num_mutations > 0)
+            else:
+                assert_true(backend.num_replays >= 2)
+                assert_equal(backend.num_mutations, 0)
+    finally:
+        logger.setLevel(level)
+        os.chdir(cwd)
+        shutil.rmtree(path)
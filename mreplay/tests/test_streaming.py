@@ -0,0 +1,74 @@
+from nose.tools import *
+from mreplay.session import *
+from mreplay.streaming import *
+from mreplay.unistd import *
+
+def test_chunked_array_spills():
+    store = SpillStore(memory_cap=64)
+    a = ChunkedArray(store, 'l', chunk_size=4)
+    b = ChunkedArray(store, 'l', chunk_size=4)
+    for i in range(100):
+        a.append(i)
+        b.append(-i)
+    assert_true(store.num_spills > 0)
+    assert_true(store.resident_bytes <= 64)
+
+    assert_equal(list(a), range(100))
+    assert_equal(list(b), [-i for i in range(100)])
+    assert_true(store.num_loads > 0)
+
+    a[3] = 42
+    for i in range(100):
+        b[i]
+    assert_equal(a[3], 42)
+    assert_equal(a[-1], 99)
+    assert_raises(IndexError, a.__getitem__, 100)
+    store.close()
+
+def synthetic_buffer():
+    events = [scribe.EventInit()]
+    for i in range(20):
+        for pid in (1, 2):
+            events += [ scribe.EventPid(pid=pid),
+                        scribe.EventSyscallExtra(nr=NR_read, ret=5),
+                        scribe.EventResourceLockExtra(id=3, serial=2*i+pid),
+                        scribe.EventResourceUnlock(),
+                        scribe.EventData('hello'),
+                        scribe.EventSyscallEnd(),
+                        scribe.EventResourceLockExtra(id=4, serial=i),
+                        scribe.EventRdtsc() ]
+    return (events, ''.join(map(lambda e: e.encode(), events)))
+
+def test_streaming_session():
+    (events, buf) = synthetic_buffer()
+    session = StreamingSession(buf, memory_cap=256, window=8, chunk_size=8)
+    eager = Session(events)
+
+    assert_equal(len(session.events), len(events))
+    assert_equal(map(repr, session.events), map(repr, events))
+    assert_true(session.store.num_spills > 0)
+
+    for pid in (1, 2):
+        p = session.processes[pid]
+        q = eager.processes[pid]
+        assert_equal(map(repr, p.events), map(repr, q.events))
+        assert_equal(len(p.syscalls), len(q.syscalls))
+        read = p.syscalls[7]
+        assert_equal(read.index, q.syscalls[7].index)
+        assert_equal(map(repr, read.children),
+                     map(repr, q.syscalls[7].children))
+        assert_equal(list(session.resource_orphans(pid)),
+                     list(eager.resource_orphans(pid)))
+
+    assert_equal(sorted(session.resources.keys()),
+                 sorted(eager.resources.keys()))
+    assert_equal(map(repr, session.resources[3].events),
+                 map(repr, eager.resources[3].events))
+    assert_equal(dict((id, list(serials)) for (id, serials)
+                      in session.lock_serials().items()),
+                 dict((id, list(serials)) for (id, serials)
+                      in eager.lock_serials().items()))
+
+    stats = session.stats()
+    assert_true(stats['peak_resident_bytes'] >= stats['resident_bytes'])
+    session.close()